@@ -1,5 +1,5 @@
 import logging
-from typing import List, Type, Union
+from typing import List, Tuple, Type, Union
 
 from concu.stock_cache import StockCache, StockModel
 
@@ -24,6 +24,11 @@ class PrizeStockCache(StockCache):
         from blind_box.models import Prize
         return Prize.objects.filter(pk=id).update(stock=qty) == 1
 
+    def save_stock_models(self, items: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
+        from blind_box.models import Prize
+        Prize.objects.bulk_update([Prize(pk=_id, stock=qty) for _id, qty in items], ['stock'])
+        return [_id for _id, qty in items]
+
 
 class BlindBoxCache(StockCache):
     def load_list(self) -> List[StockModel]:
@@ -41,6 +46,11 @@ class BlindBoxCache(StockCache):
         from blind_box.models import BlindBox
         return BlindBox.objects.filter(pk=id).update(stock=qty) == 1
 
+    def save_stock_models(self, items: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
+        from blind_box.models import BlindBox
+        BlindBox.objects.bulk_update([BlindBox(pk=_id, stock=qty) for _id, qty in items], ['stock'])
+        return [_id for _id, qty in items]
+
 
 prsc = PrizeStockCache()
 bdbc = BlindBoxCache()
@@ -63,10 +63,15 @@ level_sales_key_lock = get_redis_name('level_sales_key_lock{}')
 ticket_order_refund_key = get_redis_name('ticket_order_refund_key')
 update_goods_stock_lock = get_redis_name('update_goods_stock_lock{}')
 receipt_pay_key = get_redis_name('receipt_pay_key_lock{}')
+# 微信支付回调按transaction_id记账: processing/done
+pay_notify_ledger_key = get_redis_name('pay_notify_ledger_{}')
 pika_down_key = get_redis_name('pika_down_key_{}')
 session_actual_amount_key = get_redis_name('session_actual_amount_key')
 scroll_key = get_redis_name('scroll_key')
 pika_show_calendar_key = get_redis_name('pika_show_calendar_key_{}')
+# 日历索引: 城市_年_月 -> {日期: 上架场次数}; 场次 -> 计入的位置(城市_日期)
+pika_show_calendar_index_key = get_redis_name('pika_show_calendar_index_{}_{}_{}')
+pika_show_calendar_session_key = get_redis_name('pika_show_calendar_session')
 pika_session_mz_buy = get_redis_name('pika_session_mz_buy')
 check_cps_source_key = get_redis_name('check_cps_source_key_{}')
 theater_card_order_create_key = get_redis_name('theater_card_order_creat_{}')
@@ -88,6 +93,8 @@ redis_ticket_level_cache = get_redis_name('redis_ticket_level_cache_{}')
 redis_ticket_level_tiktok_cache = get_redis_name('redis_ticket_level_tiktok_cache_{}')
 third_cat_list = get_redis_name('third_cat_list')
 export_ticket_order_key = get_redis_name('export_ticket_order_key')
+# 消费券批量发放执行锁
+coupon_import_lock_key = get_redis_name('coupon_import_lock_{}')
 
 stl_user_num = get_redis_name('stl_user_num')
 stl_super_card_num = get_redis_name('stl_super_card_num')
@@ -141,11 +148,14 @@ lock_seat_key = get_redis_name('lock_seat_key_{}')
 lock_cancel_seat_key = get_redis_name('lock_cancel_seat_key_{}')
 account_info_cache_key = get_redis_name('account_info_cache_key_{}')
 cache_show_detail_key = get_redis_name('cache_show_detail_key_{}')
+redis_show_detail_doc_key = get_redis_name('redis_show_detail_doc_key_{}_{}')
 settle_order_award_key = get_redis_name('settle_order_award')
 cache_token_share_code_key = get_redis_name('token_sc_{}')
 cache_share_code_user_key = get_redis_name('sc_user_{}')
 cache_share_code_account_flag_key = get_redis_name('sc_flag_{}')
 cache_user_new_parent_key = get_redis_name('user_np_{}')
+# 用户id->上级链路[自己, 上级, 上上级...]
+cache_user_ancestor_path_key = get_redis_name('user_ap_{}')
 save_model_key = get_redis_name('save_m_{}')
 show_project_change_key = get_redis_name('showp_c_{}')
 show_collect_copy_key = get_redis_name('show_collect_copy_key')
@@ -153,6 +163,36 @@ cache_order_session_key = get_redis_name('cache_order_session_{}')
 cache_order_show_key = get_redis_name('cache_order_show_{}')
 cache_order_seat_key = get_redis_name('cache_order_seat_{}_{}')
 matrix_seat_data_key = get_redis_name('matrix_seat_data_key_{}')
+# 座位图静态数据(布局变化时才写), 座位状态(每个座位1字节, 按座位index定位)
+pika_seat_geometry_key = get_redis_name('pika_seat_geometry_key_{}')
+pika_seat_status_key = get_redis_name('pika_seat_status_key_{}')
+pika_seat_order_key = get_redis_name('pika_seat_order_key_{}')
+# 项目场次缓存重建队列: 待重建项目(score为最后入队时间), 首次入队时间, 入队原因, 已安排的worker, 统计
+show_rebuild_queue_key = get_redis_name('show_rebuild_queue')
+show_rebuild_first_key = get_redis_name('show_rebuild_first')
+show_rebuild_reason_key = get_redis_name('show_rebuild_reason')
+show_rebuild_scheduled_key = get_redis_name('show_rebuild_scheduled')
+show_rebuild_stats_key = get_redis_name('show_rebuild_stats')
+# 入场验票索引(按扫码的场次编号): 检票码->订单等信息, 订单->检票码, 检票码->展示快照, 已检票码, 索引信息; 待入库的检票记录
+gate_code_key = get_redis_name('gate_code_{}')
+gate_order_key = get_redis_name('gate_order_{}')
+gate_snapshot_key = get_redis_name('gate_snapshot_{}')
+gate_checked_key = get_redis_name('gate_checked_{}')
+gate_meta_key = get_redis_name('gate_meta_{}')
+gate_check_queue_key = get_redis_name('gate_check_queue')
+gate_check_scheduled_key = get_redis_name('gate_check_scheduled')
+gate_sessions_key = get_redis_name('gate_sessions')
+# 未付款订单过期索引(score为下单时间), 已同步到的订单ID, 统计, 已取消但释放失败待重试的订单
+order_expire_index_key = get_redis_name('order_expire_index')
+order_expire_synced_key = get_redis_name('order_expire_synced')
+order_expire_stats_key = get_redis_name('order_expire_stats')
+order_expire_release_key = get_redis_name('order_expire_release')
+# 抖音带货归属: 水位(付款时间戳), 执行锁
+cps_attribution_watermark_key = get_redis_name('cps_attribution_watermark')
+cps_attribution_lock_key = get_redis_name('cps_attribution_lock')
+# 开场短信提醒: 执行锁(order/give), 统计
+show_notice_lock_key = get_redis_name('show_notice_lock_{}')
+show_notice_stats_key = get_redis_name('show_notice_stats')
 
 
 def get_redis_with_db(db: int) -> StrictRedis:
@@ -297,6 +337,34 @@ def release_lock(lock_key: str, owner: str = None):
         red.delete(lock_key)
 
 
+# 批量加锁: 任意一个key已存在则全部不加, 否则全部 SET NX EX
+_acquire_locks_script = _redis.register_script("""
+for i = 1, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        return 0
+    end
+end
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[1], 'EX', ARGV[2], 'NX')
+end
+return 1
+""")
+
+
+def acquire_locks(lock_keys: list, expire: int = 60, value=1) -> bool:
+    """
+    一次往返原子地锁定多个key, 全部成功或全部失败(不会留下部分锁)
+    """
+    if not lock_keys:
+        return True
+    return bool(_acquire_locks_script(keys=lock_keys, args=[value, expire], client=get_redis()))
+
+
+def release_locks(lock_keys: list):
+    if lock_keys:
+        get_redis().delete(*lock_keys)
+
+
 @contextlib.contextmanager
 def run_with_lock(lock_key: str, expire: int = 10, wait_timeout: int = 0, owner: str = None) -> LockResult:
     try:
@@ -0,0 +1,47 @@
+# coding: utf-8
+import aioredis
+from django.conf import settings
+
+"""
+FastAPI入口(main.py)使用的异步redis客户端, 每个进程一个, 连接在事件循环里按需创建.
+django缓存里的值由django_redis序列化, 读出后用cache.client.decode解码, key用cache.make_key生成.
+"""
+_cache_redis = None
+_stock_redis = None
+
+
+def get_async_cache_redis() -> aioredis.Redis:
+    global _cache_redis
+    if not _cache_redis:
+        conf = settings.CACHES['default']
+        max_connections = (conf.get('OPTIONS') or dict()).get('CONNECTION_POOL_KWARGS', dict()).get(
+            'max_connections')
+        _cache_redis = aioredis.from_url(conf['LOCATION'], max_connections=max_connections)
+    return _cache_redis
+
+
+def get_async_stock_redis() -> aioredis.Redis:
+    """
+    和concu.get_redis()(库存缓存)同一个库
+    """
+    global _stock_redis
+    if not _stock_redis:
+        from concu import get_redis
+        kwargs = get_redis().connection_pool.connection_kwargs
+        _stock_redis = aioredis.Redis(host=kwargs.get('host', '127.0.0.1'), port=kwargs.get('port', 6379),
+                                      db=kwargs.get('db', 0), decode_responses=True)
+    return _stock_redis
+
+
+async def cache_get(key: str):
+    from django.core.cache import cache
+    value = await get_async_cache_redis().get(cache.make_key(key))
+    return cache.client.decode(value) if value is not None else None
+
+
+async def cache_get_many(keys: list) -> list:
+    from django.core.cache import cache
+    if not keys:
+        return []
+    values = await get_async_cache_redis().mget([cache.make_key(key) for key in keys])
+    return [cache.client.decode(value) if value is not None else None for value in values]
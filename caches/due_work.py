@@ -0,0 +1,135 @@
+# coding: utf-8
+import logging
+import time
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from caches import get_redis, get_redis_name
+
+log = logging.getLogger(__name__)
+
+"""
+到期任务调度(场次结束下架、结束后自动核销等):
+对象创建或修改时按到期时间写入该类任务的有序集合(同一对象再次写入覆盖到期时间),
+每次执行用lua取出并删除已到期的一批, 交给handler(ids)批量处理, 不再每次扫描整张表.
+handler需要自己在数据库里复核条件(到期时间可能已修改), 失败的一批推迟retry_delay秒重试.
+通过queryset.update修改、上线前已存在等没有登记的对象, 由执行时每sweep_interval秒一次的sweep补登记.
+"""
+# KEYS[1]: 有序集合; ARGV[1]: 当前时间戳, ARGV[2]: 数量
+POP_DUE_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+end
+return ids
+"""
+
+_pop_script = None
+_works = dict()
+
+
+def get_pop_script():
+    global _pop_script
+    if not _pop_script:
+        _pop_script = get_redis().register_script(POP_DUE_LUA)
+    return _pop_script
+
+
+def to_ts(dt: datetime) -> int:
+    return int(time.mktime(dt.timetuple()))
+
+
+class DueWork(object):
+    batch_size = 500
+    retry_delay = 60
+    # 每次执行最多处理的批数, 剩下的下次执行
+    max_batches = 20
+    sweep_interval = 3600
+
+    def __init__(self, kind: str, handler: Callable, sweep: Callable = None):
+        """
+        handler: handler(ids) 处理一批到期的对象id, 返回处理的数量
+        sweep: sweep() 返回需要登记的 [(id, 到期时间)], 只返回id和时间
+        """
+        self.kind = kind
+        self.handler = handler
+        self.sweep_func = sweep
+        self.key = get_redis_name('due_work_{}'.format(kind))
+        self.stats_key = get_redis_name('due_work_{}_stats'.format(kind))
+        self.swept_key = get_redis_name('due_work_{}_swept'.format(kind))
+        _works[kind] = self
+
+    def register(self, _id: int, due_at: datetime):
+        if due_at:
+            get_redis().zadd(self.key, {_id: to_ts(due_at)})
+
+    def register_many(self, items: List[Tuple[int, datetime]]):
+        with get_redis().pipeline(transaction=False) as pipe:
+            num = 0
+            for _id, due_at in items:
+                if due_at:
+                    pipe.zadd(self.key, {_id: to_ts(due_at)})
+                    num += 1
+                    if num % self.batch_size == 0:
+                        pipe.execute()
+            pipe.execute()
+
+    def unregister(self, _id: int):
+        get_redis().zrem(self.key, _id)
+
+    def pop_due(self) -> list:
+        ids = get_pop_script()(keys=[self.key], args=[int(time.time()), self.batch_size], client=get_redis())
+        return [int(_id) for _id in ids]
+
+    def run(self) -> int:
+        redis = get_redis()
+        if self.sweep_func and redis.set(self.swept_key, 1, nx=True, ex=self.sweep_interval):
+            self.sweep()
+        num = 0
+        for _ in range(self.max_batches):
+            ids = self.pop_due()
+            if not ids:
+                break
+            start = time.time()
+            try:
+                num += self.handler(ids) or 0
+            except Exception as e:
+                log.error('due work {} error: {}, {}'.format(self.kind, ids, e))
+                # 期间重新登记过的以新的到期时间为准
+                redis.zadd(self.key, {_id: time.time() + self.retry_delay for _id in ids}, nx=True)
+                redis.hincrby(self.stats_key, 'error', len(ids))
+                break
+            with redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(self.stats_key, 'count', len(ids))
+                pipe.hset(self.stats_key, 'last_cost', round(time.time() - start, 3))
+                pipe.hset(self.stats_key, 'last_at', int(time.time()))
+                pipe.execute()
+        if num:
+            log.info('due work {}: {}'.format(self.kind, num))
+        return num
+
+    def sweep(self) -> int:
+        try:
+            items = list(self.sweep_func())
+        except Exception as e:
+            log.error('due work {} sweep error: {}'.format(self.kind, e))
+            return 0
+        self.register_many(items)
+        return len(items)
+
+    def metrics(self) -> dict:
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.zcard(self.key)
+            pipe.zcount(self.key, '-inf', time.time())
+            pipe.hgetall(self.stats_key)
+            total, due, stats = pipe.execute()
+        return dict(kind=self.kind, pending=total, due=due, count=int(stats.get('count') or 0),
+                    error=int(stats.get('error') or 0), last_cost=float(stats.get('last_cost') or 0))
+
+
+def get_due_work(kind: str) -> DueWork:
+    return _works[kind]
+
+
+def due_work_metrics() -> list:
+    return [work.metrics() for work in _works.values()]
@@ -0,0 +1,183 @@
+# coding: utf-8
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from caches import get_redis_name, get_redis, get_pika_redis, redis_show_type_copy_key, redis_venues_copy_key, \
+    redis_show_content_copy_key, redis_shows_no_key, redis_session_no_key
+
+log = logging.getLogger(__name__)
+
+"""
+pika一级缓存(进程内):
+演出类型、场馆、分类、项目编号、场次编号这些hash几乎每个请求都会读,但很少修改.
+每个进程在内存里缓存一份(有数量上限和过期时间),写pika的 *_copy_to_pika 方法通过redis发布失效消息,各进程收到后删除本地缓存.
+配置(env.yml, 可选):
+l1_cache:
+  max_size: 2000  # 每个hash最多缓存的字段数
+  ttl: 60  # 过期时间(s), 失效消息丢失时兜底
+  disable:  # 关闭的缓存, 直接读pika
+    - redis_venues_copy_key
+"""
+l1_invalidate_channel = get_redis_name('l1_cache_invalidate')
+# 缓存名称 -> pika hash key
+FAMILIES = OrderedDict([
+    ('redis_show_type_copy_key', redis_show_type_copy_key),
+    ('redis_venues_copy_key', redis_venues_copy_key),
+    ('redis_show_content_copy_key', redis_show_content_copy_key),
+    ('redis_shows_no_key', redis_shows_no_key),
+    ('redis_session_no_key', redis_session_no_key),
+])
+
+
+class L1HashCache:
+    def __init__(self, family: str, key: str, max_size: int = 2000, ttl: int = 60, enabled: bool = True):
+        self.family = family
+        self.key = key
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # 每次失效加1, 读pika期间发生失效则不写入本地缓存, 避免缓存旧值
+        self._gen = 0
+
+    def _get(self, field: str):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(field)
+            if item and item[0] > now:
+                self._data.move_to_end(field)
+                self.hits += 1
+                return item
+            self.misses += 1
+            gen = self._gen
+        raw = get_pika_redis().hget(self.key, field)
+        item = [now + self.ttl, raw, None]
+        with self._lock:
+            if gen != self._gen:
+                return item
+            self._data[field] = item
+            self._data.move_to_end(field)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return item
+
+    def hget(self, field):
+        if not self.enabled:
+            return get_pika_redis().hget(self.key, field)
+        return self._get(str(field))[1]
+
+    def hget_json(self, field):
+        """
+        返回解析后的对象, 进程内共享, 调用方不要修改返回值(需要修改时先复制)
+        """
+        if not self.enabled:
+            raw = get_pika_redis().hget(self.key, field)
+            return json.loads(raw) if raw else None
+        item = self._get(str(field))
+        if item[1] and item[2] is None:
+            item[2] = json.loads(item[1])
+        return item[2]
+
+    def invalidate(self, field=None):
+        with self._lock:
+            self._gen += 1
+            if field is None:
+                self._data.clear()
+            else:
+                self._data.pop(str(field), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return dict(family=self.family, enabled=self.enabled, size=len(self._data), hits=self.hits,
+                    misses=self.misses, hit_rate=round(self.hits / total, 4) if total else 0)
+
+
+_caches = dict()
+_init_lock = threading.Lock()
+_listener_pid = None
+_listener_retry_at = 0
+
+
+def _init_caches():
+    from common.config import get_config
+    conf = get_config().get('l1_cache') or dict()
+    disable = conf.get('disable') or []
+    for family, key in FAMILIES.items():
+        _caches[key] = L1HashCache(family, key, max_size=conf.get('max_size', 2000), ttl=conf.get('ttl', 60),
+                                   enabled=family not in disable)
+
+
+def _on_message(message):
+    try:
+        key, field = json.loads(message['data'])
+        cache = _caches.get(key)
+        if cache:
+            cache.invalidate(field)
+    except Exception as e:
+        log.error('l1 cache invalidate error: {}'.format(e))
+
+
+def _ensure_listener():
+    """
+    每个进程(fork之后pid变化)启动一个订阅失效消息的后台线程
+    """
+    global _listener_pid, _listener_retry_at
+    pid = os.getpid()
+    if _listener_pid == pid or time.time() < _listener_retry_at:
+        return
+    with _init_lock:
+        if _listener_pid == pid:
+            return
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{l1_invalidate_channel: _on_message})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+            _listener_pid = pid
+            # fork前的本地缓存可能已错过失效消息
+            for cache in _caches.values():
+                cache.invalidate()
+        except Exception as e:
+            # 订阅失败时依赖过期时间兜底, 稍后重试
+            _listener_retry_at = time.time() + 30
+            log.error('l1 cache subscribe error: {}'.format(e))
+
+
+def get_l1_cache(key: str) -> L1HashCache:
+    if not _caches:
+        with _init_lock:
+            if not _caches:
+                _init_caches()
+    _ensure_listener()
+    return _caches[key]
+
+
+def l1_hget(key: str, field):
+    return get_l1_cache(key).hget(field)
+
+
+def l1_hget_json(key: str, field):
+    return get_l1_cache(key).hget_json(field)
+
+
+def l1_invalidate(key: str, field=None):
+    """
+    pika写入后调用, 通知所有进程删除本地缓存, field为None时清空整个hash的缓存
+    """
+    cache = _caches.get(key)
+    if cache:
+        cache.invalidate(field)
+    try:
+        get_redis().publish(l1_invalidate_channel, json.dumps([key, str(field) if field is not None else None]))
+    except Exception as e:
+        log.error('l1 cache publish error: {}'.format(e))
+
+
+def l1_stats() -> list:
+    return [cache.stats() for cache in _caches.values()]
@@ -0,0 +1,28 @@
+# coding: utf-8
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+"""
+测试用的redis: 主redis、pika、库存缓存(concu, db3)和django缓存全部换成进程内的fakeredis/locmem,
+lua脚本由fakeredis[lua]执行, 不需要真实的redis服务
+"""
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FakeRedisTestCase(TestCase):
+    def setUp(self):
+        import fakeredis
+        import caches
+        import concu
+        from django.core.cache import cache
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+        self.stock_redis = fakeredis.FakeStrictRedis(server=server, db=3, decode_responses=True)
+        self.pika = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        for patcher in [mock.patch.object(caches, '_redis', self.redis), mock.patch.object(caches, '_pika', self.pika),
+                        mock.patch.object(concu, '_redis_provider', lambda: self.stock_redis)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
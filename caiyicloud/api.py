@@ -14,7 +14,11 @@ from caiyicloud.error_codes import CaiYiCloudClientException, create_exception_f
 from common.utils import get_config
 from typing import List, Dict
 from requests import Response
+from requests.adapters import HTTPAdapter
 import uuid
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from caiyicloud.sign_utils import do_check, deal_params, sign_top_request
 
@@ -23,6 +27,48 @@ config = get_config()
 cy_config = config.get('cy')
 LOG_DEBUG = cy_config.get('log_debug') if config else True
 HOST_DEBUG = cy_config.get('host_debug') if config else False
+"""
+连接复用: 所有请求共用一个requests.Session(keep-alive), 连接池大小pool_size
+超时: 按接口前缀取(连接, 读取)超时, 没有匹配的用DEFAULT_TIMEOUT
+重试: 连接失败、超时、5xx时GET请求最多重试retries次(间隔0.5, 1, 2秒...), POST不重试避免重复下单
+分页: fetch_pages先取第1页得到总数, 其余页最多page_workers个并发拉取
+cy:
+  pool_size: 20
+  page_workers: 4
+  retries: 2
+"""
+POOL_SIZE = cy_config.get('pool_size', 20)
+PAGE_WORKERS = cy_config.get('page_workers', 4)
+RETRIES = cy_config.get('retries', 2)
+DEFAULT_TIMEOUT = (3, 15)
+ENDPOINT_TIMEOUTS = [
+    ('api/event/v1/inventories', (3, 5)),
+    ('api/event/v1/', (3, 10)),
+    ('api/venue/', (3, 10)),
+    ('api/order/', (3, 20)),
+]
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    global _session
+    if not _session:
+        with _session_lock:
+            if not _session:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def get_timeout(endpoint: str):
+    for prefix, timeout in ENDPOINT_TIMEOUTS:
+        if endpoint.startswith(prefix):
+            return timeout
+    return DEFAULT_TIMEOUT
 
 
 def random_string(length=16):
@@ -48,10 +94,22 @@ class CaiYiCloudAbstract(object):
             body = json.dumps(kwargs['data'], ensure_ascii=False)
             body = body.encode('utf-8')
             kwargs['data'] = body
-        if method == 'post':
-            res = requests.post(url, params=params, json=data, headers=headers)
-        else:
-            res = requests.get(url, params=params, headers=headers)
+        session = get_http_session()
+        timeout = get_timeout(url_or_endpoint)
+        retries = RETRIES if method == 'get' else 0
+        for i in range(retries + 1):
+            try:
+                if method == 'post':
+                    res = session.post(url, params=params, json=data, headers=headers, timeout=timeout)
+                else:
+                    res = session.get(url, params=params, headers=headers, timeout=timeout)
+                if res.status_code < 500 or i == retries:
+                    break
+            except (requests.ConnectionError, requests.Timeout):
+                if i == retries:
+                    raise
+            logger.warning('cy retry {}: {}'.format(i + 1, url_or_endpoint))
+            time.sleep(0.5 * 2 ** i)
         try:
             res.raise_for_status()
         except requests.RequestException as reqe:
@@ -213,6 +271,21 @@ class CaiYiCloud(CaiYiCloudAbstract):
         self.parse_resp(ret)
         return ret['data']
 
+    def fetch_pages(self, func, page_size: int = 50, max_page: int = 50, **kwargs) -> list:
+        """
+        拉取分页接口的全部数据(最多max_page页), 第1页之后的页并发拉取, 按页码顺序返回
+        func: get_events, sessions_list等有page, page_size参数的接口
+        """
+        data = func(page=1, page_size=page_size, **kwargs)
+        result = data.get('list') or []
+        pages = min(-(-data['total'] // page_size), max_page)
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix='cy_pages') as executor:
+                for page_data in executor.map(lambda page: func(page=page, page_size=page_size, **kwargs),
+                                              range(2, pages + 1)):
+                    result += page_data.get('list') or []
+        return result
+
     def event_detail(self, event_id: str, auth_type=0):
         """
         该接口用于获取已授权的节目详细信息
@@ -226,7 +299,7 @@ class CaiYiCloud(CaiYiCloudAbstract):
         data = ret['data']
         if data.get('content_url'):
             try:
-                res = requests.get(data.get('content_url'))
+                res = get_http_session().get(data.get('content_url'), timeout=DEFAULT_TIMEOUT)
                 if res.status_code == 200:
                     data['content'] = res.content.decode('utf-8', 'ignore')
             except Exception as e:
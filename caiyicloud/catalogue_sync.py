@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import time
+
+from caches import get_redis, get_redis_name
+
+log = logging.getLogger(__name__)
+"""
+彩艺云节目增量同步(CyShowEvent.init_cy_show):
+上游每个节目详情、场次、票档(含库存)的内容hash存在redis快照里(event/session/ticket各一个hash),
+拉取时与快照比较, 只有内容变化或本地没有记录的才调用update_or_create_record写库和pika,
+没有变化的节目不再改写节目、场次、票档, 也不再重新上传缓存.
+场次的hash带上所属节目的hash, 节目变化时(座位类型、场馆等)场次跟着更新.
+快照在记录写入成功后才更新, 写入失败的下次拉取重试; 回调更新不改快照, 下次拉取最多多更新一次.
+"""
+
+
+def content_hash(data) -> str:
+    return hashlib.md5(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+class SnapshotStore(object):
+    def __init__(self, kind: str):
+        self.key = get_redis_name('cy_snapshot_{}'.format(kind))
+
+    def get_many(self, ids: list) -> dict:
+        if not ids:
+            return dict()
+        return dict(zip(ids, get_redis().hmget(self.key, ids)))
+
+    def set_many(self, hashes: dict):
+        if hashes:
+            get_redis().hmset(self.key, hashes)
+
+    def clear(self):
+        get_redis().delete(self.key)
+
+
+class CatalogueSync(object):
+    def __init__(self, log_title: str, force: bool = False):
+        from caiyicloud.api import caiyi_cloud
+        self.cy = caiyi_cloud()
+        self.log_title = log_title
+        self.force = force
+        self.events = SnapshotStore('event')
+        self.sessions = SnapshotStore('session')
+        self.tickets = SnapshotStore('ticket')
+        self.stats = dict(event=0, session=0, ticket=0, off=0, error=0)
+
+    def changed(self, old_hash, new_hash, exists: bool) -> bool:
+        return self.force or not exists or old_hash != new_hash
+
+    def run(self, is_new: bool = False) -> dict:
+        from caiyicloud.models import CyShowEvent
+        start = time.time()
+        event_ids = [event['id'] for event in self.cy.fetch_pages(self.cy.get_events)]
+        exists = set(CyShowEvent.objects.filter(event_id__in=event_ids).values_list('event_id', flat=True))
+        if is_new:
+            event_ids = [event_id for event_id in event_ids if event_id not in exists]
+        old_hashes = self.events.get_many(event_ids)
+        for event_id in event_ids:
+            try:
+                self.sync_event(event_id, old_hashes.get(event_id), event_id in exists)
+            except Exception as e:
+                self.stats['error'] += 1
+                log.error('cy sync event error: {}, {}'.format(event_id, e))
+        self.stats.update(events=len(event_ids), cost=round(time.time() - start, 3))
+        log.info('cy catalogue sync: {}'.format(self.stats))
+        return self.stats
+
+    def sync_event(self, event_id: str, old_hash, exists: bool):
+        from caiyicloud.models import CyShowEvent
+        event_detail = self.cy.event_detail(event_id)
+        event_hash = content_hash(event_detail)
+        event_changed = self.changed(old_hash, event_hash, exists)
+        if event_changed:
+            cy_show = CyShowEvent.update_or_create_record(event_id, self.log_title, event_detail=event_detail)
+            self.events.set_many({event_id: event_hash})
+            self.stats['event'] += 1
+        else:
+            cy_show = CyShowEvent.objects.filter(event_id=event_id).first()
+        self.sync_sessions(cy_show, event_hash)
+
+    def sync_sessions(self, cy_show, event_hash: str):
+        from caiyicloud.models import CySession, CyTicketType
+        session_list = self.cy.fetch_pages(self.cy.sessions_list, event_id=cy_show.event_id)
+        # 场次类型,0:普通场次;1:联票场次 只做普通场次
+        session_list = [api_data for api_data in session_list if api_data['session_type'] == 0]
+        cy_on_list = [api_data['id'] for api_data in session_list]
+        exists = set(CySession.objects.filter(cy_no__in=cy_on_list).values_list('cy_no', flat=True))
+        session_hashes = self.sessions.get_many(cy_on_list)
+        ticket_hashes = self.tickets.get_many(cy_on_list)
+        for api_data in session_list:
+            cy_no = api_data['id']
+            session_hash = content_hash([event_hash, api_data])
+            session_changed = self.changed(session_hashes.get(cy_no), session_hash, cy_no in exists)
+            if session_changed:
+                CySession.update_or_create_record(cy_show, api_data, self.log_title)
+                self.sessions.set_many({cy_no: session_hash})
+                self.stats['session'] += 1
+            ticket_types_list = self.cy.ticket_types([cy_no])
+            ticket_stock_list = self.cy.ticket_stock([cy_no])
+            ticket_hash = content_hash([ticket_types_list, ticket_stock_list])
+            if self.changed(ticket_hashes.get(cy_no), ticket_hash, cy_no in exists):
+                CyTicketType.update_or_create_record(cy_no, ticket_types_list=ticket_types_list,
+                                                     ticket_stock_list=ticket_stock_list)
+                self.tickets.set_many({cy_no: ticket_hash})
+                self.stats['ticket'] += 1
+        if cy_on_list:
+            # 已删除的下架, 已经下架的不再重复处理
+            qs = CySession.objects.filter(event_id=cy_show.id).exclude(cy_no__in=cy_on_list).exclude(state=7)
+            for cy_session in qs:
+                cy_session.set_off()
+                self.stats['off'] += 1
@@ -0,0 +1,104 @@
+# coding: utf-8
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+def make_handler(events: int, sessions: int, latency: float, handshake: float):
+    class StubHandler(BaseHTTPRequestHandler):
+        # keep-alive, 新连接先等待handshake秒模拟TLS握手
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            time.sleep(handshake)
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('page_size', ['50'])[0])
+            if url.path.endswith('/sessions'):
+                event_id = url.path.split('/')[-2]
+                total = sessions
+                items = [dict(id='{}_{}'.format(event_id, i), session_type=0) for i in
+                         range((page - 1) * page_size, min(page * page_size, total))]
+            else:
+                total = events
+                items = [dict(id='event{}'.format(i)) for i in range((page - 1) * page_size, min(page * page_size, total))]
+            time.sleep(latency)
+            body = json.dumps(dict(code='000000', message='success', trace_id='stub',
+                                   data=dict(total=total, list=items))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    help = 'benchmark a full caiyicloud catalogue pull (events + sessions) against a local stub server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=300, help='节目数')
+        parser.add_argument('--sessions', type=int, default=60, help='每个节目的场次数')
+        parser.add_argument('--latency', type=float, default=0.05, help='接口响应延迟(秒)')
+        parser.add_argument('--handshake', type=float, default=0.03, help='新建连接的延迟(秒)')
+
+    def legacy_pull(self, base_url: str):
+        # 原来的方式: 每次请求新建连接, 逐页拉取
+        def pages(path, **params):
+            page = 1
+            data = requests.get(base_url + path, params=dict(params, page=page, page_size=50)).json()['data']
+            result = data['list']
+            while data['total'] > page * 50 and page < 50:
+                page += 1
+                result += requests.get(base_url + path, params=dict(params, page=page, page_size=50)).json()['data'][
+                    'list']
+            return result
+
+        events = pages('api/event/v1/events')
+        return events, sum([len(pages('api/event/v1/events/{}/sessions'.format(e['id']))) for e in events])
+
+    def pooled_pull(self, base_url: str):
+        from caiyicloud.api import CaiYiCloud
+
+        class StubCaiYiCloud(CaiYiCloud):
+            API_BASE_URL = API_BASE_URL_TEST = base_url
+
+            def __init__(self):
+                self.is_init = True
+                self.app_id = 'stub'
+                self.supplier_id = 'stub'
+
+            def get_sign(self, params):
+                return 'stub'
+
+        cy = StubCaiYiCloud()
+        events = cy.fetch_pages(cy.get_events)
+        return events, sum([len(cy.fetch_pages(cy.sessions_list, event_id=e['id'])) for e in events])
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(options['events'], options['sessions'],
+                                                                      options['latency'], options['handshake']))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        try:
+            for name, func in [('legacy', self.legacy_pull), ('pooled', self.pooled_pull)]:
+                start = time.time()
+                events, sessions = func(base_url)
+                self.stdout.write('{}: events {}, sessions {}, cost {:.2f}s'.format(name, len(events), sessions,
+                                                                                   time.time() - start))
+        finally:
+            server.shutdown()
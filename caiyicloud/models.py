@@ -340,30 +340,18 @@ class CyShowEvent(models.Model):
         return get_redis_name('cyiniteventkey')
 
     @classmethod
-    def init_cy_show(cls, log_title=None, is_new=False):
+    def init_cy_show(cls, log_title=None, is_new=False, force=False):
+        """
+        拉取全部节目, 只更新上游有变化的节目、场次、票档, 见caiyicloud.catalogue_sync
+        force: 忽略快照全部更新
+        """
         cy = caiyi_cloud()
         if not cy.is_init:
             return
-            # try:
-        page = 1
-        page_size = 50
-        event_data = cy.get_events(page=page, page_size=page_size)
-        total = event_data['total']
-        event_list = event_data.get('list') or []
-        while total > page * page_size and page < 50:
-            page += 1
-            event_data = cy.get_events(page=page, page_size=page_size)
-            if event_data.get('list'):
-                event_list += event_data['list']
         if not log_title:
             log_title = '初始化拉取'
-        for event in event_list:
-            has_event = False
-            if is_new:
-                has_event = cls.objects.filter(event_id=event['id']).exists()
-            if not has_event:
-                cls.update_or_create_record(event['id'], log_title)
-                CySession.init_cy_session(event['id'], log_title)
+        from caiyicloud.catalogue_sync import CatalogueSync
+        return CatalogueSync(log_title, force=force).run(is_new=is_new)
         # redis = get_pika_redis()
         # key = cls.init_event_pika_key()
         # has_change_event_list = redis.lrange(key, 0, -1) or []
@@ -474,11 +462,15 @@ class CyShowEvent(models.Model):
 
     @classmethod
     @atomic
-    def update_or_create_record(cls, event_id: str, log_title: str):
+    def update_or_create_record(cls, event_id: str, log_title: str, event_detail: dict = None):
+        """
+        event_detail: 已经查询过的节目详情, 不再重复请求
+        """
         cy = caiyi_cloud()
         if not cy.is_init:
             return
-        event_detail = cy.event_detail(event_id)
+        if not event_detail:
+            event_detail = cy.event_detail(event_id)
         cy_show_type, show_second_cate = CyCategory.get_show_second_cate(event_detail['category'], event_detail['type'],
                                                                          event_detail['type_desc'])
         show_type = show_second_cate.show_type
@@ -745,45 +737,17 @@ class CySession(models.Model):
 
     @classmethod
     def sync_stock_save_to_pika(cls, event_id: str, seat_change_vo_list: list):
-        name = cls.sync_stock_key()
-        session_dict = dict()
-        with get_pika_redis() as redis:
-            for seat in seat_change_vo_list:
-                lock_key = get_redis_name('cy_sync_stock_sn_{}'.format(seat['session_id']))
-                if redis.setnx(lock_key, 1):
-                    # 同一场次3分钟内更新库存一次
-                    try:
-                        redis.expire(lock_key, 180)
-                        cy_session = session_dict.get(seat['session_id'])
-                        if not cy_session:
-                            cy_session = CySession.objects.filter(cy_no=seat['session_id']).first()
-                            if cy_session:
-                                session_dict[seat['session_id']] = cy_session
-                        # 无座才要
-                        if cy_session and cy_session.event.seat_type == CyShowEvent.SEAT_NO:
-                            if not redis.hget(name, seat['session_id']):
-                                redis.hset(name, seat['session_id'], event_id)
-                    except Exception as e:
-                        redis.delete(lock_key)
+        """
+        库存变更通知, 同一场次3分钟内登记一次, 见caiyicloud.stock_sync
+        """
+        from caiyicloud.stock_sync import save_notify
+        save_notify(event_id, seat_change_vo_list)
         return True, None
 
     @classmethod
     def cy_update_stock_task(cls):
-        name = cls.sync_stock_key()
-        cy = caiyi_cloud()
-        with get_pika_redis() as redis:
-            session_no_list = redis.hkeys(name)
-            if session_no_list:
-                for cy_no in session_no_list:
-                    try:
-                        ticket_stock_list = cy.ticket_stock([cy_no])
-                        for tf in ticket_stock_list:
-                            ct = CyTicketType.objects.filter(cy_no=tf['ticket_type_id'],
-                                                             cy_session__cy_no=cy_no).first()
-                            if ct:
-                                ct.change_stock(tf['inventory'])
-                    finally:
-                        redis.hdel(name, cy_no)
+        from caiyicloud.stock_sync import CyStockSync
+        return CyStockSync().run()
 
     @classmethod
     def init_cy_session(cls, event_id: str, log_title: str):
@@ -791,16 +755,7 @@ class CySession(models.Model):
         cy_show = CyShowEvent.objects.filter(event_id=event_id).first()
         if not cy_show:
             cy_show = CyShowEvent.update_or_create_record(event_id, log_title)
-        sessions_data = cy.sessions_list(event_id=event_id)
-        page = 1
-        page_size = 50
-        total = sessions_data['total']
-        session_list = sessions_data.get('list') or []
-        while total > page * page_size and page < 50:
-            page += 1
-            sessions_data = cy.sessions_list(event_id=event_id, page=page, page_size=page_size)
-            if sessions_data.get('list'):
-                session_list += sessions_data['list']
+        session_list = cy.fetch_pages(cy.sessions_list, event_id=event_id)
         # redis = get_pika_redis()
         # key = get_redis_name('cyinitsessionkey')
         # has_change_session_list = redis.lrange(key, 0, -1) or []
@@ -1128,7 +1083,11 @@ class CyTicketType(models.Model):
 
     @classmethod
     @atomic
-    def update_or_create_record(cls, cy_session_id: str):
+    def update_or_create_record(cls, cy_session_id: str, ticket_types_list: list = None,
+                                ticket_stock_list: list = None):
+        """
+        ticket_types_list, ticket_stock_list: 已经查询过的票档和库存, 不再重复请求
+        """
         cy = caiyi_cloud()
         if not cy.is_init:
             return
@@ -1136,8 +1095,10 @@ class CyTicketType(models.Model):
         tf_ids = []
         tf_list = []
         if cy_session:
-            ticket_types_list = cy.ticket_types([cy_session_id])
-            ticket_stock_list = cy.ticket_stock([cy_session_id])
+            if ticket_types_list is None:
+                ticket_types_list = cy.ticket_types([cy_session_id])
+            if ticket_stock_list is None:
+                ticket_stock_list = cy.ticket_stock([cy_session_id])
             ticket_stock_dict = dict()
             show_price = 0
             qs = TicketColor.objects.all()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from collections import defaultdict
+
+from django.db.models import Case, When, Value, IntegerField
+from django.utils import timezone
+
+from caches import get_pika_redis, get_redis_name
+
+log = logging.getLogger(__name__)
+"""
+彩艺云库存同步:
+1. 库存变更通知(sync_stock_save_to_pika): 同一场次3分钟内只登记一次, 一个pipeline里 SET NX EX + HSETNX,
+   不查数据库, 座位类型等到定时任务里一次查询过滤
+2. 定时任务(cy_update_stock_task): 取出登记的场次, 有座的丢掉, 按节目分组每20个场次查一次库存(不允许跨节目查询),
+   票档一次查询, 和change_stock/reset_stock一样以上游库存为准: 有变化的CyTicketType、TicketFile各一条UPDATE,
+   无座票档的库存缓存一个pipeline覆盖
+"""
+# 每次查询库存的场次数
+STOCK_QUERY_SIZE = 20
+# 同一场次的通知间隔
+NOTIFY_INTERVAL = 180
+
+
+def notify_lock_key(cy_no: str):
+    return get_redis_name('cy_sync_stock_sn_{}'.format(cy_no))
+
+
+def save_notify(event_id: str, seat_change_vo_list: list) -> int:
+    """
+    登记需要同步库存的场次, 返回新登记的数量
+    """
+    session_nos = list(set([seat['session_id'] for seat in seat_change_vo_list]))
+    if not session_nos:
+        return 0
+    from caiyicloud.models import CySession
+    name = CySession.sync_stock_key()
+    with get_pika_redis() as redis:
+        with redis.pipeline(transaction=False) as pipe:
+            for cy_no in session_nos:
+                pipe.set(notify_lock_key(cy_no), 1, nx=True, ex=NOTIFY_INTERVAL)
+            locked = pipe.execute()
+            session_nos = [cy_no for cy_no, ok in zip(session_nos, locked) if ok]
+            for cy_no in session_nos:
+                pipe.hsetnx(name, cy_no, event_id)
+            pipe.execute()
+    return len(session_nos)
+
+
+class CyStockSync(object):
+    def __init__(self):
+        from caiyicloud.api import caiyi_cloud
+        self.cy = caiyi_cloud()
+        self.stats = dict(sessions=0, queries=0, changed=0, reset=0)
+
+    def query_stock(self, session_nos: list) -> list:
+        """
+        同一节目的场次, 每STOCK_QUERY_SIZE个查询一次, 返回 [(票档, 库存)]
+        """
+        items = []
+        for i in range(0, len(session_nos), STOCK_QUERY_SIZE):
+            self.stats['queries'] += 1
+            for stock in self.cy.ticket_stock(session_nos[i:i + STOCK_QUERY_SIZE]):
+                items.append((stock['ticket_type_id'], int(stock['inventory'])))
+        return items
+
+    def apply(self, session_nos, items: list):
+        """
+        items: [(票档, 库存)]
+        和CyTicketType.change_stock -> TicketFile.reset_stock一样以上游库存为准重置, 只是批量执行:
+        CyTicketType、TicketFile各一条UPDATE, 无座票档的库存缓存一个pipeline写入
+        """
+        from caiyicloud.models import CyTicketType
+        from ticket.models import TicketFile, SessionInfo
+        from ticket.stock_updater import tfc
+        from concu import get_redis as get_stock_redis
+        inventories = dict(items)
+        if not inventories:
+            return
+        rows = list(CyTicketType.objects.filter(cy_no__in=inventories.keys(), cy_session__cy_no__in=session_nos)
+                    .values_list('id', 'cy_no', 'stock', 'ticket_file_id', 'ticket_file__stock',
+                                 'ticket_file__session__has_seat'))
+        changed = [(_id, inventories[cy_no]) for _id, cy_no, stock, _, _, _ in rows if stock != inventories[cy_no]]
+        if changed:
+            CyTicketType.objects.filter(id__in=[_id for _id, _ in changed]).update(
+                stock=Case(*[When(id=_id, then=Value(stock)) for _id, stock in changed], output_field=IntegerField()),
+                updated_at=timezone.now())
+            self.stats['changed'] += len(changed)
+        tf_changed = [(tf_id, inventories[cy_no]) for _, cy_no, _, tf_id, tf_stock, _ in rows
+                      if tf_id and tf_stock != inventories[cy_no]]
+        if tf_changed:
+            TicketFile.objects.filter(id__in=[tf_id for tf_id, _ in tf_changed]).update(
+                stock=Case(*[When(id=tf_id, then=Value(stock)) for tf_id, stock in tf_changed],
+                           output_field=IntegerField()))
+        # 和TicketFile.redis_stock一样只有无座的有库存缓存, 上游库存每次都覆盖缓存
+        reset = [(tf_id, inventories[cy_no]) for _, cy_no, _, tf_id, _, has_seat in rows
+                 if tf_id and has_seat == SessionInfo.SEAT_NO]
+        if reset:
+            with get_stock_redis().pipeline(transaction=False) as pipe:
+                for tf_id, stock in reset:
+                    pipe.set(tfc.cache_key(tf_id), stock)
+                pipe.execute()
+            self.stats['reset'] += len(reset)
+
+    def run(self) -> dict:
+        from caiyicloud.models import CySession, CyShowEvent
+        name = CySession.sync_stock_key()
+        start = time.time()
+        with get_pika_redis() as redis:
+            notify = redis.hgetall(name)
+            if not notify:
+                return self.stats
+            try:
+                # 无座才要
+                session_nos = set(CySession.objects.filter(cy_no__in=notify.keys(),
+                                                           event__seat_type=CyShowEvent.SEAT_NO).values_list('cy_no',
+                                                                                                            flat=True))
+                events = defaultdict(list)
+                for cy_no, event_id in notify.items():
+                    if cy_no in session_nos:
+                        events[event_id].append(cy_no)
+                items = []
+                for event_id, nos in events.items():
+                    try:
+                        items += self.query_stock(nos)
+                    except Exception as e:
+                        log.error('cy ticket stock error: {}, {}'.format(event_id, e))
+                self.apply(session_nos, items)
+                self.stats.update(sessions=len(session_nos), cost=round(time.time() - start, 3))
+            finally:
+                redis.hdel(name, *notify.keys())
+        log.info('cy stock sync: {}'.format(self.stats))
+        return self.stats
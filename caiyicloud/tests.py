@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import requests
+
+from caches.testing import FakeRedisTestCase
+
+
+def response(status_code: int, content: bytes = b'{"code": 0}'):
+    res = mock.Mock(status_code=status_code, content=content)
+    if status_code >= 400:
+        res.raise_for_status.side_effect = requests.HTTPError(request=None, response=res)
+    return res
+
+
+class CaiYiCloudClientTest(FakeRedisTestCase):
+    def setUp(self):
+        super(CaiYiCloudClientTest, self).setUp()
+        self.session = mock.Mock()
+        for patcher in [mock.patch('caiyicloud.api.get_http_session', return_value=self.session),
+                        mock.patch('caiyicloud.api.time.sleep')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_retry(self):
+        from caiyicloud.api import CaiYiCloudAbstract, RETRIES
+        from caiyicloud.error_codes import CaiYiCloudClientException
+        self.session.get.side_effect = [requests.ConnectionError(), response(502)] + [response(200)] * RETRIES
+        self.assertEqual(CaiYiCloudAbstract()._request('get', 'api/event/v1/events'), dict(code=0))
+        self.assertEqual(self.session.get.call_count, 3)
+        self.assertEqual(self.session.get.call_args[1]['timeout'], (3, 10))
+        # 超过重试次数返回最后一次的错误
+        self.session.get.reset_mock()
+        self.session.get.side_effect = None
+        self.session.get.return_value = response(503)
+        with self.assertRaises(CaiYiCloudClientException):
+            CaiYiCloudAbstract()._request('get', 'api/event/v1/inventories')
+        self.assertEqual(self.session.get.call_count, RETRIES + 1)
+
+    def test_post_not_retried(self):
+        from caiyicloud.api import CaiYiCloudAbstract
+        self.session.post.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            CaiYiCloudAbstract()._request('post', 'api/order/v1/create', data=dict(a=1))
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.session.post.call_args[1]['timeout'], (3, 20))
+
+    def test_fetch_pages(self):
+        from caiyicloud.api import CaiYiCloud
+
+        def get_events(page, page_size, event_id=None):
+            start = (page - 1) * page_size
+            return dict(total=7, list=[(event_id, i) for i in range(start, min(start + page_size, 7))])
+
+        func = mock.Mock(side_effect=get_events)
+        self.assertEqual(CaiYiCloud().fetch_pages(func, page_size=2, event_id='e1'), [('e1', i) for i in range(7)])
+        self.assertEqual(sorted([call[1]['page'] for call in func.call_args_list]), [1, 2, 3, 4])
+        func.reset_mock()
+        self.assertEqual(len(CaiYiCloud().fetch_pages(func, page_size=2, max_page=2)), 4)
+        self.assertEqual(func.call_count, 2)
+
+
+class CatalogueSyncTest(FakeRedisTestCase):
+    def setUp(self):
+        super(CatalogueSyncTest, self).setUp()
+        from caiyicloud.models import CyShowEvent, CySession, CyTicketType
+        self.events = dict(e1=dict(id='e1', name='节目1'), e2=dict(id='e2', name='节目2'))
+        self.sessions = dict(e1=[dict(id='s1', session_type=0), dict(id='s2', session_type=0),
+                                 dict(id='s3', session_type=1)], e2=[dict(id='s4', session_type=0)])
+        self.stocks = dict(s1=10, s2=10, s4=10)
+        cy = mock.Mock()
+        cy.fetch_pages.side_effect = lambda func, **kwargs: func(**kwargs)
+        cy.get_events.side_effect = lambda: list(self.events.values())
+        cy.sessions_list.side_effect = lambda event_id: self.sessions[event_id]
+        cy.event_detail.side_effect = lambda event_id: self.events[event_id]
+        cy.ticket_types.side_effect = lambda ids: [dict(id='t_{}'.format(ids[0]))]
+        cy.ticket_stock.side_effect = lambda ids: [dict(id='t_{}'.format(ids[0]), qty=self.stocks[ids[0]])]
+
+        def create_event(event_id, log_title, event_detail=None):
+            return CyShowEvent.objects.update_or_create(event_id=event_id, defaults=dict(std_id=event_id,
+                                                                                          expire_order_minute=15))[0]
+
+        def create_session(cy_show, api_data, log_title):
+            now = datetime.now()
+            return CySession.objects.update_or_create(cy_no=api_data['id'], defaults=dict(
+                event=cy_show, std_id=api_data['id'], start_time=now, end_time=now, name=api_data['id']))[0]
+
+        self.create_event = mock.Mock(side_effect=create_event)
+        self.create_session = mock.Mock(side_effect=create_session)
+        self.create_ticket = mock.Mock()
+        self.set_off = mock.Mock()
+        for patcher in [mock.patch('caiyicloud.api.caiyi_cloud', return_value=cy),
+                        mock.patch.object(CyShowEvent, 'update_or_create_record', self.create_event),
+                        mock.patch.object(CySession, 'update_or_create_record', self.create_session),
+                        mock.patch.object(CyTicketType, 'update_or_create_record', self.create_ticket),
+                        mock.patch.object(CySession, 'set_off', self.set_off)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sync(self, **kwargs) -> tuple:
+        from caiyicloud.catalogue_sync import CatalogueSync
+        ret = CatalogueSync('测试', **kwargs).run()
+        return ret['event'], ret['session'], ret['ticket'], ret['off'], ret['error']
+
+    def test_only_changed(self):
+        self.assertEqual(self.sync(), (2, 3, 3, 0, 0))
+        # 上游没有变化不写库
+        self.assertEqual(self.sync(), (0, 0, 0, 0, 0))
+        self.stocks['s2'] = 5
+        self.assertEqual(self.sync(), (0, 0, 1, 0, 0))
+        self.assertEqual(self.create_ticket.call_args[0][0], 's2')
+        # 节目变化时场次跟着更新
+        self.events['e1']['name'] = '节目1修改'
+        self.assertEqual(self.sync(), (1, 2, 0, 0, 0))
+        self.assertEqual(self.sync(force=True), (2, 3, 3, 0, 0))
+
+    def test_off_and_error(self):
+        create_event = self.create_event.side_effect
+
+        def fail_e2(event_id, *args, **kwargs):
+            if event_id == 'e2':
+                raise ValueError(event_id)
+            return create_event(event_id, *args, **kwargs)
+
+        self.create_event.side_effect = fail_e2
+        self.assertEqual(self.sync(), (1, 2, 2, 0, 1))
+        # 写入失败的下次重试
+        self.create_event.side_effect = create_event
+        self.assertEqual(self.sync(), (1, 1, 1, 0, 0))
+        self.sessions['e1'] = self.sessions['e1'][:1]
+        self.assertEqual(self.sync(), (0, 0, 0, 1, 0))
+        self.assertEqual(self.set_off.call_count, 1)
+
+
+class CyStockSyncTest(FakeRedisTestCase):
+    def setUp(self):
+        super(CyStockSyncTest, self).setUp()
+        from caiyicloud.models import CyShowEvent, CySession, CyTicketType
+        from ticket.models import ShowProject, SessionInfo, TicketFile
+        from ticket.stock_updater import tfc, StockModel
+        now = datetime.now()
+        show = ShowProject.objects.create(title='测试节目', sale_time=now)
+        self.levels = []
+        for i, seat_type in enumerate([CyShowEvent.SEAT_NO, CyShowEvent.SEAT_HAS]):
+            has_seat = SessionInfo.SEAT_NO if seat_type == CyShowEvent.SEAT_NO else SessionInfo.SEAT_HAS
+            event = CyShowEvent.objects.create(event_id='e{}'.format(i), std_id='e', expire_order_minute=15,
+                                               seat_type=seat_type)
+            session = SessionInfo.objects.create(show=show, start_at=now + timedelta(days=1), has_seat=has_seat,
+                                                 end_at=now + timedelta(days=1, hours=2))
+            cy_session = CySession.objects.create(event=event, cy_no='s{}'.format(i), std_id='s', start_time=now,
+                                                  end_time=now, name='场次')
+            level = TicketFile.objects.create(session=session, stock=10, price=100)
+            CyTicketType.objects.create(ticket_file=level, cy_session=cy_session, cy_no='t{}'.format(i),
+                                        std_id='t', name='票档', price=100, stock=10)
+            self.levels.append(level)
+        tfc.append_cache(StockModel(self.levels[0].id, 7))
+        self.cy = mock.Mock()
+        self.cy.ticket_stock.side_effect = lambda nos: [dict(ticket_type_id='t{}'.format(cy_no[1:]), inventory=4)
+                                                        for cy_no in nos]
+        patcher = mock.patch('caiyicloud.api.caiyi_cloud', return_value=self.cy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_save_notify(self):
+        from caiyicloud.models import CySession
+        from caiyicloud.stock_sync import save_notify
+        self.assertEqual(save_notify('e0', [dict(session_id='s0'), dict(session_id='s0')]), 1)
+        # 通知间隔内不重复登记
+        self.assertEqual(save_notify('e0', [dict(session_id='s0')]), 0)
+        self.assertEqual(self.pika.hgetall(CySession.sync_stock_key()), dict(s0='e0'))
+
+    def test_run(self):
+        from caiyicloud.models import CySession, CyTicketType
+        from caiyicloud.stock_sync import CyStockSync, save_notify
+        from ticket.models import TicketFile
+        from ticket.stock_updater import tfc
+        save_notify('e0', [dict(session_id='s0')])
+        save_notify('e1', [dict(session_id='s1')])
+        ret = CyStockSync().run()
+        # 有座的场次不查询
+        self.cy.ticket_stock.assert_called_once_with(['s0'])
+        self.assertEqual((ret['sessions'], ret['changed'], ret['reset']), (1, 1, 1))
+        self.assertEqual(dict(CyTicketType.objects.values_list('cy_no', 'stock')), dict(t0=4, t1=10))
+        self.assertEqual([TicketFile.objects.get(id=level.id).stock for level in self.levels], [4, 10])
+        # 以上游库存为准重置缓存
+        self.assertEqual(tfc.get_stock(self.levels[0].id), '4')
+        self.assertFalse(self.pika.exists(CySession.sync_stock_key()))
@@ -0,0 +1,24 @@
+# coding: utf-8
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    多线程共用的限速器, 每秒最多rate次, rate为0时不限速
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
@@ -1,8 +1,84 @@
 import time
 from typing import List, Tuple, Union
 
+from redis.client import Script
+
 from concu import get_redis
 
+"""
+库存扣减的lua脚本.检查、扣减、记录更新时间在redis服务端一次完成,避免先incr再回滚时其他请求读到负库存.
+脚本首次调用时通过EVALSHA执行, NoScriptError时自动SCRIPT LOAD后重试(redis.client.Script的行为)
+"""
+# KEYS[1]: 库存key, KEYS[2]: update-ts字典key, KEYS[3]: 待持久化id集合key
+# ARGV: increment, ceiling(空字符串代表不限制), 记录方式(见record_mode), id, 当前时间戳
+INCR_LUA = """
+local inc = tonumber(ARGV[1])
+local cur = tonumber(redis.call('GET', KEYS[1]) or '0')
+if ARGV[2] ~= '' and cur + inc < tonumber(ARGV[2]) then
+    return {0, 0}
+end
+local ret = redis.call('INCRBY', KEYS[1], inc)
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[2], ARGV[4] .. '-upd', ARGV[5])
+elseif ARGV[3] == '2' then
+    redis.call('SADD', KEYS[3], ARGV[4])
+end
+return {1, ret}
+"""
+
+# KEYS[1]: update-ts字典key, KEYS[2]: 待持久化id集合key, KEYS[3..n]: 库存key
+# ARGV: 记录方式(见record_mode), 当前时间戳, 之后每3个为一组 id, increment, ceiling
+BATCH_INCR_LUA = """
+local n = #KEYS - 2
+for i = 1, n do
+    local base = 2 + (i - 1) * 3
+    local ceiling = ARGV[base + 3]
+    if ceiling ~= '' then
+        local cur = tonumber(redis.call('GET', KEYS[i + 2]) or '0')
+        if cur + tonumber(ARGV[base + 2]) < tonumber(ceiling) then
+            return {0}
+        end
+    end
+end
+local ret = {1}
+for i = 1, n do
+    local base = 2 + (i - 1) * 3
+    ret[i + 1] = redis.call('INCRBY', KEYS[i + 2], tonumber(ARGV[base + 2]))
+    if ARGV[1] == '1' then
+        redis.call('HSET', KEYS[1], ARGV[base + 1] .. '-upd', ARGV[2])
+    elseif ARGV[1] == '2' then
+        redis.call('SADD', KEYS[2], ARGV[base + 1])
+    end
+end
+return ret
+"""
+
+# 取出待持久化的id集合: 上次处理中的集合未清空(中途崩溃)则继续处理它, 否则把dirty集合整体改名为处理中集合
+# KEYS[1]: 待持久化id集合key, KEYS[2]: 处理中id集合key
+DRAIN_DIRTY_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return redis.call('SCARD', KEYS[2])
+"""
+
+_scripts = {}
+
+
+def get_script(lua: str) -> Script:
+    """
+    脚本只注册一次,后续通过EVALSHA调用
+    """
+    script = _scripts.get(lua)
+    if not script:
+        script = get_redis().register_script(lua)
+        _scripts[lua] = script
+    return script
+
+
+def _ceiling_arg(ceiling) -> str:
+    return '' if ceiling == Ellipsis else str(int(ceiling))
+
 
 class StockModel:
     def __init__(self, _id: Union[int, str], stock: int):
@@ -30,6 +106,13 @@ class StockModel:
 
 
 class StockCache:
+    # 是否使用lua脚本扣减库存, 为False时使用旧的 incr->比较->回滚 方式
+    use_script = True
+    # persist是否只处理dirty集合里的id, 为False时使用旧的遍历update-ts字典方式
+    use_dirty_set = True
+    # 增量持久化每批处理的数量
+    persist_batch_size = 500
+
     def load_list(self) -> List[StockModel]:
         """
         加载需要预热的全量数据列表,用于预热(pre_cache)
@@ -69,6 +152,15 @@ class StockCache:
         r = get_redis()
         return r.get(self.cache_key(_id))
 
+    def get_stocks(self, ids: List[Union[int, str]]) -> List[str]:
+        """
+        批量获取库存, 一次mget
+        """
+        if not ids:
+            return []
+        r = get_redis()
+        return r.mget([self.cache_key(_id) for _id in ids])
+
     def pre_cache(self):
         """
         1.加载数据，预热缓存
@@ -84,6 +176,18 @@ class StockCache:
         """
         return self.get_key('update-ts')
 
+    def get_dirty_key(self):
+        """
+        有更新待持久化的id集合, 例如good-dirty
+        """
+        return self.get_key('dirty')
+
+    def get_dirty_processing_key(self):
+        """
+        本轮持久化正在处理的id集合, 每批持久化成功后从中移除, 中途崩溃时下一轮从这里继续
+        """
+        return self.get_key('dirty-processing')
+
     # def incr_persist(self, id: Union[int, str], qty: int, increment:int):
     #     """
     #     :param id, 标识id
@@ -93,6 +197,14 @@ class StockCache:
     #     """
     #     pass
 
+    def record_mode(self, record_update_ts: bool) -> str:
+        """
+        脚本的记录方式: 0不记录, 1只写update-ts字典(全量模式), 2只写dirty集合(增量模式)
+        """
+        if not record_update_ts:
+            return '0'
+        return '2' if self.use_dirty_set else '1'
+
     def record_update_ts(self, id: Union[int, str]):
         """
         :param 记录id的数据更新时间戳(s),辅助后面的更新
@@ -100,14 +212,20 @@ class StockCache:
         good-update_ts:
            {"1-upd": 1009912899, "1-per": 10080091900}
            其中 1-upd代表商品id=1的最新更新的时间, 1-per代表商品id=1的最新持久化时间.只要1-upd > 1-per就可以更新
+        增量模式只写dirty集合, 不再写update-ts字典; 全量模式不消费dirty集合, 也不写入
         """
         r = get_redis()
-        r.hset(self.get_update_ts_key(), f'{id}-upd', int(time.time()))
+        if self.use_dirty_set:
+            r.sadd(self.get_dirty_key(), id)
+        else:
+            r.hset(self.get_update_ts_key(), f'{id}-upd', int(time.time()))
 
     def record_persist_ts(self, _id: Union[int, str]):
         """
-        记录持久化时间
+        记录持久化时间, 增量模式不需要
         """
+        if self.use_dirty_set:
+            return
         r = get_redis()
         r.hset(self.get_update_ts_key(), f'{_id}-per', int(time.time()))
 
@@ -119,6 +237,8 @@ class StockCache:
         2.更新数据库（采取定期同步缓存的到数据库).
         :return bool, int 是否计数成功, 计数后的新值, 若为false, 新值为0
         """
+        if self.use_script:
+            return self.script_incr(id, increment, ceiling, disable_record_update_ts)
         r = get_redis()
         ck = self.cache_key(id)
         ret = r.incr(ck, increment)
@@ -132,13 +252,27 @@ class StockCache:
                 self.record_update_ts(id)
             return True, ret
 
-    def batch_incr(self, inc_tuple: List[Tuple[Union[int, str], int, int]]) -> Tuple[
+    def script_incr(self, id: Union[int, str], increment: int, ceiling: int = 0,
+                    disable_record_update_ts: bool = False) -> Tuple[bool, int]:
+        """
+        lua脚本版本的incr, 一次往返完成检查、扣减和记录更新时间, 失败时库存不会被改动
+        """
+        record = self.record_mode(not (disable_record_update_ts or ceiling == Ellipsis))
+        succeed, ret = get_script(INCR_LUA)(keys=[self.cache_key(id), self.get_update_ts_key(), self.get_dirty_key()],
+                                            args=[increment, _ceiling_arg(ceiling), record, id, int(time.time())],
+                                            client=get_redis())
+        return bool(succeed), int(ret)
+
+    def batch_incr(self, inc_tuple: List[Tuple[Union[int, str], int, int]], record_update_ts: bool = False) -> Tuple[
         bool, List[Tuple[Union[int, str], int]]]:
         """
         :param inc_tuple (id, increment, ceiling)
+        :param record_update_ts 成功时是否同时记录更新时间戳(仅脚本模式下在同一次往返完成, 否则等同于batch_record_update_ts)
         批量减多个商品库存, 保证原子性,成功则全部更新成功,失败则回滚.
-        返回: bool, List[Tuple[Union[int, str], int]  是否全部更新成功, 成功之后依次的新值; 失败是为False, []
+        返回: bool, List[Tuple[Union[int, str], int]]  是否全部更新成功, 成功之后依次的新值; 失败是为False, []
         """
+        if self.use_script:
+            return self.script_batch_incr(inc_tuple, record_update_ts)
         l = []
         incred = []
         for _id, increment, ceiling in inc_tuple:
@@ -149,12 +283,38 @@ class StockCache:
                 l.append((_id, qty))
                 incred.append((_id, increment))
         else:
+            if record_update_ts:
+                self.batch_record_update_ts(self.resolve_ids(l))
             return True, l
         # means beak, so need to rollback
         for _id, increment in incred:
             self.incr(_id, -increment, Ellipsis, True)
         return False, []
 
+    def script_batch_incr(self, inc_tuple: List[Tuple[Union[int, str], int, int]], record_update_ts: bool = False) -> \
+            Tuple[bool, List[Tuple[Union[int, str], int]]]:
+        """
+        lua脚本版本的batch_incr, 先检查全部再统一扣减, 要么全部成功要么全部不动, 不需要客户端回滚
+        """
+        if not inc_tuple:
+            return True, []
+        keys, args = self.get_batch_incr_params(inc_tuple, record_update_ts)
+        ret = get_script(BATCH_INCR_LUA)(keys=keys, args=args, client=get_redis())
+        if not ret[0]:
+            return False, []
+        return True, [(o[0], int(qty)) for o, qty in zip(inc_tuple, ret[1:])]
+
+    def get_batch_incr_params(self, inc_tuple: List[Tuple[Union[int, str], int, int]], record_update_ts: bool = False):
+        """
+        BATCH_INCR_LUA的keys和args, 异步客户端执行同一个脚本时也使用
+        """
+        keys = [self.get_update_ts_key(), self.get_dirty_key()]
+        args = [self.record_mode(record_update_ts), int(time.time())]
+        for _id, increment, ceiling in inc_tuple:
+            keys.append(self.cache_key(_id))
+            args.extend([_id, increment, _ceiling_arg(ceiling)])
+        return keys, args
+
     @staticmethod
     def resolve_ids(batch_results: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
         """
@@ -167,8 +327,21 @@ class StockCache:
         """
         批量设置更新时间戳.用在batch_incr之后.当跨表事务更新时候尤其需要用到
         """
-        for _id in ids:
-            self.record_update_ts(_id)
+        if not ids:
+            return
+        r = get_redis()
+        if self.use_dirty_set:
+            r.sadd(self.get_dirty_key(), *ids)
+        else:
+            now = int(time.time())
+            r.hmset(self.get_update_ts_key(), {f'{_id}-upd': now for _id in ids})
+
+    def save_stock_models(self, items: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
+        """
+        :param items [(id, qty)] 批量持久化, 子类可以覆盖为一条bulk_update/CASE WHEN语句
+        :return 持久化成功的id
+        """
+        return [_id for _id, qty in items if self.save_stock_model(_id, qty)]
 
     def instant_persist(self, _id: Union[int, str]):
         """
@@ -178,8 +351,19 @@ class StockCache:
         self.incr(...)
         self.instant_persist(...)
         """
-        uk = self.get_update_ts_key()
         r = get_redis()
+        if self.use_dirty_set:
+            # 在dirty或处理中集合里即为有未持久化的更新, 不移除, 定期持久化再写一次最新值
+            with r.pipeline(transaction=False) as pipe:
+                pipe.sismember(self.get_dirty_key(), _id)
+                pipe.sismember(self.get_dirty_processing_key(), _id)
+                dirty = any(pipe.execute())
+            if dirty:
+                qty = r.get(self.cache_key(_id))
+                if qty:
+                    self.save_stock_model(_id, int(qty))
+            return
+        uk = self.get_update_ts_key()
         upd, per = r.hget(uk, f'{_id}-upd'), r.hget(uk, f'{_id}-per')
         if upd and (not per or int(per) < int(upd)):
             # update
@@ -189,7 +373,45 @@ class StockCache:
 
     def persist(self):
         """
-        定期执行, 遍历good-update-ts字典.全量持久化
+        定期执行持久化
+        """
+        if self.use_dirty_set:
+            self.dirty_persist()
+        else:
+            self.full_persist()
+
+    def dirty_persist(self):
+        """
+        增量持久化, 每轮只处理有更新的id, 开销为O(变更数):
+        1.dirty集合原子改名为处理中集合, 新的更新会进入新的dirty集合, 留给下一轮
+        2.分批 MGET 库存 -> save_stock_models 批量写库 -> 从处理中集合移除(即持久化水位)
+        中途崩溃时处理中集合里剩下的id下一轮会继续处理.
+        增量模式不使用update-ts字典, 不再写入-upd/-per
+        """
+        r = get_redis()
+        uk = self.get_update_ts_key()
+        if r.setnx(self.get_key('dirty-inited'), 1):
+            # 首次切换到增量模式, 把旧update-ts字典里还没持久化的数据先处理掉
+            self.full_persist()
+        # 旧字典(包括之前版本增量模式写入的)已无用, 删除, 不存在时为空操作
+        r.delete(uk)
+        dk, pk = self.get_dirty_key(), self.get_dirty_processing_key()
+        if not get_script(DRAIN_DIRTY_LUA)(keys=[dk, pk], client=r):
+            return
+        while True:
+            ids = r.srandmember(pk, self.persist_batch_size)
+            if not ids:
+                break
+            qtys = r.mget([self.cache_key(_id) for _id in ids])
+            items = [(_id, int(qty)) for _id, qty in zip(ids, qtys) if qty is not None]
+            if items:
+                self.save_stock_models(items)
+            # 缓存已删除或写库失败的id也移除, 写库失败的等下次更新再持久化, 避免每轮重复失败
+            r.srem(pk, *ids)
+
+    def full_persist(self):
+        """
+        遍历good-update-ts字典.全量持久化
         """
         uk = self.get_update_ts_key()
         r = get_redis()
@@ -222,6 +444,7 @@ class StockCache:
         r.delete(self.cache_key(_id))
         uk = self.get_update_ts_key()
         r.hdel(uk, f'{_id}-upd'), r.hget(uk, f'{_id}-per')
+        r.srem(self.get_dirty_key(), _id)
 
 
 class BatchTrans:
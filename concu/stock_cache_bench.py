@@ -0,0 +1,61 @@
+import time
+from typing import List, Union
+
+from redis import Redis
+
+from concu import set_redis_provider
+from concu.stock_cache import StockCache, StockModel
+
+"""
+库存扣减基准测试, 对比lua脚本模式与旧的 incr->比较->回滚 模式
+使用: python -m concu.stock_cache_bench [redis_host] [次数]
+"""
+
+
+class BenchStockCache(StockCache):
+    def load_list(self) -> List[StockModel]:
+        return []
+
+    def key_prefix(self):
+        return 'bench-stock'
+
+    def save_stock_model(self, id: Union[int, str], qty: int) -> bool:
+        return True
+
+
+def run(sc: StockCache, use_script: bool, times: int, batch_size: int = 3):
+    sc.use_script = use_script
+    ids = list(range(batch_size))
+    for _id in ids:
+        sc.append_cache(StockModel(_id, times * 2))
+    st = time.time()
+    for _ in range(times):
+        sc.incr(0, -1, 0)
+    single = time.time() - st
+    st = time.time()
+    for _ in range(times):
+        sc.batch_incr([(_id, -1, 0) for _id in ids], record_update_ts=True)
+    batch = time.time() - st
+    # 库存不足的失败路径
+    sc.append_cache(StockModel(0, 0))
+    st = time.time()
+    for _ in range(times):
+        sc.batch_incr([(_id, -1, 0) for _id in ids])
+    fail = time.time() - st
+    for _id in ids:
+        sc.remove(_id)
+    print(f"use_script={use_script} incr:{single / times * 1000:.3f}ms/op "
+          f"batch_incr({batch_size}):{batch / times * 1000:.3f}ms/op "
+          f"batch_incr_fail:{fail / times * 1000:.3f}ms/op")
+
+
+if __name__ == '__main__':
+    import sys
+
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    times = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    r = Redis(host=host, decode_responses=True)
+    set_redis_provider(lambda: r)
+    sc = BenchStockCache()
+    run(sc, False, times)
+    run(sc, True, times)
@@ -79,9 +79,9 @@ class UserCouponRecordAdmin(OnlyViewAdmin):
 
 
 def do_performance_import(modeladmin, request, queryset):
-    qs = queryset.filter(status=UserCouponImport.ST_NEED)
+    qs = queryset.filter(status__in=[UserCouponImport.ST_NEED, UserCouponImport.ST_DOING, UserCouponImport.ST_FAIL])
     if not qs:
-        raise AdminException('未执行的记录才能执行')
+        raise AdminException('未执行或未完成的记录才能执行')
     for inst in qs:
         from coupon.q_tasks import coupon_import_task
         coupon_import_task(pk=inst.id)
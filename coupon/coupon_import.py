@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import defaultdict
+
+from django.db.transaction import atomic
+
+from caches import get_redis, get_pika_redis, coupon_import_lock_key
+
+log = logging.getLogger(__name__)
+"""
+消费券批量发放(UserCouponImport.do_import):
+1. openpyxl只读模式逐行读取, 每CHUNK_SIZE行一批: 用户、消费券、未领取记录各一次查询, 在内存里校验,
+   UserCouponRecord/UserCouponCacheRecord按批bulk_create/bulk_update
+2. 断点: 每批写入和记录的success_num/fail_num/fail_msg在同一个事务里提交, 已处理行数=成功+失败,
+   执行中断(进程重启等)后状态仍是执行中, 再次执行从下一行继续; 每个失败行在fail_msg里记录行号和原因
+3. 同一记录同时只能有一个在执行(redis锁, 每批续期)
+4. 用户领取数量、弹窗的缓存在每批提交后用pipeline一次写入
+"""
+CHUNK_SIZE = 1000
+LOCK_EXPIRE = 600
+# 表头所在行
+TITLE_LINE = 1
+
+
+def format_str(content: str):
+    return content.replace('_x000D_', ' ')
+
+
+class CouponImporter(object):
+    def __init__(self, inst, chunk_size: int = CHUNK_SIZE):
+        self.inst = inst
+        self.chunk_size = chunk_size
+        self.lock_key = coupon_import_lock_key.format(inst.id)
+        self.coupons = dict()
+        self.snapshots = dict()
+
+    def acquire(self) -> bool:
+        return bool(get_redis().set(self.lock_key, 1, nx=True, ex=LOCK_EXPIRE))
+
+    def release(self):
+        get_redis().delete(self.lock_key)
+
+    def run(self):
+        from openpyxl import load_workbook
+        inst = self.inst
+        # 已处理的行, 从断点继续
+        done = inst.success_num + inst.fail_num
+        wb = load_workbook(inst.file.path, read_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            title_list = list(next(rows))
+            indexes = title_list.index('手机号'), title_list.index('消费券编号'), title_list.index('发放数量')
+            chunk = []
+            line = TITLE_LINE
+            for line, row in enumerate(rows, TITLE_LINE + 1):
+                if line - TITLE_LINE <= done:
+                    continue
+                chunk.append((line, [row[i] if i < len(row) else None for i in indexes]))
+                if len(chunk) >= self.chunk_size:
+                    self.do_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.do_chunk(chunk)
+            inst.total_num = line - TITLE_LINE
+        finally:
+            wb.close()
+
+    def parse(self, chunk: list):
+        """
+        返回 [(行号, 手机号, 消费券编号, 数量)], [(行号, 原因)]
+        """
+        from common.utils import validate_mobile
+        items = []
+        errors = []
+        for line, (mobile, coupon_no, num) in chunk:
+            mobile = format_str(str(mobile))
+            if not validate_mobile(mobile):
+                errors.append((line, '手机号格式错误'))
+                continue
+            try:
+                num = int(num)
+                if num < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                errors.append((line, '发放数量错误'))
+                continue
+            items.append((line, mobile, format_str(str(coupon_no)), num))
+        return items, errors
+
+    def load_coupons(self, coupon_nos: set):
+        from coupon.models import Coupon, UserCouponRecord
+        coupon_nos = coupon_nos - set(self.coupons.keys())
+        if not coupon_nos:
+            return
+        for coupon in Coupon.objects.filter(no__in=coupon_nos):
+            self.coupons[coupon.no] = coupon
+            # 同一消费券的快照相同, 只生成一次
+            self.snapshots[coupon.no] = UserCouponRecord(coupon=coupon).get_snapshot()
+
+    def do_chunk(self, chunk: list):
+        from coupon.models import UserCouponRecord, UserCouponCacheRecord
+        from mall.models import User
+        inst = self.inst
+        items, errors = self.parse(chunk)
+        self.load_coupons(set([coupon_no for _, _, coupon_no, _ in items]))
+        users = dict(User.objects.filter(mobile__in=set([mobile for _, mobile, _, _ in items]))
+                     .order_by('-pk').values_list('mobile', 'id'))
+        records = []
+        cache_nums = dict()
+        obtain = defaultdict(int)
+        success = 0
+        for line, mobile, coupon_no, num in items:
+            coupon = self.coupons.get(coupon_no)
+            if not coupon:
+                errors.append((line, '消费券不存在'))
+                continue
+            user_id = users.get(mobile)
+            if user_id:
+                for i in range(num):
+                    records.append(UserCouponRecord(user_id=user_id, coupon=coupon, expire_time=coupon.expire_time,
+                                                    amount=coupon.amount, discount=coupon.discount,
+                                                    coupon_type=coupon.type, require_amount=coupon.require_amount,
+                                                    require_num=coupon.require_num,
+                                                    snapshot=self.snapshots[coupon_no]))
+                if num:
+                    obtain[(coupon_no, user_id)] += num
+            else:
+                # 未注册的用户等绑定手机后发放, 同一手机号同一消费券以最后一行为准
+                cache_nums[(mobile, coupon.id)] = num
+            success += 1
+        with atomic():
+            if records:
+                UserCouponRecord.objects.bulk_create(records, batch_size=500)
+            if cache_nums:
+                self.save_cache_records(UserCouponCacheRecord, cache_nums)
+            inst.success_num += success
+            inst.fail_num += len(errors)
+            if errors:
+                errors.sort()
+                inst.fail_msg = (inst.fail_msg or '') + ''.join(['{}行:{},'.format(line, msg) for line, msg in errors])
+            inst.save(update_fields=['success_num', 'fail_num', 'fail_msg'])
+        if obtain:
+            self.set_user_cache(obtain)
+        get_redis().expire(self.lock_key, LOCK_EXPIRE)
+        log.debug('coupon import {} chunk: {}, {}'.format(inst.id, success, len(errors)))
+
+    def save_cache_records(self, model, cache_nums: dict):
+        exists = dict()
+        for obj in model.objects.filter(record_id=self.inst.id,
+                                        mobile__in=set([mobile for mobile, _ in cache_nums.keys()])):
+            exists[(obj.mobile, obj.coupon_id)] = obj
+        update_list = []
+        create_list = []
+        for (mobile, coupon_id), num in cache_nums.items():
+            obj = exists.get((mobile, coupon_id))
+            if obj:
+                obj.num = num
+                update_list.append(obj)
+            else:
+                create_list.append(model(record_id=self.inst.id, mobile=mobile, coupon_id=coupon_id, num=num))
+        if update_list:
+            model.objects.bulk_update(update_list, ['num'], batch_size=500)
+        if create_list:
+            model.objects.bulk_create(create_list, batch_size=500)
+
+    def set_user_cache(self, obtain: dict):
+        from coupon.models import Coupon, UserCouponRecord
+        with get_pika_redis() as redis:
+            with redis.pipeline(transaction=False) as pipe:
+                user_ids = set()
+                for (coupon_no, user_id), num in obtain.items():
+                    key, name = UserCouponRecord.user_obtain_key(coupon_no, user_id)
+                    pipe.hincrby(key, name, num)
+                    user_ids.add(user_id)
+                for user_id in user_ids:
+                    key, name = Coupon.pop_up_key(user_id)
+                    pipe.hset(key, name, 1)
+                pipe.execute()
@@ -420,72 +420,34 @@ class UserCouponImport(models.Model):
         log.info(f'批量发放记录导入完成,{pk}')
 
     def do_import(self):
-        def format_str(content: str):
-            return content.replace('_x000D_', ' ')
-
-        self.exec_at = timezone.now()
-        self.status = self.ST_DOING
-        self.save(update_fields=['status', 'exec_at'])
-        fail_num = 0
-        success_num = 0
-        fail_msg = ''
+        """
+        流式导入, 按批写入, 执行中断后再次执行从断点继续, 见coupon.coupon_import
+        """
+        from coupon.coupon_import import CouponImporter
+        importer = CouponImporter(self)
+        if not importer.acquire():
+            log.warning(f'批量发放记录正在执行,{self.id}')
+            return
         try:
-            from openpyxl import load_workbook
-            wb = load_workbook(self.file.path)
-            # wb = load_workbook('d:/11.xlsx')
-            ws = wb.active
-            update_list = []
-            coupon_dict = dict()
-            user_dict = dict()
-            for line, row in enumerate(ws.rows, 1):
-                if line == 1:
-                    title_list = [t.value for t in row]
-                    mobile_index = title_list.index('手机号')
-                    coupon_index = title_list.index('消费券编号')
-                    num_index = title_list.index('发放数量')
-                    continue
-                try:
-                    dd = list(map(lambda cell: cell.value, row))
-                    mobile = format_str(str(dd[mobile_index]))
-                    from common.utils import validate_mobile
-                    vm = validate_mobile(mobile)
-                    if not vm:
-                        raise ValueError('手机号格式错误')
-                    if not user_dict.get(mobile):
-                        from mall.models import User
-                        user = User.objects.filter(mobile=mobile).first()
-                        user_dict[mobile] = user
-                    else:
-                        user = user_dict[mobile]
-                    coupon_no = format_str(str(dd[coupon_index]))
-                    num = int(dd[num_index])
-                    if not coupon_dict.get(coupon_no):
-                        coupon = Coupon.objects.get(no=coupon_no)
-                        coupon_dict[coupon_no] = coupon
-                    else:
-                        coupon = coupon_dict[coupon_no]
-                    if not user:
-                        obj = UserCouponCacheRecord.get_obj(self.id, mobile, coupon.id)
-                        obj.num = num
-                        update_list.append(obj)
-                    else:
-                        for i in list(range(0, num)):
-                            UserCouponRecord.create_record(user.id, coupon)
-                    success_num += 1
-                except Exception as e:
-                    fail_num += 1
-                    fail_msg = fail_msg + '{}行,'.format(line)
-                    print(e)
-            if update_list:
-                UserCouponCacheRecord.objects.bulk_update(update_list, ['num'])
-        except Exception as e:
-            log.error(e)
-            fail_msg = str(e)
-        self.status = self.ST_FINISH if fail_num == 0 and not fail_msg else self.ST_FAIL
-        self.fail_num = fail_num
-        self.success_num = success_num
-        self.fail_msg = fail_msg
-        self.save(update_fields=['status', 'fail_num', 'success_num', 'fail_msg'])
+            if self.status == self.ST_NEED:
+                # 未执行的从头开始, 执行中(中断)和异常的从断点继续
+                self.success_num = self.fail_num = 0
+                self.fail_msg = ''
+            self.exec_at = timezone.now()
+            self.status = self.ST_DOING
+            self.save(update_fields=['status', 'exec_at', 'success_num', 'fail_num', 'fail_msg'])
+            error = None
+            try:
+                importer.run()
+            except Exception as e:
+                log.error(e)
+                error = str(e)
+            self.status = self.ST_FINISH if self.fail_num == 0 and not error else self.ST_FAIL
+            if error:
+                self.fail_msg = (self.fail_msg or '') + error
+            self.save(update_fields=['status', 'total_num', 'fail_msg'])
+        finally:
+            importer.release()
 
 
 class UserCouponCacheRecord(models.Model):
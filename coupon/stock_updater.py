@@ -1,5 +1,5 @@
 import logging
-from typing import List, Type, Union
+from typing import List, Tuple, Type, Union
 
 from concu.stock_cache import StockCache, StockModel
 
@@ -24,5 +24,10 @@ class CouponStockCache(StockCache):
         from coupon.models import Coupon
         return Coupon.objects.filter(pk=id).update(stock=qty) == 1
 
+    def save_stock_models(self, items: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
+        from coupon.models import Coupon
+        Coupon.objects.bulk_update([Coupon(pk=_id, stock=qty) for _id, qty in items], ['stock'])
+        return [_id for _id, qty in items]
+
 
 csc = CouponStockCache()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import override_settings
+
+from caches.testing import FakeRedisTestCase
+
+ROWS = [('13800000050', 'C1', 2), ('13800000051', 'C1', 1), ('abc', 'C1', 1), ('13800000050', 'NOPE', 1),
+        ('13800000050', 'C1', 'x'), ('13800000051', 'C1', 3)]
+
+
+class CouponImportTest(FakeRedisTestCase):
+    def setUp(self):
+        super(CouponImportTest, self).setUp()
+        from openpyxl import Workbook
+        from coupon.models import Coupon, UserCouponImport
+        from mall.models import User
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        patcher = override_settings(MEDIA_ROOT=media_root)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        wb = Workbook()
+        wb.active.append(['手机号', '消费券编号', '发放数量'])
+        for row in ROWS:
+            wb.active.append(row)
+        wb.save(os.path.join(media_root, 'coupon.xlsx'))
+        self.coupon = Coupon.objects.create(no='C1', name='测试券', expire_time=datetime.now() + timedelta(days=1),
+                                            user_tips='测试', amount=10)
+        self.user = User.objects.create(username='coupon', mobile='13800000050')
+        self.inst = UserCouponImport.objects.create(file='coupon.xlsx')
+
+    def assert_imported(self, inst):
+        from coupon.models import UserCouponRecord, UserCouponCacheRecord
+        self.assertEqual((inst.success_num, inst.fail_num, inst.total_num), (3, 3, 6))
+        self.assertEqual(inst.fail_msg, '4行:手机号格式错误,5行:消费券不存在,6行:发放数量错误,')
+        self.assertEqual(UserCouponRecord.objects.filter(user=self.user, coupon=self.coupon).count(), 2)
+        # 未注册的手机号以最后一行为准
+        self.assertEqual(list(UserCouponCacheRecord.objects.filter(record_id=inst.id).values_list('mobile', 'num')),
+                         [('13800000051', 3)])
+
+    def test_resume_from_checkpoint(self):
+        from coupon.coupon_import import CouponImporter
+        from coupon.models import UserCouponImport
+        do_chunk = CouponImporter.do_chunk
+        calls = []
+
+        def fail_second(importer, chunk):
+            calls.append(chunk)
+            if len(calls) == 2:
+                raise ConnectionError('中断')
+            return do_chunk(importer, chunk)
+
+        with mock.patch.object(CouponImporter, 'do_chunk', fail_second), self.assertRaises(ConnectionError):
+            CouponImporter(self.inst, chunk_size=2).run()
+        inst = UserCouponImport.objects.get(id=self.inst.id)
+        # 已提交的批次就是断点
+        self.assertEqual(inst.success_num + inst.fail_num, 2)
+        with mock.patch.object(CouponImporter, 'do_chunk', autospec=True, side_effect=do_chunk) as resumed:
+            CouponImporter(inst, chunk_size=2).run()
+        self.assertEqual([line for line, _ in resumed.call_args_list[0][0][1]], [4, 5])
+        inst.save(update_fields=['total_num'])
+        self.assert_imported(UserCouponImport.objects.get(id=self.inst.id))
+
+    def test_do_import(self):
+        from coupon.models import Coupon, UserCouponImport, UserCouponRecord
+        self.inst.do_import()
+        inst = UserCouponImport.objects.get(id=self.inst.id)
+        self.assertEqual(inst.status, UserCouponImport.ST_FAIL)
+        self.assert_imported(inst)
+        key, name = UserCouponRecord.user_obtain_key('C1', self.user.id)
+        self.assertEqual(self.pika.hget(key, name), '2')
+        self.assertTrue(self.pika.hexists(*Coupon.pop_up_key(self.user.id)))
+        # 已完成的行不会重复发放
+        inst.do_import()
+        self.assert_imported(UserCouponImport.objects.get(id=self.inst.id))
+
+    def test_locked(self):
+        from coupon.coupon_import import CouponImporter
+        from coupon.models import UserCouponImport
+        self.assertTrue(CouponImporter(self.inst).acquire())
+        self.inst.do_import()
+        self.assertEqual(UserCouponImport.objects.get(id=self.inst.id).status, UserCouponImport.ST_NEED)
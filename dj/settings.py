@@ -397,6 +397,22 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'ticket.tasks.add_session_actual_amount',
         'schedule': timedelta(seconds=153),  # 每隔10分钟执行一次（datetime的 timedelta方式来实现）
     },
+    'drain_show_rebuild_queue': {
+        'task': 'ticket.tasks.drain_show_rebuild_queue',
+        'schedule': timedelta(seconds=31),  # 项目场次缓存重建, 延迟任务丢失时兜底
+    },
+    'flush_gate_checks': {
+        'task': 'ticket.tasks.flush_gate_checks',
+        'schedule': timedelta(seconds=13),  # 入场验票记录写库, 延迟任务丢失时兜底
+    },
+    'preload_gate_index': {
+        'task': 'ticket.tasks.preload_gate_index',
+        'schedule': timedelta(seconds=307),  # 加载即将开演场次的验票索引
+    },
+    'reconcile_gate_checks': {
+        'task': 'ticket.tasks.reconcile_gate_checks',
+        'schedule': timedelta(seconds=601),  # 验票索引对账
+    },
     'send_show_start_notice': {
         'task': 'ticket.tasks.send_show_start_notice',
         'schedule': timedelta(seconds=71),  # 每隔10分钟执行一次（datetime的 timedelta方式来实现）
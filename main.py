@@ -30,6 +30,7 @@ log = logging.getLogger(__name__)
 
 _config = None
 _pika_redis = None
+_noseat_order_pipeline = None
 
 
 def get_config() -> Dict:
@@ -64,6 +65,22 @@ def pika_redis():
     return _pika_redis
 
 
+def noseat_order_pipeline():
+    """
+    env.yml可选配置:
+    noseat_order:
+      db_workers: 20  # 数据库线程数
+      max_pending: 200  # 每个进程同时处理的下单请求上限, 超过直接拒绝
+    """
+    global _noseat_order_pipeline
+    if not _noseat_order_pipeline:
+        from ticket.async_order import NoSeatOrderPipeline
+        conf = get_config().get('noseat_order') or dict()
+        _noseat_order_pipeline = NoSeatOrderPipeline(db_workers=conf.get('db_workers', 20),
+                                                     max_pending=conf.get('max_pending', 200))
+    return _noseat_order_pipeline
+
+
 #
 # @app.get("/tapi/szpw/info/")
 # async def info(req: FastAPIRequest):
@@ -101,8 +118,8 @@ def pika_redis():
 async def new_info(req: FastAPIRequest):
     config = get_config()
     token = req.headers.get('actoken') or req.query_params.get('token')
-    from mall.user_cache import token_to_cache_user
-    user = token_to_cache_user(token)
+    from mall.user_cache import async_token_to_cache_user
+    user = await async_token_to_cache_user(token)
     if not user:
         return ORJSONResponse(status_code=403, content=dict(msg='请重新登录'))
     share_code = req.query_params.get('share_code')
@@ -123,14 +140,6 @@ async def new_info(req: FastAPIRequest):
     return user_info
 
 
-class DjRequest:
-    def __init__(self, data, user, header, query_params):
-        self.data = data
-        self.user = user
-        self.META = header
-        self.query_params = query_params
-
-
 @app.post("/tapi/szpw/noseat_order/")
 async def noseat_order(req: FastAPIRequest):
     token = req.headers.get('actoken') or req.query_params.get('token')
@@ -141,34 +150,9 @@ async def noseat_order(req: FastAPIRequest):
         data = orjson.loads(body)
     else:
         return ORJSONResponse(status_code=403, content=dict(msg='参数错误'))
-    from mall.user_cache import token_to_cache_user
-    user = token_to_cache_user(token)
-    if not user:
-        return ORJSONResponse(status_code=403, content=dict(msg='请重新登陆'))
-    django_request = DjRequest(data, user, req.headers, req.query_params)
-    loop = asyncio.get_event_loop()
     from restframework_ext.exceptions import CustomAPIException
-    from ticket.order_serializer_new import TicketOrderOnSeatNewCreateSerializer
-
-    def noseat_order_debug(dj_request):
-        data = dj_request.data
-        user = dj_request.user
-        data['user'] = user
-        if user.forbid_order:
-            raise CustomAPIException('用户异常，请联系客服')
-        s = TicketOrderOnSeatNewCreateSerializer(data=django_request.data, context={'request': dj_request})
-        s._validated_data = dict()
-        s._errors = {}
-        s.is_valid(True)
-        order, payno, prepare_order, pay_end_at, ks_order_info, xhs_order_info = s.create(data)
-        data = dict(receipt_id=payno, prepare_order=prepare_order, pay_end_at=pay_end_at,
-                    order_id=order.order_no, ks_order_info=ks_order_info, xhs_order_info=xhs_order_info)
-        # log.warning(f"got the queue and exec over")
-        return data
-
     try:
-        data = await loop.run_in_executor(executor, lambda: noseat_order_debug(django_request))
-        return data
+        return await noseat_order_pipeline().create(token, data, req.headers, req.query_params)
     except CustomAPIException as e:
         log.error(e)
         return ORJSONResponse(status_code=e.status_code, content=dict(msg=e.msg))
@@ -176,6 +160,14 @@ async def noseat_order(req: FastAPIRequest):
         log.error(e)
         return ORJSONResponse(status_code=400, content=dict(msg='下单失败'))
 
+
+@app.get("/tapi/szpw/noseat_order_metrics/")
+async def noseat_order_metrics(req: FastAPIRequest):
+    # 当前进程的下单统计, 只允许本机访问
+    if not req.client or req.client.host not in ['127.0.0.1', '::1']:
+        return ORJSONResponse(status_code=403, content=dict(msg='forbidden'))
+    return noseat_order_pipeline().get_metrics()
+
 # @app.get("/tapi/szpw/test_order/")
 # async def test_order(req: FastAPIRequest):
 #     # token = req.headers.get('actoken') or req.query_params.get('token')
@@ -15,7 +15,7 @@ from django.contrib.auth.models import AbstractUser, Group
 from django.db import models
 from django.db.models.functions import Concat
 from django.db.models import Manager
-from django.db.transaction import atomic
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
@@ -30,7 +30,8 @@ from mall.utils import randomstrwithdatetime, gen_user_share_code, randomstrwith
 from mp.models import WeiXinPayConfig, DouYinPayConfig
 from restframework_ext.exceptions import CustomAPIException
 from .pay_service import get_mp_pay_client
-from caches import get_by_key, get_pika_redis, get_redis_name
+from caches import get_by_key, get_pika_redis, get_redis_name, add_discount_total_key
+from statistical.delta_counter import DeltaCounter
 from mp.wechat_client import get_mp_client
 from django.db.models.functions import Cast
 from django.db.models import CharField
@@ -135,6 +136,24 @@ class User(AbstractUser):
     def __str__(self):
         return self.get_full_name()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        inst = super(User, cls).from_db(db, field_names, values)
+        # 记录读出时的上级, 保存时判断上级是否变更
+        inst._loaded_parent_id = inst.__dict__.get('parent_id')
+        return inst
+
+    def save(self, *args, **kwargs):
+        loaded_parent_id = getattr(self, '_loaded_parent_id', None)
+        is_new = self._state.adding
+        super(User, self).save(*args, **kwargs)
+        self._loaded_parent_id = self.__dict__.get('parent_id')
+        if not is_new and self._loaded_parent_id != loaded_parent_id:
+            # 上级变更(包括后台修改), 提交后删除自己和下级的上级链路缓存
+            from mall.user_cache import ancestor_path_cache_delete
+            user_id = self.id
+            on_commit(lambda: ancestor_path_cache_delete(user_id))
+
     ROLE_NONE = 0
     ROLE_SUPER = 1
     ROLE_STORE = 2
@@ -2023,32 +2042,16 @@ class TheaterCardUserRecord(models.Model):
                     raise Exception('更新用户剧场会员卡余额时版本错误')
 
     def add_discount_total(self, amount):
-        from caches import get_redis, add_discount_total_key
-        redis = get_redis()
-        redis.lpush(add_discount_total_key, '{}_{}'.format(self.id, float(amount)))
+        discount_total_counter.incr(self.id, discount_total=amount)
 
     @classmethod
     def task_add_discount_total(cls):
-        from caches import get_redis, add_discount_total_key
-        redis = get_redis()
-        amount_list = redis.lrange(add_discount_total_key, 0, -1)
-        if amount_list:
-            data_dict = dict()
-            for value in amount_list:
-                val = redis.rpop(add_discount_total_key)
-                if val:
-                    id, amount = val.split('_')
-                    key = str(id)
-                    if data_dict.get(key):
-                        data_dict[key] += float(amount)
-                    else:
-                        data_dict[key] = float(amount)
-            if data_dict:
-                for key, value in data_dict.items():
-                    inst = cls.objects.filter(id=int(key)).first()
-                    if inst:
-                        inst.discount_total += Decimal(value)
-                        inst.save(update_fields=['discount_total'])
+        close_old_connections()
+        discount_total_counter.drain()
+
+
+discount_total_counter = DeltaCounter('theater_card_discount_total', TheaterCardUserRecord, ['discount_total'],
+                                      legacy_key=add_discount_total_key)
 
 
 class TheaterCardUserDetail(models.Model):
@@ -0,0 +1,128 @@
+import time
+from unittest import mock
+
+from caches.testing import FakeRedisTestCase
+
+
+def run_on_commit(func):
+    func()
+
+
+class AncestorPathTest(FakeRedisTestCase):
+    def setUp(self):
+        super(AncestorPathTest, self).setUp()
+        from mall.models import User
+        self.users = []
+        parent = None
+        for i in range(4):
+            parent = User.objects.create(username='u{}'.format(i), mobile='1380000001{}'.format(i), parent=parent)
+            self.users.append(parent)
+        patcher = mock.patch('mall.models.on_commit', run_on_commit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ids(self, *index):
+        return [self.users[i].id for i in index]
+
+    def test_cached_path(self):
+        from mall.user_cache import get_ancestor_path
+        self.assertEqual(get_ancestor_path(self.users[1].id), self.ids(1, 0))
+        # 碰到已缓存的上级直接拼接
+        with self.assertNumQueries(2):
+            self.assertEqual(get_ancestor_path(self.users[3].id), self.ids(3, 2, 1, 0))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_ancestor_path(self.users[3].id), self.ids(3, 2, 1, 0))
+
+    def test_parent_change(self):
+        from mall.models import User
+        from mall.user_cache import get_ancestor_path
+        get_ancestor_path(self.users[3].id)
+        user = User.objects.get(id=self.users[1].id)
+        user.parent = None
+        user.save(update_fields=['parent'])
+        # 自己和下级的链路都失效
+        self.assertEqual(get_ancestor_path(self.users[3].id), self.ids(3, 2, 1))
+        self.assertEqual(get_ancestor_path(self.users[0].id), self.ids(0))
+
+    def test_cycle(self):
+        from mall.models import User
+        from mall.user_cache import get_ancestor_path
+        get_ancestor_path(self.users[1].id)
+        # 形成循环时截断
+        user = User.objects.get(id=self.users[0].id)
+        user.parent_id = self.users[3].id
+        user.save(update_fields=['parent'])
+        self.assertEqual(get_ancestor_path(self.users[1].id), self.ids(1, 0, 3, 2))
+
+    def test_save_without_parent_change(self):
+        from mall.models import User
+        from mall.user_cache import get_ancestor_path
+        get_ancestor_path(self.users[3].id)
+        with mock.patch('mall.user_cache.ancestor_path_cache_delete') as cache_delete:
+            user = User.objects.get(id=self.users[2].id)
+            user.save()
+        cache_delete.assert_not_called()
+
+
+class PayNotifyTest(FakeRedisTestCase):
+    body = '<xml><transaction_id>tx1</transaction_id><mch_id>m1</mch_id></xml>'
+
+    def setUp(self):
+        super(PayNotifyTest, self).setUp()
+        from mall.models import Receipt
+        self.receipt = Receipt.objects.create(amount=10)
+        self.client = mock.Mock()
+        self.client.parse_pay_result.return_value = dict(return_code='SUCCESS', result_code='SUCCESS', total_fee=1000,
+                                                         attach=str(self.receipt.id), transaction_id='tx1')
+        self.client.check_signature.return_value = True
+        self.set_paid = mock.Mock()
+        for patcher in [mock.patch('restframework_ext.pay_notify.get_notify_client', return_value=self.client),
+                        mock.patch.object(Receipt, 'set_paid', self.set_paid)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def notify(self) -> str:
+        from django.test import RequestFactory
+        from mall.views import ReceiptViewset
+        request = RequestFactory().post('/api/receipts/notify/', self.body, content_type='text/xml')
+        res = ReceiptViewset.as_view({'post': 'notify'})(request)
+        return res.content.decode('utf-8')
+
+    def test_duplicate(self):
+        from caches import pay_notify_ledger_key
+        self.assertIn('SUCCESS', self.notify())
+        self.assertEqual(self.redis.get(pay_notify_ledger_key.format('tx1')), 'done')
+        # 已完成的重复回调不再查询数据库
+        with self.assertNumQueries(0):
+            self.assertIn('SUCCESS', self.notify())
+        self.assertEqual(self.client.parse_pay_result.call_count, 1)
+        self.set_paid.assert_called_once_with(transaction_id='tx1')
+
+    def test_processing(self):
+        from caches import pay_notify_ledger_key
+        self.redis.set(pay_notify_ledger_key.format('tx1'), 'processing')
+        self.assertIn('processing', self.notify())
+        self.client.parse_pay_result.assert_not_called()
+
+    def test_release_on_fail(self):
+        from caches import pay_notify_ledger_key
+        self.client.parse_pay_result.return_value['total_fee'] = 1
+        self.assertIn('fee not correct', self.notify())
+        # 没有处理完成, 微信重试时重新处理
+        self.assertFalse(self.redis.exists(pay_notify_ledger_key.format('tx1')))
+        self.set_paid.assert_not_called()
+
+
+class NotifyClientTest(FakeRedisTestCase):
+    def test_cached(self):
+        from restframework_ext import pay_notify
+        pay_notify.clear_notify_clients()
+        self.addCleanup(pay_notify.clear_notify_clients)
+        with mock.patch('mall.pay_service.get_mp_pay_client') as get_client:
+            self.assertIs(pay_notify.get_notify_client('m1'), pay_notify.get_notify_client('m1'))
+            self.assertEqual(get_client.call_count, 1)
+            pay_notify.get_notify_client('m2')
+            self.assertEqual(get_client.call_count, 2)
+            with mock.patch.object(pay_notify.time, 'time', return_value=time.time() + pay_notify.CLIENT_TTL + 1):
+                pay_notify.get_notify_client('m1')
+            self.assertEqual(get_client.call_count, 3)
@@ -1,7 +1,7 @@
 # coding:utf-8
 from django.core.cache import cache
 from caches import cache_share_code_user_key, cache_token_share_code_key, cache_share_code_account_flag_key, \
-    cache_user_new_parent_key
+    cache_user_new_parent_key, cache_user_ancestor_path_key
 from datetime import datetime
 import logging
 log = logging.getLogger(__name__)
@@ -9,6 +9,9 @@ log = logging.getLogger(__name__)
 TOKEN_EXPIRE_HOURS = 24
 # share_code-> user 90天过期
 SHARE_CODE_USER_EXPIRE = 3 * 30 * 24 * 3600
+# 上级链路缓存1天, 最多缓存的层数
+ANCESTOR_PATH_EXPIRE = 24 * 3600
+ANCESTOR_PATH_MAX_LEVEL = 25
 
 
 def token_share_code_cache(token: str, share_code: str, is_refresh=True):
@@ -117,6 +120,17 @@ def token_to_cache_user(token: str):
     return user
 
 
+async def async_token_to_cache_user(token: str):
+    """
+    token_to_cache_user的异步版本, 不阻塞事件循环
+    """
+    from caches.async_client import cache_get
+    share_code = await cache_get(cache_token_share_code_key.format(token))
+    if share_code:
+        return await cache_get(cache_share_code_user_key.format(share_code))
+    return None
+
+
 def share_code_to_user(share_code: str):
     """
     share_code获取user
@@ -240,3 +254,51 @@ def page_init_user_cache():
     # 返回的id为，最后的accountid
     end_account_id = init_account_flag_cache(account_list)
     return end_user_id, end_account_id
+
+
+def get_ancestor_path(user_id: int) -> list:
+    """
+    用户id->上级链路[自己, 上级, 上上级...], 最多ANCESTOR_PATH_MAX_LEVEL层, 遇到循环截断
+    未缓存时逐级往上查parent_id, 碰到已缓存的上级直接拼接它的链路
+    """
+    key = cache_user_ancestor_path_key.format(user_id)
+    path = cache.get(key)
+    if path is not None:
+        return path
+    from mall.models import User
+    path = [user_id]
+    current = user_id
+    while len(path) < ANCESTOR_PATH_MAX_LEVEL:
+        parent_id = User.objects.filter(id=current).values_list('parent_id', flat=True).first()
+        if not parent_id or parent_id in path:
+            break
+        parent_path = cache.get(cache_user_ancestor_path_key.format(parent_id))
+        if parent_path is not None:
+            for uid in parent_path:
+                if uid in path or len(path) >= ANCESTOR_PATH_MAX_LEVEL:
+                    break
+                path.append(uid)
+            break
+        path.append(parent_id)
+        current = parent_id
+    cache.set(key, path, ANCESTOR_PATH_EXPIRE)
+    return path
+
+
+def ancestor_path_cache_delete(user_id: int):
+    """
+    用户上级变更时删除自己和下级(ANCESTOR_PATH_MAX_LEVEL层内)的上级链路
+    """
+    from mall.models import User
+    user_ids = {user_id}
+    frontier = [user_id]
+    for _ in range(ANCESTOR_PATH_MAX_LEVEL - 1):
+        children = [uid for uid in User.objects.filter(parent_id__in=frontier).values_list('id', flat=True) if
+                    uid not in user_ids]
+        if not children:
+            break
+        user_ids.update(children)
+        frontier = children
+    keys = [cache_user_ancestor_path_key.format(uid) for uid in user_ids]
+    for i in range(0, len(keys), 1000):
+        cache.delete_many(keys[i:i + 1000])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from caches import get_redis, pay_notify_ledger_key
+
+logger = logging.getLogger('mall')
+"""
+微信支付回调(BaseReceiptViewset.notify)的快速路径:
+1. 商户号->支付客户端(含验签)缓存在进程内, CLIENT_TTL秒后重新查询WeiXinPayConfig
+2. 按transaction_id记账: 处理前 SET NX 标记处理中, 处理完成标记已完成,
+   已完成的重复回调直接返回SUCCESS, 不再查询数据库; 处理中的返回Fail, 由微信稍后重试, 避免并发重复set_paid
+"""
+CLIENT_TTL = 300
+# 处理中标记的过期时间, 处理异常退出时到期后可以重新处理
+PROCESSING_EXPIRE = 30
+# 已完成标记保留时间, 微信回调重试不超过这个时间
+DONE_EXPIRE = 3 * 24 * 3600
+ST_PROCESSING = 'processing'
+ST_DONE = 'done'
+
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def get_notify_client(mch_id: str):
+    """
+    商户号对应的支付客户端, 没有对应配置的用默认配置(与get_mp_pay_client一致)
+    """
+    item = _clients.get(mch_id)
+    if item and item[1] > time.time():
+        return item[0]
+    from mall.pay_service import get_mp_pay_client
+    from mall.models import Receipt
+    from mp.models import WeiXinPayConfig
+    wx_pay = WeiXinPayConfig.objects.filter(pay_shop_id=mch_id).first()
+    client = get_mp_pay_client(Receipt.PAY_WeiXin_LP, wx_pay)
+    with _clients_lock:
+        _clients[mch_id] = (client, time.time() + CLIENT_TTL)
+    return client
+
+
+def clear_notify_clients():
+    with _clients_lock:
+        _clients.clear()
+
+
+class NotifyLedger(object):
+    def __init__(self, transaction_id: str):
+        self.transaction_id = transaction_id
+        self.key = pay_notify_ledger_key.format(transaction_id) if transaction_id else None
+
+    def begin(self) -> str:
+        """
+        返回None表示可以处理, 否则返回已有的状态
+        """
+        if not self.key:
+            return None
+        redis = get_redis()
+        if redis.set(self.key, ST_PROCESSING, nx=True, ex=PROCESSING_EXPIRE):
+            return None
+        return redis.get(self.key) or ST_PROCESSING
+
+    def done(self):
+        if self.key:
+            get_redis().set(self.key, ST_DONE, ex=DONE_EXPIRE)
+
+    def release(self):
+        if self.key:
+            get_redis().delete(self.key)
@@ -70,43 +70,51 @@ class BaseReceiptViewset(viewsets.ViewSet):
     def notify(self, request):
         """
         lp payment notify(default)
+        同一transaction_id已处理完成的重复回调直接返回, 见restframework_ext.pay_notify
         :param request:
         :return:
         """
         logger.debug('receive pay notify {}'.format(request.META))
         logger.debug('receive pay notify data is{}'.format(request.body))
-
-        # mp_pay_client = get_wechat_pay_notice_client()
-        data = xmltodict.parse(request.body).get('xml')
-        logger.warning(data)
-        mch_id = data.get('mch_id')
-        from mall.pay_service import get_mp_pay_client
-        from mall.models import Receipt
-        from mp.models import WeiXinPayConfig
-        wx_pay = WeiXinPayConfig.objects.filter(pay_shop_id=mch_id).first()
-        mp_pay_client = get_mp_pay_client(Receipt.PAY_WeiXin_LP, wx_pay)
-
-        result = mp_pay_client.parse_pay_result(request.body)
-        receipt = get_object_or_404(self.receipt_class, id=result.get('attach'))
-        logger.warning('get receipt obj {}'.format(receipt))
         xml = """<xml>
                  <return_code><![CDATA[{}]]></return_code>
                  <return_msg><![CDATA[{}]]></return_msg>
                  </xml>"""
-        logger.warning('receipt {} notify result is {}'.format(receipt.id, result))
-        if result.get('return_code') != 'SUCCESS' or result.get('result_code') != 'SUCCESS':
-            logger.debug('return_code or result_code not success')
-            return HttpResponse(content=xml.format('Fail', 'code not success'))
-        if result.get('total_fee') != int(receipt.amount * 100):
-            return HttpResponse(content=xml.format('Fail', 'fee not correct'))
-        if mp_pay_client.check_signature(result):
-            if not receipt.paid:
-                logger.debug('receipt {} transaction_id is {}'.format(receipt.id, result.get('transaction_id')))
-                receipt.set_paid(transaction_id=result.get('transaction_id'))
-        else:
-            logger.debug('check sign fail')
-
-        return HttpResponse(content=xml.format('SUCCESS', 'OK'))
+        # mp_pay_client = get_wechat_pay_notice_client()
+        data = xmltodict.parse(request.body).get('xml')
+        logger.warning(data)
+        from restframework_ext.pay_notify import get_notify_client, NotifyLedger, ST_DONE
+        ledger = NotifyLedger(data.get('transaction_id'))
+        st = ledger.begin()
+        if st == ST_DONE:
+            return HttpResponse(content=xml.format('SUCCESS', 'OK'))
+        elif st:
+            return HttpResponse(content=xml.format('Fail', 'processing'))
+        is_done = False
+        try:
+            mp_pay_client = get_notify_client(data.get('mch_id'))
+            result = mp_pay_client.parse_pay_result(request.body)
+            receipt = get_object_or_404(self.receipt_class, id=result.get('attach'))
+            logger.warning('get receipt obj {}'.format(receipt))
+            logger.warning('receipt {} notify result is {}'.format(receipt.id, result))
+            if result.get('return_code') != 'SUCCESS' or result.get('result_code') != 'SUCCESS':
+                logger.debug('return_code or result_code not success')
+                return HttpResponse(content=xml.format('Fail', 'code not success'))
+            if result.get('total_fee') != int(receipt.amount * 100):
+                return HttpResponse(content=xml.format('Fail', 'fee not correct'))
+            if mp_pay_client.check_signature(result):
+                if not receipt.paid:
+                    logger.debug('receipt {} transaction_id is {}'.format(receipt.id, result.get('transaction_id')))
+                    receipt.set_paid(transaction_id=result.get('transaction_id'))
+                is_done = True
+            else:
+                logger.debug('check sign fail')
+            return HttpResponse(content=xml.format('SUCCESS', 'OK'))
+        finally:
+            if is_done:
+                ledger.done()
+            else:
+                ledger.release()
 
     @action(methods=['get', 'post'], detail=False)
     def refund_notify(self, request):
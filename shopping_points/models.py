@@ -686,6 +686,34 @@ class UserCommissionChangeRecord(ChangeAddAbstract):
                                               total_award_amount=total_award_amount)
         return r
 
+    @classmethod
+    @atomic
+    def bulk_add_records(cls, items, source_type, status=STATUS_UNSETTLE, order=None):
+        """
+        同一订单的多条记录一次写入, 入账和统计同add_record
+        :param items: [(account, amount, desc)], account需要带上user
+        """
+        show_type = None
+        if order and order.session and order.session.show and order.session.show.show_type:
+            show_type = order.session.show.show_type
+        from common.utils import quantize
+        records = cls.objects.bulk_create(
+            [cls(source_type=source_type, amount=quantize(amount, 2), account=account, desc=desc, order=order,
+                 mobile=account.user.mobile, status=status, show_type=show_type) for account, amount, desc in items])
+        if records and status == cls.STATUS_CAN_WITHDRAW:
+            from caches import get_redis, commission_balance_key
+            with get_redis().pipeline(transaction=False) as pipe:
+                for r in records:
+                    pipe.lpush(commission_balance_key, r.account.get_commission_balance_val(r.amount, show_type))
+                pipe.execute()
+            from statistical.models import TotalStatistical
+            total = sum([r.amount for r in records])
+            TotalStatistical.change_award_stl(
+                share_award_amount=total if source_type == cls.SOURCE_TYPE_SHARE_AWARD else 0,
+                group_award_amount=total if source_type == cls.SOURCE_TYPE_GROUP else 0,
+                total_award_amount=total if source_type in cls.award_source_type() else 0)
+        return records
+
 
 class PointWithdraw(WithdrawAbstract, WithdrawActionMixin):
     @classmethod
@@ -0,0 +1,218 @@
+# coding: utf-8
+import logging
+import random
+import uuid
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Callable, Dict, List
+
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value
+from django.utils import timezone
+
+from caches import get_redis, get_pika_redis, get_redis_name
+
+log = logging.getLogger(__name__)
+
+"""
+计数器增量汇总(销量、实收、统计表等只做累加的字段):
+写入时按 id:字段 HINCRBY 到当前窗口hash, 金额按字段的小数位放大成整数, 同一个id多次写入在redis里直接合并.
+定时任务用lua把当前窗口改名为处理中窗口并分配批次号(uuid, 和窗口一起存在redis), 一次读出全部增量, 每张表每chunk_size个id一条
+UPDATE ... SET x = x + CASE WHEN id=.. THEN .. END, 不再限制每次处理的数量.
+批次号和更新在同一个数据库事务里写入DeltaBatch: 提交后、删除处理中窗口前崩溃的话,
+下次执行发现批次已处理, 直接删除窗口, 不会重复累加; 提交前崩溃则整个事务回滚, 下次重新处理同一个窗口.
+批次号不用自增序列, redis丢失序列(清空、主从切换)后不会和已处理的批次重复.
+DeltaBatch保留BATCH_KEEP_DAYS天.
+"""
+# KEYS[1]: 当前窗口, KEYS[2]: 处理中窗口, KEYS[3]: 处理中的批次号; ARGV[1]: 新批次号
+# 处理中窗口还在(上次没处理完)时沿用它的批次号
+SWAP_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    local batch = redis.call('GET', KEYS[3])
+    if not batch then
+        batch = ARGV[1]
+        redis.call('SET', KEYS[3], batch)
+    end
+    return batch
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('SET', KEYS[3], ARGV[1])
+return ARGV[1]
+"""
+BATCH_KEEP_DAYS = 7
+
+_swap_script = None
+_counters = dict()
+
+
+def get_swap_script():
+    global _swap_script
+    if not _swap_script:
+        _swap_script = get_redis().register_script(SWAP_LUA)
+    return _swap_script
+
+
+class DeltaCounter(object):
+    chunk_size = 500
+    # 每次任务最多处理的窗口数, 处理期间新写入的增量进入新窗口
+    max_batches = 20
+    lock_expire = 300
+
+    def __init__(self, name: str, model, fields: List[str], min_values: Dict = None, after_apply: Callable = None,
+                 legacy_key: str = None, legacy_pika: bool = False, legacy_parse: Callable = None):
+        """
+        fields: 累加的字段, 小数位取模型字段的decimal_places
+        min_values: {字段: 最小值}, 例如销量不能小于0
+        after_apply: after_apply(deltas) 和更新在同一个事务里执行, deltas为 {id: {字段: 增量}}
+        legacy_key: 旧版本lpush的列表, 处理前先转入窗口; legacy_parse(val)返回(id, {字段: 增量}),
+        默认格式为 id_字段1_字段2
+        """
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.places = dict()
+        for field in fields:
+            self.places[field] = getattr(model._meta.get_field(field), 'decimal_places', None) or 0
+        self.min_values = min_values or dict()
+        self.after_apply = after_apply
+        self.legacy_key = legacy_key
+        self.legacy_pika = legacy_pika
+        self.legacy_parse = legacy_parse or self.parse_legacy
+        self.window_key = get_redis_name('delta_{}'.format(name))
+        self.processing_key = get_redis_name('delta_{}_processing'.format(name))
+        self.batch_key = get_redis_name('delta_{}_batch'.format(name))
+        self.lock_key = get_redis_name('delta_{}_lock'.format(name))
+        _counters[name] = self
+
+    def to_int(self, field: str, value) -> int:
+        return int((Decimal(str(value)) * (10 ** self.places[field])).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    def from_int(self, field: str, value):
+        if not self.places[field]:
+            return int(value)
+        return Decimal(int(value)).scaleb(-self.places[field])
+
+    def incr(self, _id: int, **deltas):
+        self.incr_many([(_id, deltas)])
+
+    def incr_many(self, items: list):
+        """
+        items: [(id, {字段: 增量})]
+        """
+        with get_redis().pipeline(transaction=False) as pipe:
+            num = 0
+            for _id, deltas in items:
+                for field, value in deltas.items():
+                    scaled = self.to_int(field, value)
+                    if scaled:
+                        pipe.hincrby(self.window_key, '{}:{}'.format(_id, field), scaled)
+                        num += 1
+            if num:
+                pipe.execute()
+
+    def parse_legacy(self, val: str):
+        values = val.split('_')
+        return int(values[0]), dict(zip(self.fields, values[1:]))
+
+    def migrate_legacy(self):
+        """
+        旧版本写入列表的增量转入窗口
+        """
+        if not self.legacy_key:
+            return
+        client = get_pika_redis() if self.legacy_pika else get_redis()
+        while True:
+            # lpush只加在列表头部, 持有锁时取尾部再截掉是安全的
+            with client.pipeline(transaction=False) as pipe:
+                pipe.lrange(self.legacy_key, -self.chunk_size, -1)
+                pipe.ltrim(self.legacy_key, 0, -self.chunk_size - 1)
+                values, _ = pipe.execute()
+            if not values:
+                break
+            self.incr_many([self.legacy_parse(val) for val in values])
+
+    def backlog(self) -> int:
+        """
+        等待写入数据库的 id:字段 数量
+        """
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hlen(self.window_key)
+            pipe.hlen(self.processing_key)
+            return sum(pipe.execute())
+
+    def get_field_expr(self, field: str, deltas: dict, ids: list):
+        output_field = self.model._meta.get_field(field)
+        ids = [_id for _id in ids if deltas[_id].get(field)]
+        if not ids:
+            return None
+        if field not in self.min_values:
+            whens = [When(pk=_id, then=Value(deltas[_id][field], output_field=output_field)) for _id in ids]
+            return F(field) + Case(*whens, default=Value(0, output_field=output_field), output_field=output_field)
+        # 有最小值时先判断再加, 无符号字段不能先加成负数
+        min_value = self.min_values[field]
+        whens = []
+        for _id in ids:
+            delta = deltas[_id][field]
+            if delta < 0:
+                whens.append(When(Q(pk=_id) & Q(**{'{}__lt'.format(field): min_value - delta}),
+                                  then=Value(min_value, output_field=output_field)))
+            whens.append(When(pk=_id, then=F(field) + Value(delta, output_field=output_field)))
+        return Case(*whens, default=F(field), output_field=output_field)
+
+    def apply(self, deltas: dict):
+        ids = sorted(deltas.keys())
+        for i in range(0, len(ids), self.chunk_size):
+            chunk_ids = ids[i:i + self.chunk_size]
+            kwargs = dict()
+            for field in self.fields:
+                expr = self.get_field_expr(field, deltas, chunk_ids)
+                if expr is not None:
+                    kwargs[field] = expr
+            if kwargs:
+                self.model.objects.filter(pk__in=chunk_ids).update(**kwargs)
+
+    def drain(self) -> int:
+        """
+        返回本次更新的id数量
+        """
+        from statistical.models import DeltaBatch
+        redis = get_redis()
+        if not redis.set(self.lock_key, 1, nx=True, ex=self.lock_expire):
+            return 0
+        num = 0
+        try:
+            self.migrate_legacy()
+            for _ in range(self.max_batches):
+                batch = get_swap_script()(keys=[self.window_key, self.processing_key, self.batch_key],
+                                          args=[uuid.uuid4().hex], client=redis)
+                if batch is None:
+                    break
+                deltas = dict()
+                for key, value in redis.hgetall(self.processing_key).items():
+                    _id, field = key.split(':')
+                    deltas.setdefault(int(_id), dict())[field] = self.from_int(field, value)
+                if DeltaBatch.objects.filter(name=self.name, batch=batch).exists():
+                    log.warning('delta counter {} batch {} already applied'.format(self.name, batch))
+                else:
+                    with transaction.atomic():
+                        DeltaBatch.objects.create(name=self.name, batch=batch)
+                        self.apply(deltas)
+                        if self.after_apply:
+                            self.after_apply(deltas)
+                    num += len(deltas)
+                redis.delete(self.processing_key, self.batch_key)
+            if num and random.randint(1, 100) == 1:
+                DeltaBatch.objects.filter(name=self.name,
+                                          create_at__lt=timezone.now() - timedelta(days=BATCH_KEEP_DAYS)).delete()
+        finally:
+            redis.delete(self.lock_key)
+        if num:
+            log.info('delta counter {}: {}, backlog: {}'.format(self.name, num, self.backlog()))
+        return num
+
+
+def delta_backlog() -> dict:
+    return {name: counter.backlog() for name, counter in _counters.items()}
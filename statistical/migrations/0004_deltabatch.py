@@ -0,0 +1,27 @@
+# Generated by Django 3.0 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statistical', '0003_auto_20251022_1527'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeltaBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, verbose_name='计数器')),
+                ('batch', models.CharField(max_length=32, verbose_name='批次号')),
+                ('create_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='处理时间')),
+            ],
+            options={
+                'verbose_name': '计数器处理批次',
+                'verbose_name_plural': '计数器处理批次',
+                'unique_together': {('name', 'batch')},
+            },
+        ),
+    ]
@@ -2,12 +2,13 @@
 from __future__ import unicode_literals
 from django.db import models
 from django.utils import timezone
-from decimal import Decimal
 from express.models import Division
 import logging
 from django.db import close_old_connections
 
 from ticket.models import SessionInfo, TiktokUser
+from statistical.delta_counter import DeltaCounter
+from caches import city_order_sum, day_order_sum, month_order_sum, session_agent_sum_key, session_cps_sum_key
 from django.conf import settings
 from django.http import HttpResponse
 import xlwt
@@ -254,35 +255,12 @@ class CityStatistical(models.Model):
     @classmethod
     def change_order_sum(cls, city, num, amount):
         inst = cls.get_inst(city)
-        from caches import get_pika_redis, city_order_sum
-        with get_pika_redis() as redis:
-            redis.lpush(city_order_sum, '{}_{}_{}'.format(inst.id, num, float(amount)))
+        city_order_counter.incr(inst.id, order_num=num, total_amount=amount)
 
     @classmethod
     def task_add_order_sum(cls):
         close_old_connections()
-        from caches import get_pika_redis, city_order_sum
-        with get_pika_redis() as redis:
-            dd = redis.lindex(city_order_sum, 0)
-            total_list = dict()
-            i = 0
-            while dd and i < 200:
-                i += 1
-                dd = redis.rpop(city_order_sum)
-                if not dd:
-                    break
-                id, num, amount = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)]['order_num'] += int(num)
-                    total_list[str(id)]['total_amount'] += Decimal(amount)
-                else:
-                    total_list[str(id)] = dict(order_num=int(num), total_amount=Decimal(amount))
-            for key, data in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    self.order_num += data['order_num']
-                    self.total_amount += data['total_amount']
-                    self.save(update_fields=['order_num', 'total_amount'])
+        city_order_counter.drain()
 
 
 class DayStatistical(models.Model):
@@ -306,34 +284,12 @@ class DayStatistical(models.Model):
     @classmethod
     def change_order_sum(cls, create_at, num, amount):
         inst = cls.get_inst(create_at)
-        from caches import get_pika_redis, day_order_sum
-        with get_pika_redis() as redis:
-            redis.lpush(day_order_sum, '{}_{}_{}'.format(inst.id, num, float(amount)))
+        day_order_counter.incr(inst.id, order_num=num, total_amount=amount)
 
     @classmethod
     def task_add_order_sum(cls):
-        from caches import get_pika_redis, day_order_sum
-        with get_pika_redis() as redis:
-            dd = redis.lindex(day_order_sum, 0)
-            total_list = dict()
-            i = 0
-            while dd and i < 200:
-                i += 1
-                dd = redis.rpop(day_order_sum)
-                if not dd:
-                    break
-                id, num, amount = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)]['order_num'] += int(num)
-                    total_list[str(id)]['total_amount'] += Decimal(amount)
-                else:
-                    total_list[str(id)] = dict(order_num=int(num), total_amount=Decimal(amount))
-            for key, data in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    self.order_num += data['order_num']
-                    self.total_amount += data['total_amount']
-                    self.save(update_fields=['order_num', 'total_amount'])
+        close_old_connections()
+        day_order_counter.drain()
 
 
 class MonthSales(models.Model):
@@ -357,34 +313,12 @@ class MonthSales(models.Model):
     @classmethod
     def change_order_sum(cls, create_at, num, amount):
         inst = cls.get_inst(create_at)
-        from caches import get_pika_redis, month_order_sum
-        with get_pika_redis() as redis:
-            redis.lpush(month_order_sum, '{}_{}_{}'.format(inst.id, num, float(amount)))
+        month_order_counter.incr(inst.id, order_num=num, total_amount=amount)
 
     @classmethod
     def task_add_order_sum(cls):
-        from caches import get_pika_redis, month_order_sum
-        with get_pika_redis() as redis:
-            dd = redis.lindex(month_order_sum, 0)
-            total_list = dict()
-            i = 0
-            while dd and i < 200:
-                i += 1
-                dd = redis.rpop(month_order_sum)
-                if not dd:
-                    break
-                id, num, amount = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)]['order_num'] += int(num)
-                    total_list[str(id)]['total_amount'] += Decimal(amount)
-                else:
-                    total_list[str(id)] = dict(order_num=int(num), total_amount=Decimal(amount))
-            for key, data in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    self.order_num += data['order_num']
-                    self.total_amount += data['total_amount']
-                    self.save(update_fields=['order_num', 'total_amount'])
+        close_old_connections()
+        month_order_counter.drain()
 
 
 class SessionSum(models.Model):
@@ -448,38 +382,21 @@ class SessionAgentDaySum(models.Model):
 
     def change_amount(self, amount=0, c_amount=0):
         if amount != 0 or c_amount != 0:
-            from caches import get_pika_redis, session_agent_sum_key
-            with get_pika_redis() as redis:
-                redis.lpush(session_agent_sum_key,
-                            '{}_{}_{}'.format(self.id, float(amount), float(c_amount)))
+            session_agent_day_counter.incr(self.id, amount=amount, c_amount=c_amount)
 
     @classmethod
     def task_add_session_agent_day_sum(cls):
-        from caches import get_pika_redis, session_agent_sum_key
-        with get_pika_redis() as redis:
-            dd = redis.lindex(session_agent_sum_key, 0)
-            i = 0
-            total_list = dict()
-            while dd and i < 200:
-                i += 1
-                dd = redis.rpop(session_agent_sum_key)
-                if not dd:
-                    break
-                id, amount, c_amount = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)]['amount'] += Decimal(amount)
-                    total_list[str(id)]['c_amount'] += Decimal(c_amount)
-                else:
-                    total_list[str(id)] = dict(amount=Decimal(amount),
-                                               c_amount=Decimal(c_amount))
-            for key, data in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    self.c_amount += data['c_amount']
-                    self.amount += data['amount']
-                    self.save(update_fields=['c_amount', 'amount'])
-                    SessionAgentSum.change_record(self.session, data['amount'], data['c_amount'],
-                                                  self.agent)
+        close_old_connections()
+        session_agent_day_counter.drain()
+
+    @classmethod
+    def after_apply_amount(cls, deltas: dict):
+        """
+        同步累加到场次代理汇总, 和每日记录在同一个事务里
+        """
+        for inst in cls.objects.filter(id__in=list(deltas.keys())).select_related('session', 'agent'):
+            data = deltas[inst.id]
+            SessionAgentSum.change_record(inst.session, data.get('amount', 0), data.get('c_amount', 0), inst.agent)
 
     @classmethod
     def change_record(cls, session, agent, create_at, source_type, c_amount=0, amount=0):
@@ -516,36 +433,12 @@ class SessionCpsDaySum(models.Model):
 
     def change_cps_amount(self, amount=0, c_amount=0):
         if amount != 0 or c_amount != 0:
-            from caches import get_pika_redis, session_cps_sum_key
-            with get_pika_redis() as redis:
-                redis.lpush(session_cps_sum_key,
-                            '{}_{}_{}'.format(self.id, float(amount), float(c_amount)))
+            session_cps_day_counter.incr(self.id, amount=amount, c_amount=c_amount)
 
     @classmethod
     def task_add_session_cps_day_sum(cls):
-        from caches import get_pika_redis, session_cps_sum_key
-        with get_pika_redis() as redis:
-            dd = redis.lindex(session_cps_sum_key, 0)
-            total_list = dict()
-            i = 0
-            while dd and i < 200:
-                i += 1
-                dd = redis.rpop(session_cps_sum_key)
-                if not dd:
-                    break
-                id, amount, c_amount = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)]['amount'] += Decimal(amount)
-                    total_list[str(id)]['c_amount'] += Decimal(c_amount)
-                else:
-                    total_list[str(id)] = dict(amount=Decimal(amount),
-                                               c_amount=Decimal(c_amount))
-            for key, data in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    self.c_amount += data['c_amount']
-                    self.amount += data['amount']
-                    self.save(update_fields=['c_amount', 'amount'])
+        close_old_connections()
+        session_cps_day_counter.drain()
 
     @classmethod
     def change_cps_record(cls, session, tiktok_douyinid, tiktok_nickname, create_at, source_type, platform, c_amount=0,
@@ -567,3 +460,29 @@ class SessionCpsDaySum(models.Model):
 class SessionCpsRecord(models.Model):
     class Meta:
         verbose_name_plural = verbose_name = '达人销售查询'
+
+
+class DeltaBatch(models.Model):
+    name = models.CharField('计数器', max_length=50)
+    batch = models.CharField('批次号', max_length=32)
+    create_at = models.DateTimeField('处理时间', auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = verbose_name = '计数器处理批次'
+        unique_together = ['name', 'batch']
+
+    def __str__(self):
+        return '{}_{}'.format(self.name, self.batch)
+
+
+city_order_counter = DeltaCounter('city_order_sum', CityStatistical, ['order_num', 'total_amount'],
+                                  legacy_key=city_order_sum, legacy_pika=True)
+day_order_counter = DeltaCounter('day_order_sum', DayStatistical, ['order_num', 'total_amount'],
+                                 legacy_key=day_order_sum, legacy_pika=True)
+month_order_counter = DeltaCounter('month_order_sum', MonthSales, ['order_num', 'total_amount'],
+                                   legacy_key=month_order_sum, legacy_pika=True)
+session_agent_day_counter = DeltaCounter('session_agent_day_sum', SessionAgentDaySum, ['amount', 'c_amount'],
+                                         after_apply=SessionAgentDaySum.after_apply_amount,
+                                         legacy_key=session_agent_sum_key, legacy_pika=True)
+session_cps_day_counter = DeltaCounter('session_cps_day_sum', SessionCpsDaySum, ['amount', 'c_amount'],
+                                       legacy_key=session_cps_sum_key, legacy_pika=True)
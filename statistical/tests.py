@@ -0,0 +1,61 @@
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from caches.testing import FakeRedisTestCase
+
+
+class DeltaCounterTest(FakeRedisTestCase):
+    def setUp(self):
+        super(DeltaCounterTest, self).setUp()
+        from statistical.models import DayStatistical
+        self.days = [DayStatistical.objects.create(create_at=date(2030, 5, i), order_num=1) for i in (1, 2)]
+
+    def values(self):
+        from statistical.models import DayStatistical
+        return [DayStatistical.objects.filter(pk=inst.pk).values_list('order_num', 'total_amount')[0]
+                for inst in self.days]
+
+    def test_merge_and_drain(self):
+        from statistical.models import day_order_counter
+        a, b = [inst.pk for inst in self.days]
+        day_order_counter.incr(a, order_num=1, total_amount='10.05')
+        day_order_counter.incr_many([(a, dict(order_num=2, total_amount=0.1)), (b, dict(total_amount=-1))])
+        # 同一个id:字段在redis里合并
+        self.assertEqual(day_order_counter.backlog(), 3)
+        self.assertEqual(day_order_counter.drain(), 2)
+        self.assertEqual(self.values(), [(4, Decimal('10.15')), (1, Decimal('-1.00'))])
+        self.assertEqual(day_order_counter.backlog(), 0)
+        self.assertEqual(day_order_counter.drain(), 0)
+
+    def test_legacy_list(self):
+        from statistical.models import day_order_counter
+        a, b = [inst.pk for inst in self.days]
+        for val in ['{}_1_20.5'.format(a), '{}_1_3'.format(b), '{}_1_0.5'.format(a)]:
+            self.pika.lpush(day_order_counter.legacy_key, val)
+        day_order_counter.drain()
+        self.assertEqual(self.values(), [(3, Decimal('21.00')), (2, Decimal('3.00'))])
+        self.assertFalse(self.pika.exists(day_order_counter.legacy_key))
+
+    def test_applied_batch_not_repeated(self):
+        from statistical.delta_counter import get_swap_script
+        from statistical.models import DeltaBatch, day_order_counter
+        day_order_counter.incr(self.days[0].pk, order_num=5)
+        # 上次已提交, 删除处理中窗口前中断
+        keys = [day_order_counter.window_key, day_order_counter.processing_key, day_order_counter.batch_key]
+        batch = get_swap_script()(keys=keys, args=['b1'], client=self.redis)
+        DeltaBatch.objects.create(name=day_order_counter.name, batch=batch)
+        day_order_counter.incr(self.days[1].pk, order_num=2)
+        self.assertEqual(day_order_counter.drain(), 1)
+        self.assertEqual(self.values(), [(1, Decimal('0.00')), (3, Decimal('0.00'))])
+        self.assertFalse(self.redis.exists(*keys))
+
+    def test_min_value(self):
+        from statistical import delta_counter
+        from statistical.models import DayStatistical
+        with mock.patch.dict(delta_counter._counters):
+            counter = delta_counter.DeltaCounter('test_day_order', DayStatistical, ['order_num'],
+                                                 min_values=dict(order_num=0))
+            counter.incr_many([(self.days[0].pk, dict(order_num=-3)), (self.days[1].pk, dict(order_num=2))])
+            counter.drain()
+        self.assertEqual([order_num for order_num, _ in self.values()], [0, 3])
@@ -2663,7 +2663,7 @@ class MaiZuoTaskAdmin(ChangeAndViewAdmin):
 
 
 class DownLoadTaskAdmin(OnlyViewAdmin):
-    list_display = ['name', 'status', 'create_at', 'export_file']
+    list_display = ['name', 'status', 'progress', 'create_at', 'export_file']
 
 
 class MaiZuoLoginLogAdmin(ChangeAndViewAdmin):
@@ -0,0 +1,174 @@
+# coding: utf-8
+import asyncio
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from restframework_ext.exceptions import CustomAPIException
+
+log = logging.getLogger(__name__)
+
+"""
+无座下单的异步流程(main.py的noseat_order):
+1. auth: 异步读取token对应的用户
+2. validate: 参数校验, 异步读取场次、票档缓存(缓存没有时交给同步序列化器处理)
+3. reserve: 异步执行库存lua脚本预扣库存, 库存不足直接返回, 不占用数据库线程
+4. db: 只有数据库事务(TicketOrderOnSeatNewCreateSerializer)放到有上限的线程池执行, queue_wait为排队时间
+进行中的请求超过max_pending时直接拒绝; 数据库阶段失败时退回预扣的库存.
+"""
+REG_MOBILE = re.compile(r'^\d{11}$')
+
+
+class StageMetrics(object):
+    """
+    进程内各阶段耗时统计(ms)
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.rejected = 0
+        # queue_wait和db在线程池里记录
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, start: float) -> float:
+        now = time.time()
+        ms = (now - start) * 1000
+        with self._lock:
+            count, total, max_ms = self.stages.get(stage, (0, 0, 0))
+            self.stages[stage] = (count + 1, total + ms, max(max_ms, ms))
+        return now
+
+    def snapshot(self) -> dict:
+        return {stage: dict(count=count, avg_ms=round(total / count, 2), max_ms=round(max_ms, 2))
+                for stage, (count, total, max_ms) in self.stages.items()}
+
+
+class DjRequest:
+    def __init__(self, data, user, header, query_params):
+        self.data = data
+        self.user = user
+        self.META = header
+        self.query_params = query_params
+
+
+class NoSeatOrderPipeline(object):
+    def __init__(self, db_workers: int = 20, max_pending: int = 200):
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='noseat_order')
+        self.db_workers = db_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.metrics = StageMetrics()
+        self._batch_incr_script = None
+
+    def get_metrics(self) -> dict:
+        return dict(pending=self.pending, max_pending=self.max_pending, db_workers=self.db_workers,
+                    rejected=self.metrics.rejected, stages=self.metrics.snapshot())
+
+    async def validate(self, data: dict, user):
+        """
+        返回需要预扣的库存 [(level_id, -multiply, 0)], 缓存不完整时返回None, 由同步流程扣库存
+        """
+        from caches import cache_order_session_key, cache_order_seat_key
+        from caches.async_client import cache_get, cache_get_many
+        from ticket.models import SessionInfo
+        if user.forbid_order:
+            raise CustomAPIException('用户异常，请联系客服')
+        if not user.mobile:
+            raise CustomAPIException('请先绑定手机')
+        if not REG_MOBILE.match(str(data.get('mobile') or '')):
+            raise CustomAPIException('手机号格式不对')
+        ticket_list = data.get('ticket_list')
+        if not ticket_list or not isinstance(ticket_list, list):
+            raise CustomAPIException('下单错误，请重新选择下单')
+        try:
+            multiply_list = [int(level_data['multiply']) for level_data in ticket_list]
+            multiply = int(data.get('multiply'))
+        except (KeyError, TypeError, ValueError):
+            raise CustomAPIException('下单错误，请重新选择下单')
+        if sum(multiply_list) != multiply or min(multiply_list) <= 0:
+            raise CustomAPIException('购票数量错误，请重新选择')
+        session = await cache_get(cache_order_session_key.format(data.get('session_id')))
+        if not session:
+            return None
+        if not session.can_buy:
+            raise CustomAPIException('该场次已停止购买')
+        if session.has_seat == SessionInfo.SEAT_HAS:
+            raise CustomAPIException('下单错误，必须选择座位')
+        levels = await cache_get_many([cache_order_seat_key.format(level_data.get('level_id'), session.id)
+                                       for level_data in ticket_list])
+        if not all(levels):
+            return None
+        return [(level.id, -multiply, 0) for level, multiply in zip(levels, multiply_list) if not level.lock_stock]
+
+    async def batch_incr(self, inc_tuple: list) -> bool:
+        from concu.stock_cache import BATCH_INCR_LUA
+        from caches.async_client import get_async_stock_redis
+        from ticket.stock_updater import tfc
+        if not self._batch_incr_script:
+            self._batch_incr_script = get_async_stock_redis().register_script(BATCH_INCR_LUA)
+        keys, args = tfc.get_batch_incr_params(inc_tuple, record_update_ts=True)
+        ret = await self._batch_incr_script(keys=keys, args=args)
+        return bool(ret[0])
+
+    async def reserve(self, inc_tuple: list):
+        if inc_tuple and not await self.batch_incr(inc_tuple):
+            raise CustomAPIException('抢购失败,库存不足')
+
+    async def release(self, inc_tuple: list):
+        try:
+            await self.batch_incr([(_id, -increment, Ellipsis) for _id, increment, _ in inc_tuple])
+        except Exception as e:
+            log.error('noseat order release stock error: {}, {}'.format(inc_tuple, e))
+
+    def create_order(self, dj_request: DjRequest, reserved: bool, submit_at: float):
+        from ticket.order_serializer_new import TicketOrderOnSeatNewCreateSerializer
+        self.metrics.record('queue_wait', submit_at)
+        start = time.time()
+        data = dj_request.data
+        data['user'] = dj_request.user
+        s = TicketOrderOnSeatNewCreateSerializer(data=data, context={'request': dj_request,
+                                                                     'stock_reserved': reserved})
+        s._validated_data = dict()
+        s._errors = {}
+        s.is_valid(True)
+        order, payno, prepare_order, pay_end_at, ks_order_info, xhs_order_info = s.create(data)
+        self.metrics.record('db', start)
+        return dict(receipt_id=payno, prepare_order=prepare_order, pay_end_at=pay_end_at,
+                    order_id=order.order_no, ks_order_info=ks_order_info, xhs_order_info=xhs_order_info)
+
+    async def create(self, token: str, data: dict, headers, query_params) -> dict:
+        """
+        失败时抛出CustomAPIException
+        """
+        if self.pending >= self.max_pending:
+            self.metrics.rejected += 1
+            raise CustomAPIException('当前下单人数过多，请稍后再试', status_code=429)
+        self.pending += 1
+        begin = start = time.time()
+        inc_tuple = None
+        try:
+            from mall.user_cache import async_token_to_cache_user
+            user = await async_token_to_cache_user(token)
+            if not user:
+                raise CustomAPIException('请重新登陆', status_code=403)
+            start = self.metrics.record('auth', start)
+            inc_tuple = await self.validate(data, user)
+            start = self.metrics.record('validate', start)
+            if inc_tuple is not None:
+                await self.reserve(inc_tuple)
+                start = self.metrics.record('reserve', start)
+            dj_request = DjRequest(data, user, headers, query_params)
+            loop = asyncio.get_event_loop()
+            try:
+                ret = await loop.run_in_executor(self.executor, self.create_order, dj_request, inc_tuple is not None,
+                                                 start)
+            except Exception:
+                if inc_tuple:
+                    await self.release(inc_tuple)
+                raise
+            self.metrics.record('total', begin)
+            return ret
+        finally:
+            self.pending -= 1
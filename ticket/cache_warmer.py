@@ -0,0 +1,255 @@
+import json
+import logging
+from collections import defaultdict
+from typing import Callable, List
+
+from caches import get_pika_redis, get_redis_name
+
+log = logging.getLogger(__name__)
+
+"""
+pika缓存批量预热(ShowProject.init_all_cache):
+按数据类型分阶段, 每个阶段按主键分批加载(一批几条预取查询), 序列化后通过pipeline分批写入pika.
+每批完成后记录断点(阶段, 最后主键), 中断后重新执行从断点继续; 全部完成后删除断点.
+dry_run只序列化每个阶段的第一批, 按数量估算写入的命令数和数据大小.
+"""
+warm_cache_checkpoint_key = get_redis_name('warm_cache_checkpoint')
+STAGE_DONE = 'done'
+
+
+class PipelineWriter:
+    def __init__(self, pika, chunk_size: int = 500):
+        self._pika = pika
+        self._chunk_size = chunk_size
+        self._pipe = pika.pipeline(transaction=False)
+        self._pending = 0
+        self.commands = 0
+        self.bytes = 0
+
+    def _add(self, size: int):
+        self.commands += 1
+        self.bytes += size
+        self._pending += 1
+        if self._pending >= self._chunk_size:
+            self.flush()
+
+    def hset(self, name: str, key, value: str):
+        self._pipe.hset(name, str(key), value)
+        self._add(len(value))
+
+    def hdel(self, name: str, key):
+        self._pipe.hdel(name, str(key))
+        self._add(0)
+
+    def flush(self):
+        if self._pending:
+            self._pipe.execute()
+            self._pending = 0
+
+
+class DryRunWriter(PipelineWriter):
+    def __init__(self):
+        self._pending = 0
+        self._chunk_size = 0
+        self.commands = 0
+        self.bytes = 0
+
+    def hset(self, name: str, key, value: str):
+        self.commands += 1
+        self.bytes += len(value)
+
+    def hdel(self, name: str, key):
+        self.commands += 1
+
+    def flush(self):
+        pass
+
+
+class Stage:
+    def __init__(self, name: str, queryset_func: Callable, handler: Callable):
+        """
+        queryset_func: 返回按pk排序的queryset
+        handler: handler(objs, writer) 序列化一批数据并写入
+        """
+        self.name = name
+        self.queryset_func = queryset_func
+        self.handler = handler
+
+
+class ShowCacheWarmer:
+    def __init__(self, batch_size: int = 200, pipeline_size: int = 500, progress: Callable = None):
+        self.batch_size = batch_size
+        self.pipeline_size = pipeline_size
+        self.progress = progress or self.log_progress
+        self.stages = [
+            Stage('show_type', self.show_type_qs, self.write_show_types),
+            Stage('content_category', self.content_category_qs, self.write_content_categories),
+            Stage('venues', self.venues_qs, self.write_venues),
+            Stage('shows', self.shows_qs, self.write_shows),
+        ]
+
+    @staticmethod
+    def log_progress(stage: str, done: int, total: int):
+        log.info('warm cache {}: {}/{}'.format(stage, done, total))
+
+    @staticmethod
+    def show_type_qs():
+        from ticket.models import ShowType
+        return ShowType.objects.order_by('pk')
+
+    @staticmethod
+    def content_category_qs():
+        from ticket.models import ShowContentCategory
+        return ShowContentCategory.objects.order_by('pk')
+
+    @staticmethod
+    def venues_qs():
+        from ticket.models import Venues
+        return Venues.objects.select_related('cy_venue').order_by('pk')
+
+    @staticmethod
+    def shows_qs():
+        from ticket.models import ShowProject
+        return ShowProject.objects.filter(status=ShowProject.STATUS_ON).select_related('cy_show').order_by('pk')
+
+    @staticmethod
+    def write_show_types(objs: list, writer: PipelineWriter):
+        from caches import redis_show_type_copy_key
+        from ticket.serializers import ShowTypeSerializer
+        for inst, data in zip(objs, ShowTypeSerializer(objs, many=True).data):
+            writer.hset(redis_show_type_copy_key, inst.id, json.dumps(data))
+
+    @staticmethod
+    def write_content_categories(objs: list, writer: PipelineWriter):
+        from caches import redis_show_content_copy_key, redis_show_content_second_key
+        from ticket.models import ShowContentCategorySecond
+        from ticket.serializers import ShowContentCategorySerializer, ShowContentCategorySecondSerializer
+        for inst, data in zip(objs, ShowContentCategorySerializer(objs, many=True).data):
+            writer.hset(redis_show_content_copy_key, inst.id, json.dumps(data))
+        seconds = defaultdict(list)
+        qs = ShowContentCategorySecond.objects.filter(cate_id__in=[inst.id for inst in objs]).select_related(
+            'cate', 'show_type').order_by('display_order')
+        for inst in qs:
+            seconds[inst.cate_id].append(inst)
+        for cate_id, second_list in seconds.items():
+            show_type_list = ShowContentCategorySecondSerializer(second_list, many=True).data
+            writer.hset(redis_show_content_second_key, cate_id, json.dumps(dict(show_type_list=show_type_list)))
+
+    @staticmethod
+    def write_venues(objs: list, writer: PipelineWriter):
+        from caches import redis_venues_copy_key
+        for inst in objs:
+            writer.hset(redis_venues_copy_key, inst.id, json.dumps(inst.get_pika_data()))
+
+    @staticmethod
+    def write_shows(objs: list, writer: PipelineWriter):
+        """
+        一批项目: 详情图、须知、场次、票档各一次查询, 写项目详情、日期、场次列表、票档缓存
+        """
+        from caches import redis_shows_copy_key, redis_shows_no_key, redis_show_date_copy, redis_session_info_copy, \
+            redis_session_no_key
+        from ticket.models import ShowProject, SessionInfo, TicketFile, ShowsDetailImage, TicketWatchingNotice, \
+            TicketPurchaseNotice
+        show_ids = [inst.id for inst in objs]
+        images, watching, purchase, sessions = defaultdict(list), defaultdict(list), defaultdict(list), defaultdict(
+            list)
+        for img in ShowsDetailImage.objects.filter(show_id__in=show_ids):
+            images[img.show_id].append(img)
+        for notice in TicketWatchingNotice.objects.filter(show_id__in=show_ids):
+            watching[notice.show_id].append(notice)
+        for notice in TicketPurchaseNotice.objects.filter(show_id__in=show_ids):
+            purchase[notice.show_id].append(notice)
+        for session in SessionInfo.objects.filter(show_id__in=show_ids, status=SessionInfo.STATUS_ON,
+                                                  is_delete=False).order_by('show_id', 'start_at'):
+            sessions[session.show_id].append(session)
+        session_map = {session.id: session for session_list in sessions.values() for session in session_list}
+        levels = TicketFile.objects.filter(session_id__in=list(session_map.keys())).select_related(
+            'color', 'cy_tf').prefetch_related('cy_tf__ticket_pack_list')
+        for show in objs:
+            for session in sessions[show.id]:
+                session.show = show
+            writer.hset(redis_shows_no_key, show.no, str(show.id))
+            show_cache = show.get_detail_cache(images[show.id], watching[show.id], purchase[show.id])
+            writer.hset(redis_shows_copy_key, show.id, json.dumps(show_cache))
+            data_date, session_list = SessionInfo.get_show_session_cache(show, sessions[show.id])
+            writer.hset(redis_show_date_copy, show.id, json.dumps(data_date))
+            writer.hset(redis_session_info_copy, show.id, json.dumps(session_list))
+            for session in sessions[show.id]:
+                writer.hset(redis_session_no_key, session.no, str(session.id))
+        for level in levels:
+            level.session = session_map[level.session_id]
+            level.set_level_cache(writer)
+        if not isinstance(writer, DryRunWriter):
+            for show_id in show_ids:
+                ShowProject.delete_detail_doc(show_id)
+
+    def get_checkpoint(self) -> dict:
+        return get_pika_redis().hgetall(warm_cache_checkpoint_key)
+
+    def reset(self):
+        get_pika_redis().delete(warm_cache_checkpoint_key)
+
+    def iter_batches(self, qs, last_pk: int):
+        while True:
+            objs = list(qs.filter(pk__gt=last_pk)[:self.batch_size])
+            if not objs:
+                return
+            yield objs
+            last_pk = objs[-1].pk
+
+    def pre_cache_stock(self):
+        """
+        无座票档库存, 已有的不覆盖(未持久化的库存以缓存为准)
+        """
+        from ticket.stock_updater import tfc
+        from concu import get_redis
+        r = get_redis()
+        with r.pipeline(transaction=False) as pipe:
+            for i, sm in enumerate(tfc.load_list(), 1):
+                pipe.setnx(tfc.cache_key(sm.id), sm.stock)
+                if i % self.pipeline_size == 0:
+                    pipe.execute()
+            pipe.execute()
+
+    def run(self):
+        pika = get_pika_redis()
+        checkpoint = self.get_checkpoint()
+        if not checkpoint:
+            self.pre_cache_stock()
+        for stage in self.stages:
+            last = checkpoint.get(stage.name)
+            if last == STAGE_DONE:
+                continue
+            last_pk = int(last) if last else 0
+            qs = stage.queryset_func()
+            total = qs.count()
+            done = qs.filter(pk__lte=last_pk).count() if last_pk else 0
+            writer = PipelineWriter(pika, self.pipeline_size)
+            for objs in self.iter_batches(qs, last_pk):
+                stage.handler(objs, writer)
+                writer.flush()
+                pika.hset(warm_cache_checkpoint_key, stage.name, objs[-1].pk)
+                done += len(objs)
+                self.progress(stage.name, done, total)
+            pika.hset(warm_cache_checkpoint_key, stage.name, STAGE_DONE)
+        self.reset()
+        from caches.local_cache import l1_invalidate, FAMILIES
+        for key in FAMILIES.values():
+            l1_invalidate(key)
+
+    def estimate(self) -> List[dict]:
+        """
+        估算每个阶段写入pika的命令数和数据大小, 不写入
+        """
+        ret = []
+        for stage in self.stages:
+            qs = stage.queryset_func()
+            total = qs.count()
+            writer = DryRunWriter()
+            sample = list(qs[:self.batch_size])
+            if sample:
+                stage.handler(sample, writer)
+            rate = total / len(sample) if sample else 0
+            ret.append(dict(stage=stage.name, total=total, commands=int(writer.commands * rate),
+                            bytes=int(writer.bytes * rate)))
+        return ret
@@ -0,0 +1,172 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from caches import get_redis, cps_attribution_watermark_key, cps_attribution_lock_key
+from common.rate_limit import RateLimiter
+
+log = logging.getLogger(__name__)
+
+"""
+抖音订单带货场景归属(TicketOrder.check_cps_source_new):
+1. 只取水位之后付款、还未归属的订单: 水位为上次执行时仍未查到结果的最早付款时间(全部查到时为上次执行时间),
+   往前多取overlap秒, 最多往前2天
+2. 线程池并发调用query_cps, 所有线程共用一个限速器(每秒最多rate次)
+3. 结果整批写回: 订单bulk_update, 检票码按带货场景各一条UPDATE, 补差订单一次查询;
+   佣金统计和发奖励仍按订单执行
+client只需要实现 query_cps(order_no) -> (st, ret), 可以换成 StubCpsClient 在本地验证.
+配置(env.yml, 可选):
+cps_attribution:
+  workers: 8
+  rate: 20
+"""
+
+
+class StubCpsClient(object):
+    """
+    本地模拟抖音query_cps: latency秒延迟, cps_ratio比例的订单返回带货信息, error_ratio比例的请求失败
+    """
+
+    def __init__(self, latency: float = 0.2, cps_ratio: float = 0.3, error_ratio: float = 0):
+        self.latency = latency
+        self.cps_ratio = cps_ratio
+        self.error_ratio = error_ratio
+
+    def query_cps(self, out_order_no: str):
+        time.sleep(self.latency)
+        r = random.random()
+        if r < self.error_ratio:
+            return None
+        if r < self.error_ratio + self.cps_ratio:
+            item = dict(source_type=1, commission_user_douyinid='stub_{}'.format(out_order_no[-6:]),
+                        commission_user_nickname='stub', task_id='stub_task')
+            return True, dict(data=dict(error_code=0, cps_info=dict(cps_item_list=[item],
+                                                                    total_commission_amount=100)))
+        return True, dict(data=dict(error_code=0, cps_info=dict(cps_item_list=[])))
+
+
+class CpsAttribution(object):
+    workers = 8
+    rate = 20
+    overlap = 300
+    lock_expire = 600
+
+    def __init__(self, client=None, workers: int = None, rate: float = None, dry_run: bool = False):
+        from common.config import get_config
+        conf = get_config().get('cps_attribution') or dict()
+        if client is None:
+            from douyin import get_dou_yin
+            client = get_dou_yin()
+        self.client = client
+        self.workers = workers or conf.get('workers', self.workers)
+        self.limiter = RateLimiter(rate or conf.get('rate', self.rate))
+        self.dry_run = dry_run
+
+    def get_orders(self, now: datetime) -> list:
+        from ticket.models import TicketOrder
+        from mall.models import Receipt
+        start_at = now - timedelta(days=2)
+        watermark = get_redis().get(cps_attribution_watermark_key)
+        if watermark:
+            start_at = max(start_at, datetime.fromtimestamp(float(watermark) - self.overlap))
+        return list(TicketOrder.objects.filter(source_type=TicketOrder.SOURCE_DEFAULT, tiktok_order_id__isnull=False,
+                                               status__in=[TicketOrder.STATUS_PAID, TicketOrder.STATUS_FINISH],
+                                               pay_type=Receipt.PAY_TikTok_LP, pay_at__lt=now,
+                                               pay_at__gt=start_at).select_related('session'))
+
+    def query(self, order_no: str):
+        """
+        返回 (st, ret), 请求失败返回None, 下次重试
+        """
+        self.limiter.wait()
+        try:
+            return self.client.query_cps(order_no)
+        except Exception as e:
+            log.error('query cps error: {}, {}'.format(order_no, e))
+            return None
+
+    @staticmethod
+    def get_cps_item(result):
+        st, ret = result
+        if st and ret.get('data') and ret['data'].get('cps_info') and ret['data']['cps_info']['cps_item_list']:
+            return ret['data']['cps_info']['cps_item_list'][0], ret['data']['cps_info']['total_commission_amount']
+        return None, 0
+
+    def apply(self, orders: list, results: list) -> dict:
+        from ticket.models import TicketOrder, TicketUserCode, TiktokUser
+        cps_orders = []
+        no_cps_orders = []
+        for order, result in zip(orders, results):
+            if result is None:
+                continue
+            item, total_commission = self.get_cps_item(result)
+            if item:
+                order.source_type = item['source_type']
+                order.tiktok_douyinid = item['commission_user_douyinid']
+                order.tiktok_nickname = item['commission_user_nickname']
+                order.plan_id = item['task_id']
+                order.tiktok_commission_amount = total_commission / 100
+                cps_orders.append(order)
+            else:
+                # 非CPS订单或带货场景为空的订单按照目前的逻辑正常计算
+                order.source_type = TicketOrder.SOURCE_NO
+                no_cps_orders.append(order)
+        ret = dict(cps=len(cps_orders), no_cps=len(no_cps_orders))
+        if self.dry_run:
+            return ret
+        if cps_orders:
+            # CPS订单不发放任何奖励，并且不记录最新推荐人在订单中
+            TicketOrder.objects.bulk_update(cps_orders, ['source_type', 'tiktok_douyinid', 'tiktok_nickname',
+                                                         'plan_id', 'tiktok_commission_amount'], batch_size=200)
+        if no_cps_orders:
+            TicketOrder.objects.bulk_update(no_cps_orders, ['source_type'], batch_size=200)
+        source_orders = dict()
+        for order in cps_orders + no_cps_orders:
+            source_orders.setdefault(order.source_type, []).append(order.id)
+        for source_type, order_ids in source_orders.items():
+            TicketUserCode.objects.filter(order_id__in=order_ids).update(source_type=source_type)
+        for order in cps_orders:
+            try:
+                order.change_cps_agent_amount(order.source_type, order.tiktok_commission_amount, order.actual_amount,
+                                              TiktokUser.ST_DY)
+            except Exception as e:
+                log.error('cps agent amount error: {}, {}'.format(order.order_no, e))
+        if no_cps_orders:
+            # 订单和补差订单发奖励
+            margin_orders = list(TicketOrder.objects.filter(source_order_id__in=[order.id for order in no_cps_orders]))
+            for order in no_cps_orders + margin_orders:
+                try:
+                    order.send_award()
+                except Exception as e:
+                    log.error('cps send award error: {}, {}'.format(order.order_no, e))
+        return ret
+
+    def run(self) -> dict:
+        redis = get_redis()
+        if not self.dry_run and not redis.set(cps_attribution_lock_key, 1, nx=True, ex=self.lock_expire):
+            return dict()
+        try:
+            now = datetime.now()
+            start = time.time()
+            orders = self.get_orders(now)
+            if not orders:
+                if not self.dry_run:
+                    redis.set(cps_attribution_watermark_key, start)
+                return dict(orders=0)
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cps_attribution') as executor:
+                results = list(executor.map(self.query, [order.order_no for order in orders]))
+            query_cost = time.time() - start
+            ret = self.apply(orders, results)
+            failed = [order.pay_at for order, result in zip(orders, results) if result is None]
+            if not self.dry_run:
+                # 水位: 未查到结果的最早付款时间, 全部查到时为本次开始时间
+                redis.set(cps_attribution_watermark_key, time.mktime(min(failed).timetuple()) if failed else start)
+            ret.update(orders=len(orders), failed=len(failed), query_cost=round(query_cost, 3),
+                       cost=round(time.time() - start, 3))
+            log.info('cps attribution: {}'.format(ret))
+            return ret
+        finally:
+            if not self.dry_run:
+                redis.delete(cps_attribution_lock_key)
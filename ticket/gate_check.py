@@ -0,0 +1,432 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from caches import get_redis, gate_code_key, gate_order_key, gate_snapshot_key, gate_checked_key, gate_meta_key, \
+    gate_check_queue_key, gate_check_scheduled_key, gate_sessions_key
+
+log = logging.getLogger(__name__)
+
+"""
+入场验票(TicketUserCode.check_code/check_code_order):
+按扫码的场次编号(含关联主场次的子场次)预先加载未检票的检票码到redis:
+检票码 -> 订单ID|赠送ID|可验票开始时间|场次结束时间, 订单 -> 未赠送的检票码, 检票码 -> 展示快照.
+扫码时一个lua脚本完成校验和占用(HSETNX已检票hash), 同时把检票记录放入队列, 不访问数据库;
+子场次的码同时在自己和主场次的索引里, 已检票hash按主场次共用一个, 两边扫码不会重复占用;
+索引里没有的码(其他场次、加载后才出票、退款或赠送后移出的订单)返回None, 走原来的数据库验票.
+队列由异步任务批量写入数据库, 已检票hash保存了全部检票记录, 对账任务按它补写数据库.
+写库只更新未检票的码, 订单检票数按已检票的码重新统计, 重复执行结果不变.
+配置(env.yml, 可选):
+gate_check:
+  enable: true
+  preload_hours: 3  # 提前加载几小时内开演的场次
+"""
+MODE_CODE = 'code'
+MODE_ORDER = 'order'
+ST_OK = 'ok'
+ST_MISS = 'miss'
+ST_CHECKED = 'checked'
+ST_EARLY = 'early'
+ST_ENDED = 'ended'
+# KEYS: 检票码, 订单, 快照, 已检票, 检票记录队列; ARGV: 检票码, 当前时间戳, 模式, 验票员ID
+# 返回 {状态, 快照, 检票码...}: ok时为本次占用的码, early/ended时为本次应检的码
+CLAIM_LUA = """
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if not entry then
+    return {'miss', ''}
+end
+local snapshot = redis.call('HGET', KEYS[3], ARGV[1]) or ''
+if redis.call('HEXISTS', KEYS[4], ARGV[1]) == 1 then
+    return {'checked', snapshot}
+end
+local order_id, give_id, check_start, check_end = string.match(entry, '^(%d+)|(%d+)|(%d+)|(%d+)$')
+local codes = {ARGV[1]}
+if ARGV[3] == 'order' and give_id == '0' then
+    local members = redis.call('HGET', KEYS[2], order_id)
+    if members then
+        codes = {}
+        for c in string.gmatch(members, '[^,]+') do
+            table.insert(codes, c)
+        end
+    end
+end
+local now = tonumber(ARGV[2])
+local ret = {'ok', snapshot}
+if now < tonumber(check_start) then
+    ret[1] = 'early'
+elseif now >= tonumber(check_end) then
+    ret[1] = 'ended'
+end
+if ret[1] ~= 'ok' then
+    for _, c in ipairs(codes) do
+        table.insert(ret, c)
+    end
+    return ret
+end
+local value = order_id .. '|' .. ARGV[4] .. '|' .. ARGV[2]
+for _, c in ipairs(codes) do
+    if redis.call('HEXISTS', KEYS[1], c) == 1 and redis.call('HSETNX', KEYS[4], c, value) == 1 then
+        redis.call('RPUSH', KEYS[5], c .. '|' .. value)
+        table.insert(ret, c)
+    end
+end
+return ret
+"""
+
+_claim_script = None
+
+
+def get_claim_script():
+    global _claim_script
+    if not _claim_script:
+        _claim_script = get_redis().register_script(CLAIM_LUA)
+    return _claim_script
+
+
+def get_gate_config() -> dict:
+    from common.config import get_config
+    return get_config().get('gate_check') or dict()
+
+
+def to_ts(dt: datetime) -> int:
+    return int(time.mktime(dt.timetuple()))
+
+
+class GateCheckIndex(object):
+    load_lock_expire = 120
+    chunk_size = 2000
+
+    def __init__(self, session_no: str, queue_key: str = gate_check_queue_key):
+        self.session_no = str(session_no)
+        self.code_key = gate_code_key.format(self.session_no)
+        self.order_key = gate_order_key.format(self.session_no)
+        self.snapshot_key = gate_snapshot_key.format(self.session_no)
+        # 已检票hash所属的场次编号, 加载或确认已加载后才确定, 见get_checked_no
+        self.checked_no = self.session_no
+        self.meta_key = gate_meta_key.format(self.session_no)
+        self.lock_key = '{}_lock'.format(self.meta_key)
+        self.queue_key = queue_key
+
+    @property
+    def checked_key(self) -> str:
+        return gate_checked_key.format(self.checked_no)
+
+    def is_loaded(self) -> bool:
+        checked_no = get_redis().hget(self.meta_key, 'checked')
+        if checked_no:
+            self.checked_no = checked_no
+        return bool(checked_no)
+
+    def get_checked_no(self) -> str:
+        """
+        已检票hash所属的场次编号: 子场次用主场次的, 和主场次索引里的同一批码共用
+        """
+        from ticket.models import SessionInfo
+        main_no = SessionInfo.objects.filter(no=self.session_no).values_list('main_session__no', flat=True).first()
+        return main_no or self.session_no
+
+    def get_rows(self) -> (list, datetime):
+        """
+        返回 [(检票码, 订单ID, 赠送ID, 可验票开始时间戳, 结束时间戳, 快照)], 最晚结束时间
+        """
+        from django.db.models import Q
+        from ticket.models import SessionInfo, TicketUserCode
+        sessions = dict()
+        expire_at = None
+        for session in SessionInfo.objects.filter(Q(no=self.session_no) | Q(main_session__no=self.session_no)):
+            check_at = session.can_check_at or session.start_at.replace(hour=0, minute=0, second=0, microsecond=0)
+            sessions[session.id] = (to_ts(check_at), to_ts(session.end_at))
+            expire_at = max(expire_at, session.end_at) if expire_at else session.end_at
+        rows = []
+        if not sessions:
+            return rows, expire_at
+        qs = TicketUserCode.objects.filter(session_id__in=list(sessions.keys()), status=TicketUserCode.STATUS_DEFAULT,
+                                           code__isnull=False).order_by().values_list(
+            'code', 'order_id', 'give_id', 'session_id', 'snapshot', 'session_seat_id', 'session_seat__layers',
+            'order__title', 'order__start_at')
+        for code, order_id, give_id, session_id, snapshot, seat_id, layers, title, start_at in qs.iterator(
+                chunk_size=self.chunk_size):
+            snapshot = json.loads(snapshot) if snapshot else dict()
+            snapshot['title'] = title
+            snapshot['start_at'] = start_at.strftime('%Y-%m-%d %H:%M') if start_at else None
+            snapshot['layer'] = layers if seat_id else 0
+            if not seat_id:
+                snapshot['seat'] = '无座'
+            check_start, check_end = sessions[session_id]
+            rows.append((code, order_id, give_id, check_start, check_end, json.dumps(snapshot)))
+        return rows, expire_at
+
+    def write(self, rows: list, expire_at: datetime):
+        """
+        先写临时key再改名, 加载过程中扫码仍使用旧索引; 已检票hash不重建
+        """
+        redis = get_redis()
+        tmp_keys = ['{}_tmp'.format(key) for key in [self.code_key, self.order_key, self.snapshot_key]]
+        orders = dict()
+        with redis.pipeline(transaction=False) as pipe:
+            pipe.delete(*tmp_keys)
+            for i, (code, order_id, give_id, check_start, check_end, snapshot) in enumerate(rows, 1):
+                pipe.hset(tmp_keys[0], code, '{}|{}|{}|{}'.format(order_id, give_id, check_start, check_end))
+                pipe.hset(tmp_keys[2], code, snapshot)
+                if not give_id:
+                    orders.setdefault(order_id, []).append(code)
+                if i % self.chunk_size == 0:
+                    pipe.execute()
+            for i, (order_id, codes) in enumerate(orders.items(), 1):
+                pipe.hset(tmp_keys[1], order_id, ','.join(codes))
+                if i % self.chunk_size == 0:
+                    pipe.execute()
+            pipe.execute()
+        expire = max(int((expire_at - datetime.now()).total_seconds()), 0) + 86400 if expire_at else 86400
+        with redis.pipeline() as pipe:
+            for tmp_key, key, has_data in zip(tmp_keys, [self.code_key, self.order_key, self.snapshot_key],
+                                              [rows, orders, rows]):
+                if has_data:
+                    pipe.rename(tmp_key, key)
+                    pipe.expire(key, expire)
+                else:
+                    pipe.delete(key)
+            pipe.hset(self.meta_key, 'count', len(rows))
+            pipe.hset(self.meta_key, 'loaded_at', int(time.time()))
+            pipe.hset(self.meta_key, 'checked', self.checked_no)
+            pipe.expire(self.meta_key, expire)
+            # 已检票hash和主场次共用, 只延长不缩短
+            if redis.ttl(self.checked_key) < expire:
+                pipe.expire(self.checked_key, expire)
+            pipe.sadd(gate_sessions_key, self.session_no)
+            pipe.execute()
+
+    def load(self) -> int:
+        """
+        返回加载的检票码数量, 其他进程正在加载时返回-1
+        """
+        redis = get_redis()
+        if not redis.set(self.lock_key, 1, nx=True, ex=self.load_lock_expire):
+            return -1
+        try:
+            start = time.time()
+            self.checked_no = self.get_checked_no()
+            rows, expire_at = self.get_rows()
+            self.write(rows, expire_at)
+            log.info('gate index {} loaded: {}, {:.2f}s'.format(self.session_no, len(rows), time.time() - start))
+            return len(rows)
+        finally:
+            redis.delete(self.lock_key)
+
+    def ensure_loaded(self) -> bool:
+        return self.is_loaded() or self.load() >= 0
+
+    def claim(self, code: str, mode: str, account_id: int, now: int = None) -> (str, dict, list):
+        ret = get_claim_script()(keys=[self.code_key, self.order_key, self.snapshot_key, self.checked_key,
+                                       self.queue_key], args=[code, now or int(time.time()), mode, account_id],
+                                   client=get_redis())
+        snapshot = json.loads(ret[1]) if ret[1] else None
+        return ret[0], snapshot, ret[2:]
+
+    def drop_codes(self, order_id: int, codes: list):
+        """
+        订单退款、赠送后移出索引, 之后扫码走数据库验票
+        """
+        if codes:
+            with get_redis().pipeline(transaction=False) as pipe:
+                pipe.hdel(self.code_key, *codes)
+                pipe.hdel(self.snapshot_key, *codes)
+                pipe.hdel(self.order_key, order_id)
+                pipe.execute()
+
+    def delete(self):
+        redis = get_redis()
+        redis.delete(self.code_key, self.order_key, self.snapshot_key, self.meta_key)
+        if self.checked_no == self.session_no:
+            # 主场次的已检票hash由主场次的索引删除
+            redis.delete(self.checked_key)
+        redis.srem(gate_sessions_key, self.session_no)
+
+    def reconcile(self) -> int:
+        """
+        已检票hash里有, 数据库还是未检票的码重新写库(队列丢失或写库失败时), 返回补写的数量
+        """
+        from ticket.models import TicketUserCode
+        checked = get_redis().hgetall(self.checked_key)
+        codes = list(checked.keys())
+        entries = []
+        for i in range(0, len(codes), GateCheckRecorder.chunk_size):
+            chunk = codes[i:i + GateCheckRecorder.chunk_size]
+            for code in TicketUserCode.objects.filter(code__in=chunk, status=TicketUserCode.STATUS_DEFAULT).values_list(
+                    'code', flat=True):
+                entries.append(GateCheckRecorder.parse('{}|{}'.format(code, checked[code])))
+        if entries:
+            log.warning('gate index {} reconcile: {}'.format(self.session_no, len(entries)))
+            GateCheckRecorder.apply(entries)
+        return len(entries)
+
+
+class GateCheckRecorder(object):
+    """
+    检票记录批量写库
+    """
+    chunk_size = 500
+    lock_expire = 300
+    schedule_countdown = 2
+
+    @classmethod
+    def schedule(cls):
+        if get_redis().set(gate_check_scheduled_key, 1, nx=True, ex=cls.schedule_countdown * 5):
+            try:
+                from ticket.tasks import flush_gate_checks
+                flush_gate_checks.apply_async(countdown=cls.schedule_countdown)
+            except Exception as e:
+                # 定时任务兜底
+                log.error('schedule gate check flush error: {}'.format(e))
+
+    @staticmethod
+    def parse(val: str) -> tuple:
+        code, order_id, account_id, ts = val.split('|')
+        return code, int(order_id), int(account_id), int(ts)
+
+    @classmethod
+    def apply(cls, entries: list) -> int:
+        """
+        entries: [(检票码, 订单ID, 验票员ID, 检票时间戳)], 返回本次改为已检票的数量
+        """
+        from django.db import transaction
+        from django.db.models import Case, When, Value, Count, DateTimeField, IntegerField
+        from ticket.models import TicketUserCode, TicketOrder
+        num = 0
+        for i in range(0, len(entries), cls.chunk_size):
+            chunk = entries[i:i + cls.chunk_size]
+            order_ids = set([order_id for _, order_id, _, _ in chunk])
+            with transaction.atomic():
+                check_at = [When(code=code, then=Value(datetime.fromtimestamp(ts), output_field=DateTimeField()))
+                            for code, _, _, ts in chunk]
+                check_user = [When(code=code, then=Value(account_id, output_field=IntegerField()))
+                              for code, _, account_id, _ in chunk]
+                num += TicketUserCode.objects.filter(code__in=[entry[0] for entry in chunk],
+                                                     status=TicketUserCode.STATUS_DEFAULT).update(
+                    status=TicketUserCode.STATUS_CHECK,
+                    check_at=Case(*check_at, output_field=DateTimeField()),
+                    check_user_id=Case(*check_user, output_field=IntegerField()))
+                counts = dict(TicketUserCode.objects.filter(order_id__in=order_ids,
+                                                            status=TicketUserCode.STATUS_CHECK).order_by().values_list(
+                    'order_id').annotate(num=Count('id')))
+                orders = list(TicketOrder.objects.filter(id__in=order_ids).only('id', 'multiply', 'is_check_num'))
+                finish_ids = []
+                for order in orders:
+                    order.is_check_num = counts.get(order.id, 0)
+                    if order.is_check_num >= order.multiply:
+                        finish_ids.append(order.id)
+                TicketOrder.objects.bulk_update(orders, ['is_check_num'])
+                if finish_ids:
+                    TicketOrder.objects.filter(id__in=finish_ids).update(status=TicketOrder.STATUS_FINISH)
+        return num
+
+    @classmethod
+    def drain(cls, queue_key: str = gate_check_queue_key) -> int:
+        """
+        队列改名为处理中后写库, 写完再删除; 中途失败下次重新处理同一批, 写库可重复执行
+        """
+        redis = get_redis()
+        processing_key = '{}_processing'.format(queue_key)
+        lock_key = '{}_lock'.format(queue_key)
+        if not redis.set(lock_key, 1, nx=True, ex=cls.lock_expire):
+            return 0
+        num = 0
+        try:
+            redis.delete(gate_check_scheduled_key)
+            if not redis.exists(processing_key):
+                if not redis.exists(queue_key):
+                    return 0
+                # 只有持有锁的任务会删除队列, 存在就可以改名
+                redis.rename(queue_key, processing_key)
+            entries = [cls.parse(val) for val in redis.lrange(processing_key, 0, -1)]
+            num = cls.apply(entries)
+            redis.delete(processing_key)
+            log.info('gate check flush: {}/{}'.format(num, len(entries)))
+        finally:
+            redis.delete(lock_key)
+        return num
+
+
+def is_enabled() -> bool:
+    return bool(get_gate_config().get('enable'))
+
+
+def gate_scan(user, session_no: str, code: str, mode: str):
+    """
+    返回(状态, 快照, 检票码列表), 返回None时走数据库验票
+    """
+    if not is_enabled():
+        return None
+    try:
+        index = GateCheckIndex(session_no)
+        if not index.ensure_loaded():
+            return None
+        status, snapshot, codes = index.claim(code, mode, user.account.id)
+    except Exception as e:
+        log.error('gate scan error: {}, {}'.format(code, e))
+        return None
+    if status == ST_MISS:
+        return None
+    if status == ST_OK:
+        GateCheckRecorder.schedule()
+    return status, snapshot, codes
+
+
+def drop_order(order):
+    """
+    订单的检票码有变化(退款、赠送)时移出索引
+    """
+    if not is_enabled():
+        return
+    from ticket.models import TicketUserCode
+    try:
+        session = order.session
+        session_nos = [session.no]
+        if session.main_session_id:
+            session_nos.append(session.main_session.no)
+        codes = list(TicketUserCode.objects.filter(order_id=order.id, code__isnull=False).values_list('code',
+                                                                                                      flat=True))
+        for session_no in session_nos:
+            index = GateCheckIndex(session_no)
+            if index.is_loaded():
+                index.drop_codes(order.id, codes)
+    except Exception as e:
+        log.error('gate index drop order error: {}, {}'.format(order.id, e))
+
+
+def preload_indexes() -> int:
+    """
+    提前加载即将开演场次的验票索引
+    """
+    from ticket.models import SessionInfo
+    if not is_enabled():
+        return 0
+    now = datetime.now()
+    hours = get_gate_config().get('preload_hours', 3)
+    num = 0
+    for session_no in SessionInfo.objects.filter(status=SessionInfo.STATUS_ON, is_delete=False, end_at__gt=now,
+                                                 start_at__lte=now + timedelta(hours=hours)).values_list('no',
+                                                                                                         flat=True):
+        index = GateCheckIndex(session_no)
+        if not index.is_loaded() and index.load() >= 0:
+            num += 1
+    return num
+
+
+def reconcile_indexes() -> int:
+    """
+    对账已加载的验票索引, 过期的索引从列表移除
+    """
+    num = 0
+    reconciled = set()
+    for session_no in get_redis().smembers(gate_sessions_key):
+        index = GateCheckIndex(session_no)
+        if not index.is_loaded():
+            index.delete()
+            continue
+        # 主场次和子场次共用已检票hash, 只对账一次
+        if index.checked_key not in reconciled:
+            reconciled.add(index.checked_key)
+            num += index.reconcile()
+    return num
@@ -0,0 +1,82 @@
+# coding: utf-8
+import random
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'benchmark gate check-in: concurrent scanners claiming codes from a synthetic session index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seats', type=int, default=5000, help='检票码数量')
+        parser.add_argument('--order-size', type=int, default=2, help='每个订单的检票码数')
+        parser.add_argument('--scanners', type=int, default=50, help='并发扫码数')
+        parser.add_argument('--repeat', type=float, default=0.1, help='重复扫码的比例')
+        parser.add_argument('--mode', choices=['code', 'order'], default='code')
+
+    def handle(self, *args, **options):
+        from ticket.gate_check import GateCheckIndex, ST_OK, ST_CHECKED
+        from caches import get_redis, get_redis_name
+        # 独立的索引和队列, 不写数据库
+        session_no = 'bench_{}'.format(uuid.uuid4().hex[:8])
+        queue_key = get_redis_name('gate_check_queue_{}'.format(session_no))
+        index = GateCheckIndex(session_no, queue_key=queue_key)
+        now = int(time.time())
+        rows = []
+        for i in range(options['seats']):
+            rows.append(('{}'.format(200000000000 + i), i // options['order_size'] + 1, 0, now - 3600, now + 3600,
+                         '{"title": "bench", "seat": "1排1列"}'))
+        start = time.time()
+        index.write(rows, None)
+        self.stdout.write('index: {} codes, {:.2f}s'.format(len(rows), time.time() - start))
+        codes = [row[0] for row in rows]
+        scans = codes + random.sample(codes, int(len(codes) * options['repeat']))
+        random.shuffle(scans)
+        latencies = []
+        claimed = []
+        checked = [0]
+        lock = threading.Lock()
+
+        def scanner(items):
+            local_latencies = []
+            local_claimed = []
+            local_checked = 0
+            for code in items:
+                begin = time.time()
+                status, _, got = index.claim(code, options['mode'], 1)
+                local_latencies.append((time.time() - begin) * 1000)
+                if status == ST_OK:
+                    local_claimed.extend(got)
+                elif status == ST_CHECKED:
+                    local_checked += 1
+            with lock:
+                latencies.extend(local_latencies)
+                claimed.extend(local_claimed)
+                checked[0] += local_checked
+
+        scanners = options['scanners']
+        threads = [threading.Thread(target=scanner, args=(scans[i::scanners],)) for i in range(scanners)]
+        start = time.time()
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            cost = time.time() - start
+            latencies.sort()
+            queued = get_redis().llen(queue_key)
+        finally:
+            index.delete()
+            get_redis().delete(queue_key)
+        self.stdout.write('scans: {}, scanners: {}, cost: {:.2f}s, {:.0f} scans/s'.format(
+            len(scans), scanners, cost, len(scans) / cost if cost else 0))
+        self.stdout.write('latency ms: p50 {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+            latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)],
+            latencies[int(len(latencies) * 0.99)], latencies[-1]))
+        self.stdout.write('claimed: {} (unique {}), already checked: {}, queued: {}'.format(
+            len(claimed), len(set(claimed)), checked[0], queued))
+        if len(claimed) != len(set(claimed)) or len(set(claimed)) != len(codes) or queued != len(codes):
+            self.stderr.write('each code must be claimed and queued exactly once')
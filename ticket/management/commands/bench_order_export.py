@@ -0,0 +1,41 @@
+# coding: utf-8
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'benchmark TicketOrder export: time, queries and peak memory for the latest N orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num', type=int, nargs='+', default=[10000, 100000], help='导出的订单数')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每批加载的订单数')
+
+    def handle(self, *args, **options):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from ticket.models import TicketOrder
+        from ticket.order_export import TicketOrderExporter
+        for num in options['num']:
+            ids = list(TicketOrder.objects.order_by('-pk').values_list('id', flat=True)[:num])
+            exporter = TicketOrderExporter(ids)
+            exporter.chunk_size = options['chunk_size']
+            fd, filepath = tempfile.mkstemp(suffix='.xlsx')
+            os.close(fd)
+            tracemalloc.start()
+            start = time.time()
+            try:
+                with CaptureQueriesContext(connection) as ctx:
+                    rows = exporter.write(filepath)
+                cost = time.time() - start
+                _, peak = tracemalloc.get_traced_memory()
+                size = os.path.getsize(filepath)
+            finally:
+                tracemalloc.stop()
+                os.remove(filepath)
+            self.stdout.write('orders: {}, cost: {:.2f}s, {:.0f} rows/s, queries: {}, peak memory: {:.1f}MB, '
+                              'file: {:.1f}MB'.format(rows, cost, rows / cost if cost else 0, len(ctx.captured_queries),
+                                                      peak / 1024 / 1024, size / 1024 / 1024))
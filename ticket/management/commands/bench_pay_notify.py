@@ -0,0 +1,73 @@
+# coding: utf-8
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'benchmark replayed wechat pay notify callbacks against the transaction id ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callbacks', type=int, default=5000, help='重复回调数')
+        parser.add_argument('--threads', type=int, default=20)
+        parser.add_argument('--mch-id', default='bench')
+
+    def handle(self, *args, **options):
+        from django.db import connection
+        from django.test import RequestFactory
+        from django.test.utils import CaptureQueriesContext
+        from mall.views import ReceiptViewset
+        from restframework_ext.pay_notify import NotifyLedger
+        transaction_id = 'bench{}'.format(uuid.uuid4().hex)
+        body = ('<xml><return_code><![CDATA[SUCCESS]]></return_code><result_code><![CDATA[SUCCESS]]></result_code>'
+                '<mch_id><![CDATA[{}]]></mch_id><transaction_id><![CDATA[{}]]></transaction_id>'
+                '<attach><![CDATA[0]]></attach><total_fee>100</total_fee></xml>').format(options['mch_id'],
+                                                                                           transaction_id)
+        view = ReceiptViewset.as_view({'post': 'notify'})
+        factory = RequestFactory()
+        # 模拟第一次回调已经处理完成, 之后全部是微信的重试
+        ledger = NotifyLedger(transaction_id)
+        ledger.done()
+
+        def notify():
+            return view(factory.post('/notify', data=body, content_type='text/xml'))
+
+        try:
+            with CaptureQueriesContext(connection) as ctx:
+                resp = notify()
+            self.stdout.write('single replay: status {}, queries {}, body {}'.format(
+                resp.status_code, len(ctx.captured_queries), resp.content.decode().split()[1]))
+            latencies = []
+            failed = [0]
+            lock = threading.Lock()
+
+            def worker(num):
+                local = []
+                local_failed = 0
+                for _ in range(num):
+                    begin = time.time()
+                    resp = notify()
+                    local.append((time.time() - begin) * 1000)
+                    if b'SUCCESS' not in resp.content:
+                        local_failed += 1
+                with lock:
+                    latencies.extend(local)
+                    failed[0] += local_failed
+
+            threads = [threading.Thread(target=worker, args=(options['callbacks'] // options['threads'],))
+                       for _ in range(options['threads'])]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            cost = time.time() - start
+            latencies.sort()
+            self.stdout.write('replays: {}, threads: {}, cost {:.2f}s, {:.0f}/s, not SUCCESS: {}'.format(
+                len(latencies), options['threads'], cost, len(latencies) / cost if cost else 0, failed[0]))
+            self.stdout.write('latency ms: p50 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+                latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1]))
+        finally:
+            ledger.release()
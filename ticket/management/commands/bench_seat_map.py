@@ -0,0 +1,42 @@
+# coding: utf-8
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'benchmark seat map upload: re-ingest the current seat map of an off-shelf session and roll back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_id', type=int, help='已下架且设置过座位的场次')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from ticket.models import SessionInfo, SessionSeat
+        session = SessionInfo.objects.filter(id=options['session_id']).first()
+        if not session:
+            raise CommandError('场次不存在')
+        # 按当前座位图重新上传, 写入pika的数据与现有一致, 数据库改动回滚
+        data = [dict(ticket_level_id=ss.ticket_level_id, seat_no=ss.seats.seat_no, is_reserve=ss.is_reserve,
+                     box_no_special=ss.box_no_special, showRow=ss.showRow, showCol=ss.showCol, desc=ss.desc)
+                for ss in SessionSeat.objects.filter(session_id=session.id, ticket_level__isnull=False,
+                                                     seats__isnull=False).select_related('seats').order_by('pk')]
+        if not data:
+            raise CommandError('场次没有座位')
+        for i in range(options['repeat']):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.time()
+                try:
+                    with transaction.atomic():
+                        SessionSeat.create_record(data, session.cache_seat)
+                        cost = time.time() - start
+                        raise Rollback()
+                except Rollback:
+                    pass
+            self.stdout.write('seats: {}, cost: {:.3f}s, queries: {}'.format(len(data), cost, len(ctx.captured_queries)))
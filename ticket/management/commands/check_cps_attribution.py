@@ -0,0 +1,25 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'run douyin cps attribution once, optionally against a local stub client'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stub', action='store_true', help='使用本地模拟的query_cps')
+        parser.add_argument('--latency', type=float, default=0.2, help='模拟接口延迟(秒)')
+        parser.add_argument('--cps-ratio', type=float, default=0.3, help='模拟带货订单比例')
+        parser.add_argument('--error-ratio', type=float, default=0, help='模拟请求失败比例')
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--rate', type=float, default=None, help='每秒最多请求数')
+        parser.add_argument('--dry-run', action='store_true', help='只查询不写回, 不移动水位')
+
+    def handle(self, *args, **options):
+        from ticket.cps_attribution import CpsAttribution, StubCpsClient
+        client = None
+        if options['stub']:
+            client = StubCpsClient(latency=options['latency'], cps_ratio=options['cps_ratio'],
+                                   error_ratio=options['error_ratio'])
+        ret = CpsAttribution(client=client, workers=options['workers'], rate=options['rate'],
+                             dry_run=options['dry_run']).run()
+        self.stdout.write('{}'.format(ret))
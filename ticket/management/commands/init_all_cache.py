@@ -0,0 +1,39 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'warm up pika cache of shows, sessions and ticket levels'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只估算写入的命令数和数据大小')
+        parser.add_argument('--reset', action='store_true', help='忽略断点从头开始')
+        parser.add_argument('--batch-size', type=int, default=200, help='每批加载的数量')
+        parser.add_argument('--pipeline-size', type=int, default=500, help='每次pipeline提交的命令数')
+
+    def handle(self, *args, **options):
+        from functools import partial
+        from concu import set_redis_provider
+        from caches import get_redis_with_db
+        from ticket.cache_warmer import ShowCacheWarmer
+        set_redis_provider(partial(get_redis_with_db, db=3))
+
+        def progress(stage, done, total):
+            self.stdout.write('{}: {}/{}'.format(stage, done, total))
+
+        warmer = ShowCacheWarmer(batch_size=options['batch_size'], pipeline_size=options['pipeline_size'],
+                                 progress=progress)
+        if options['dry_run']:
+            total_bytes = 0
+            for row in warmer.estimate():
+                total_bytes += row['bytes']
+                self.stdout.write('{stage}: {total} rows, ~{commands} commands, ~{bytes} bytes'.format(**row))
+            self.stdout.write(self.style.SUCCESS('estimated total: ~{:.2f} MB'.format(total_bytes / 1024 / 1024)))
+            return
+        if options['reset']:
+            warmer.reset()
+        checkpoint = warmer.get_checkpoint()
+        if checkpoint:
+            self.stdout.write('resume from {}'.format(checkpoint))
+        warmer.run()
+        self.stdout.write(self.style.SUCCESS('Successfully warm up cache'))
@@ -0,0 +1,23 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'run show start sms notice once, optionally against a local fake sms provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['order', 'give'])
+        parser.add_argument('--fake', action='store_true', help='使用本地模拟的短信服务商')
+        parser.add_argument('--latency', type=float, default=0.1, help='模拟发送延迟(秒)')
+        parser.add_argument('--fail-ratio', type=float, default=0, help='模拟发送失败比例')
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--rate', type=float, default=None, help='每秒最多发送数')
+
+    def handle(self, *args, **options):
+        from ticket.show_notice import NoticeDispatcher, FakeSmsProvider
+        provider = None
+        if options['fake']:
+            provider = FakeSmsProvider(latency=options['latency'], fail_ratio=options['fail_ratio'])
+        ret = NoticeDispatcher(provider=provider, workers=options['workers'], rate=options['rate']).run(
+            options['kind'])
+        self.stdout.write('{}'.format(ret))
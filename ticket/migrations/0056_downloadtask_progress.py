@@ -0,0 +1,18 @@
+# Generated by Django 3.0 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticket', '0055_merge_20251119_1539'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadtask',
+            name='progress',
+            field=models.IntegerField(default=0, editable=False, verbose_name='进度(%)'),
+        ),
+    ]
@@ -15,7 +15,7 @@ from restframework_ext.exceptions import CustomAPIException
 from django.db.models import F
 from django.db import close_old_connections
 from datetime import timedelta
-from django.db.transaction import atomic
+from django.db.transaction import atomic, on_commit
 import os
 import json
 from common.utils import get_config, random_new_digits, hash_ids, group_by_str, random_str, get_timestamp, sha256_str
@@ -28,7 +28,10 @@ from common.utils import quantize
 from django.forms.models import model_to_dict
 from datetime import datetime
 import pysnooper
-from caches import get_pika_redis, get_redis_name, run_with_lock
+from caches import get_pika_redis, get_redis_name, run_with_lock, performer_key, session_actual_amount_key, \
+    level_sales_key
+from statistical.delta_counter import DeltaCounter
+from caches.due_work import DueWork
 from django.core.validators import validate_image_file_extension, FileExtensionValidator
 from restframework_ext.models import UseNoAbstract
 from django.db.models import Sum
@@ -210,6 +213,8 @@ class ShowContentCategory(models.Model):
             from ticket.serializers import ShowContentCategorySerializer
             data = ShowContentCategorySerializer(self).data
             pika.hset(redis_show_content_copy_key, str(self.id), json.dumps(data))
+        from caches.local_cache import l1_invalidate
+        l1_invalidate(redis_show_content_copy_key, self.id)
 
     def get_index_data(self, context):
         qs = ShowProject.objects.filter(cate_id=self.id, status=ShowProject.STATUS_ON).order_by('-display_order')
@@ -267,33 +272,13 @@ class ShowPerformer(models.Model):
         return ShowProject.objects.filter(performer=self, status=ShowProject.STATUS_ON).count()
 
     def set_focus_num(self, num=1):
-        from caches import get_redis, performer_key
-        redis = get_redis()
         if num:
-            redis.lpush(performer_key, '{}_{}'.format(self.id, int(num)))
+            performer_focus_counter.incr(self.id, focus_num=int(num))
 
     @classmethod
     def update_focus_num(cls):
-        from caches import get_redis, performer_key
-        redis = get_redis()
-        dd = redis.lindex(performer_key, 0)
-        total_list = dict()
-        i = 0
-        while dd and i < 200:
-            i += 1
-            dd = redis.rpop(performer_key)
-            if not dd:
-                break
-            id, num = dd.split('_')
-            if total_list.get(str(id)):
-                total_list[str(id)] += int(num)
-            else:
-                total_list[str(id)] = int(num)
-        for key, val in total_list.items():
-            self = cls.objects.filter(id=int(key)).first()
-            if self:
-                self.focus_num += val
-                self.save(update_fields=['focus_num'])
+        close_old_connections()
+        performer_focus_counter.drain()
 
 
 class ShowPerformerBanner(models.Model):
@@ -371,6 +356,8 @@ class ShowType(models.Model):
         data = ShowTypeSerializer(self).data
         with get_pika_redis() as pika:
             pika.hset(redis_show_type_copy_key, str(self.id), json.dumps(data))
+        from caches.local_cache import l1_invalidate
+        l1_invalidate(redis_show_type_copy_key, self.id)
         qs = ShowContentCategorySecond.objects.filter(show_type=self)
         for ss in qs:
             ss.show_content_second_copy_to_pika()
@@ -429,16 +416,22 @@ class Venues(UseNoAbstract):
     def __str__(self):
         return self.name
 
-    def venues_detail_copy_to_pika(self):
-        # log.debug('venues_detail_copy_to_pika')
-        from caches import get_pika_redis, redis_venues_copy_key
+    def get_pika_data(self):
         from ticket.serializers import VenuesSerializer
         data = VenuesSerializer(self).data
         data['price'] = float(data['price'])
         if hasattr(self, 'cy_venue'):
             data['cy_no'] = self.cy_venue.cy_no
+        return data
+
+    def venues_detail_copy_to_pika(self):
+        # log.debug('venues_detail_copy_to_pika')
+        from caches import get_pika_redis, redis_venues_copy_key
+        data = self.get_pika_data()
         with get_pika_redis() as pika:
             pika.hset(redis_venues_copy_key, str(self.id), json.dumps(data))
+        from caches.local_cache import l1_invalidate
+        l1_invalidate(redis_venues_copy_key, self.id)
 
 
 class VenuesLayers(models.Model):
@@ -688,8 +681,10 @@ class ShowProject(UseNoAbstract):
 
     def set_shows_no_pk(self):
         from caches import get_pika_redis, redis_shows_no_key
+        from caches.local_cache import l1_invalidate
         with get_pika_redis() as redis:
             redis.hset(redis_shows_no_key, self.no, self.id)
+        l1_invalidate(redis_shows_no_key, self.no)
 
     @classmethod
     def get_cache(cls, data: dict, show_id: int, user: User, is_tiktok: bool, is_ks: bool, is_xhs: bool = False):
@@ -704,58 +699,93 @@ class ShowProject(UseNoAbstract):
             'session_end_at') else None
         data['can_buy'] = data[
                               'status'] == ShowProject.STATUS_ON and sale_time <= now and session_end_at and session_end_at >= now
-        from caches import get_pika_redis, redis_show_date_copy, redis_session_info_copy, \
-            redis_session_info_tiktok_copy, redis_ticket_level_ks_cache, redis_ticket_level_xhs_cache, \
-            redis_ticket_level_cache, redis_ticket_level_tiktok_cache, redis_show_type_copy_key, \
-            redis_venues_copy_key, redis_show_content_copy_key, redis_session_info_ks_copy, redis_session_info_xhs_copy
+        from caches import get_pika_redis
         from ticket.stock_updater import tfc
+        doc_key = cls.get_detail_doc_key(show_id, is_tiktok, is_ks, is_xhs)
         with get_pika_redis() as pika:
-            data['show_type'] = json.loads(pika.hget(redis_show_type_copy_key, data['show_type']))
-            data['venues'] = json.loads(pika.hget(redis_venues_copy_key, data['venues']))
-            if data.get('cate'):
-                data['cate'] = json.loads(pika.hget(redis_show_content_copy_key, data['cate']))
-                data['cate'].pop('show_type_list', None)
-            date_data = pika.hget(redis_show_date_copy, show_id)
-            data['date'] = json.loads(date_data) if date_data else None
-            if is_tiktok:
-                session_data = pika.hget(redis_session_info_tiktok_copy, show_id)
-            elif is_ks:
-                session_data = pika.hget(redis_session_info_ks_copy, show_id)
-            elif is_xhs:
-                session_data = pika.hget(redis_session_info_xhs_copy, show_id)
+            doc = pika.get(doc_key)
+            if doc:
+                doc = json.loads(doc)
             else:
-                session_data = pika.hget(redis_session_info_copy, show_id)
-            data['sessions'] = json.loads(session_data) if session_data else []
-            if data['sessions']:
-                # log.debug(data['sessions'])
-                for session in data['sessions']:
-                    session['ticket_level'] = []
-                    if is_tiktok:
-                        name = redis_ticket_level_tiktok_cache.format(session['no'])
-                    elif is_ks:
-                        name = redis_ticket_level_ks_cache.format(session['no'])
-                    elif is_xhs:
-                        name = redis_ticket_level_xhs_cache.format(session['no'])
-                    else:
-                        name = redis_ticket_level_cache.format(session['no'])
-                    ticket_level_keys_list = pika.hkeys(name)
-                    # log.debug(ticket_level_keys_list)
-                    pack_list = []
-                    for key in ticket_level_keys_list:
-                        level = pika.hget(name, key)
-                        if level:
-                            level = json.loads(level)
-                            level['stock'] = tfc.get_stock(level['id'])
-                            if level.get('cy') and level['cy'].get('ticket_pack_list'):
-                                pack_list.append(level)
-                            else:
-                                session['ticket_level'].append(level)
-                    if session.get('ticket_level'):
-                        session['ticket_level'] = sorted(session['ticket_level'], key=lambda x: x['price'])
-                    if pack_list:
-                        session['ticket_level'] += sorted(pack_list, key=lambda x: x['price'])
+                doc = cls.build_detail_doc(pika, data, show_id, is_tiktok, is_ks, is_xhs)
+                pika.set(doc_key, json.dumps(doc), ex=cls.DETAIL_DOC_EXPIRE)
+        data.update(doc)
+        # 库存变化频繁不放进详情文档, 一次mget取全部票档库存
+        levels = [level for session in data['sessions'] for level in session['ticket_level']]
+        if levels:
+            for level, stock in zip(levels, tfc.get_stocks([level['id'] for level in levels])):
+                level['stock'] = stock
         return data
 
+    # 详情文档过期时间,兜底演出类型、场馆等修改后没有主动失效的情况
+    DETAIL_DOC_EXPIRE = 300
+
+    @classmethod
+    def get_detail_doc_key(cls, show_id: int, is_tiktok, is_ks, is_xhs):
+        from caches import redis_show_detail_doc_key
+        return redis_show_detail_doc_key.format(show_id, '{}{}{}'.format(int(is_tiktok), int(is_ks), int(is_xhs)))
+
+    @classmethod
+    def delete_detail_doc(cls, show_id: int):
+        # 场次、票档、项目缓存更新时删除详情文档
+        from caches import get_pika_redis
+        keys = [cls.get_detail_doc_key(show_id, *origin) for origin in
+                [(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1)]]
+        with get_pika_redis() as pika:
+            pika.delete(*keys)
+
+    @classmethod
+    def build_detail_doc(cls, pika, data: dict, show_id: int, is_tiktok: bool, is_ks: bool, is_xhs: bool):
+        """
+        组装演出详情里除库存外的部分,读pika用pipeline批量:
+        1.一次取演出类型、场馆、分类、日期、场次列表
+        2.一次取所有场次的票档hash
+        """
+        from caches import redis_show_date_copy, redis_session_info_copy, \
+            redis_session_info_tiktok_copy, redis_ticket_level_ks_cache, redis_ticket_level_xhs_cache, \
+            redis_ticket_level_cache, redis_ticket_level_tiktok_cache, redis_show_type_copy_key, \
+            redis_venues_copy_key, redis_show_content_copy_key, redis_session_info_ks_copy, redis_session_info_xhs_copy
+        if is_tiktok:
+            session_key, level_key = redis_session_info_tiktok_copy, redis_ticket_level_tiktok_cache
+        elif is_ks:
+            session_key, level_key = redis_session_info_ks_copy, redis_ticket_level_ks_cache
+        elif is_xhs:
+            session_key, level_key = redis_session_info_xhs_copy, redis_ticket_level_xhs_cache
+        else:
+            session_key, level_key = redis_session_info_copy, redis_ticket_level_cache
+        from caches.local_cache import l1_hget_json
+        doc = dict()
+        pipe = pika.pipeline(transaction=False)
+        pipe.hget(redis_show_date_copy, show_id)
+        pipe.hget(session_key, show_id)
+        date_data, session_data = pipe.execute()
+        doc['show_type'] = l1_hget_json(redis_show_type_copy_key, data['show_type'])
+        doc['venues'] = l1_hget_json(redis_venues_copy_key, data['venues'])
+        if data.get('cate'):
+            doc['cate'] = dict(l1_hget_json(redis_show_content_copy_key, data['cate']))
+            doc['cate'].pop('show_type_list', None)
+        doc['date'] = json.loads(date_data) if date_data else None
+        doc['sessions'] = json.loads(session_data) if session_data else []
+        if doc['sessions']:
+            pipe = pika.pipeline(transaction=False)
+            for session in doc['sessions']:
+                pipe.hgetall(level_key.format(session['no']))
+            for session, level_dict in zip(doc['sessions'], pipe.execute()):
+                session['ticket_level'] = []
+                pack_list = []
+                for level in level_dict.values():
+                    if level:
+                        level = json.loads(level)
+                        if level.get('cy') and level['cy'].get('ticket_pack_list'):
+                            pack_list.append(level)
+                        else:
+                            session['ticket_level'].append(level)
+                if session.get('ticket_level'):
+                    session['ticket_level'] = sorted(session['ticket_level'], key=lambda x: x['price'])
+                if pack_list:
+                    session['ticket_level'] += sorted(pack_list, key=lambda x: x['price'])
+        return doc
+
     @classmethod
     def init_all_cache(cls):
         from user_agents import parsers
@@ -764,33 +794,9 @@ class ShowProject(UseNoAbstract):
         from concu import set_redis_provider
         from caches import get_redis_with_db
         set_redis_provider(partial(get_redis_with_db, db=3))
-        from ticket.stock_updater import tfc
-        tfc.pre_cache()
-        st_qs = ShowType.objects.all()
-        for inst in st_qs:
-            inst.show_type_copy_to_pika()
-        cate_qs = ShowContentCategory.objects.all()
-        for inst in cate_qs:
-            inst.show_content_copy_to_pika()
-        s_cate_qs = ShowContentCategorySecond.objects.all()
-        for inst in s_cate_qs:
-            inst.show_content_second_copy_to_pika()
-        venues_qs = Venues.objects.all()
-        for inst in venues_qs:
-            inst.venues_detail_copy_to_pika()
-        shows_qs = cls.objects.filter(status=cls.STATUS_ON)
-        for inst in shows_qs:
-            session_qs = SessionInfo.objects.filter(show_id=inst.id, status=SessionInfo.STATUS_ON, is_delete=False)
-            if session_qs:
-                session = session_qs.first()
-                session.redis_show_date_copy()
-            for session in session_qs:
-                level_qs = TicketFile.objects.filter(session_id=session.id)
-                for level in level_qs:
-                    level.redis_ticket_level_cache()
-                    if level.status:
-                        level.redis_stock()
-            inst.shows_detail_copy_to_pika()
+        from ticket.cache_warmer import ShowCacheWarmer
+        # 分批预取+pipeline写入, 可断点续跑, 也可用 python manage.py init_all_cache
+        ShowCacheWarmer().run()
 
     def shows_detail_copy_to_pika(self):
         # log.debug('show_detail_init_or_delete')
@@ -800,103 +806,97 @@ class ShowProject(UseNoAbstract):
             # 下架删除，避免后面一直叠加
             redis.hdel(redis_shows_copy_key, str(self.id))
             redis.hdel(redis_shows_no_key, self.no)
+            from caches.local_cache import l1_invalidate
+            l1_invalidate(redis_shows_no_key, self.no)
         else:
             self.set_shows_no_pk()
-            from common.config import get_config
-            config = get_config()
-            domain = config.get('template_url')
-            show_dict = model_to_dict(self)
-            pop_list = ['no', 'title', 'lat', 'lng', 'content', 'display_order', 'is_test', 'status', 'cate',
-                        'venues', 'show_type', 'is_recommend', 'dy_show_date', 'source_type', 'use_schedule']
-            show_cache = dict()
-            for key in pop_list:
-                if show_dict.get(key):
-                    show_cache[key] = show_dict[key]
-            show_cache['id'] = self.no
-            show_cache['price'] = float(self.price)
-            show_cache['sale_time'] = datetime.strftime(self.sale_time, '%Y-%m-%dT%H:%M:%S')
-            show_cache['session_end_at'] = datetime.strftime(self.session_end_at,
-                                                             '%Y-%m-%dT%H:%M:%S') if self.session_end_at else None
-            show_cache['origin_amount'] = float(self.origin_amount)
-            show_cache['logo_mobile'] = '{}/{}'.format(domain, self.logo_mobile.url) if self.logo_mobile else None
-            # log.debug(show_cache)
-            image_data = []
-            qs = ShowsDetailImage.objects.filter(show_id=self.id)
-            if qs:
-                for img in qs:
-                    image_data.append(dict(id=img.id, image='{}/{}'.format(domain, img.image.url)))
-            show_cache['images'] = image_data if image_data else None
-            from common.utils import get_timestamp
-            show_cache['sale_time_timestamp'] = get_timestamp(self.sale_time) if self.sale_time else None
-            if hasattr(self, 'cy_show'):
-                show_cache['cy_no'] = self.cy_show.event_id
-            tw_qs = TicketWatchingNotice.objects.filter(show=self)
-            tp_qs = TicketPurchaseNotice.objects.filter(show=self)
-            from ticket.serializers import TicketWatchingNoticeSerializer, TicketPurchaseNoticeSerializer
-            show_cache['watching_notice'] = TicketWatchingNoticeSerializer(tw_qs, many=True).data
-            show_cache['purchase_notice'] = TicketPurchaseNoticeSerializer(tp_qs, many=True).data
+            show_cache = self.get_detail_cache()
             redis.hset(redis_shows_copy_key, str(self.id), json.dumps(show_cache))
+        self.delete_detail_doc(self.id)
+
+    def get_detail_cache(self, images: list = None, watching_notice: list = None, purchase_notice: list = None):
+        """
+        项目详情缓存数据, 批量预热时可传入预先批量查询的详情图和须知, 避免每个项目单独查询
+        """
+        from common.config import get_config
+        config = get_config()
+        domain = config.get('template_url')
+        show_dict = model_to_dict(self)
+        pop_list = ['no', 'title', 'lat', 'lng', 'content', 'display_order', 'is_test', 'status', 'cate',
+                    'venues', 'show_type', 'is_recommend', 'dy_show_date', 'source_type', 'use_schedule']
+        show_cache = dict()
+        for key in pop_list:
+            if show_dict.get(key):
+                show_cache[key] = show_dict[key]
+        show_cache['id'] = self.no
+        show_cache['price'] = float(self.price)
+        show_cache['sale_time'] = datetime.strftime(self.sale_time, '%Y-%m-%dT%H:%M:%S')
+        show_cache['session_end_at'] = datetime.strftime(self.session_end_at,
+                                                         '%Y-%m-%dT%H:%M:%S') if self.session_end_at else None
+        show_cache['origin_amount'] = float(self.origin_amount)
+        show_cache['logo_mobile'] = '{}/{}'.format(domain, self.logo_mobile.url) if self.logo_mobile else None
+        # log.debug(show_cache)
+        image_data = []
+        qs = images if images is not None else ShowsDetailImage.objects.filter(show_id=self.id)
+        if qs:
+            for img in qs:
+                image_data.append(dict(id=img.id, image='{}/{}'.format(domain, img.image.url)))
+        show_cache['images'] = image_data if image_data else None
+        from common.utils import get_timestamp
+        show_cache['sale_time_timestamp'] = get_timestamp(self.sale_time) if self.sale_time else None
+        if hasattr(self, 'cy_show'):
+            show_cache['cy_no'] = self.cy_show.event_id
+        tw_qs = watching_notice if watching_notice is not None else TicketWatchingNotice.objects.filter(show=self)
+        tp_qs = purchase_notice if purchase_notice is not None else TicketPurchaseNotice.objects.filter(show=self)
+        from ticket.serializers import TicketWatchingNoticeSerializer, TicketPurchaseNoticeSerializer
+        show_cache['watching_notice'] = TicketWatchingNoticeSerializer(tw_qs, many=True).data
+        show_cache['purchase_notice'] = TicketPurchaseNoticeSerializer(tp_qs, many=True).data
+        return show_cache
+
+    CALENDAR_INITED = 'inited'
 
     @classmethod
     def get_calendar_key(cls, year: int, month: int, city_id: int = 0):
-        from caches import pika_show_calendar_key
-        key = pika_show_calendar_key.format(city_id)
-        name = '{}_{}'.format(year, month)
-        tiktok_name = '{}_tiktok'.format(name)
-        ks_name = '{}_ks'.format(name)
-        xhs_name = '{}_xhs'.format(name)
-        return key, name, tiktok_name, ks_name, xhs_name
+        from caches import pika_show_calendar_index_key
+        return pika_show_calendar_index_key.format(city_id, year, month)
+
+    @classmethod
+    def rebuild_show_calendar(cls, year: int, month: int, city_id: int = 0):
+        """
+        按日期分组统计一个月的上架场次数, 重建日历索引
+        """
+        from common.dateutils import get_month_day
+        from django.db.models import Count
+        from django.db.models.functions import TruncDate
+        from caches import get_pika_redis
+        start_at, end_at = get_month_day(year, month, 1)
+        qs = SessionInfo.objects.filter(status=SessionInfo.STATUS_ON, start_at__gte=start_at, start_at__lt=end_at)
+        if city_id:
+            qs = qs.filter(show__city_id=city_id)
+        qs = qs.annotate(day=TruncDate('start_at')).values('day').order_by('day').annotate(num=Count('id'))
+        data = {row['day'].strftime('%Y-%m-%d'): row['num'] for row in qs}
+        key = cls.get_calendar_key(year, month, city_id)
+        with get_pika_redis().pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.hmset(key, dict(data, **{cls.CALENDAR_INITED: 1}))
+            pipe.execute()
+        return data
 
     @classmethod
     def get_show_calendar(cls, year: int, month: int, city_id: int = 0, is_tiktok=False, is_init=False, is_ks=False,
                           is_xhs=False):
-        # is_tiktok 和is_init不会同时是true
-        key, name, tiktok_name, ks_name, xhs_name = cls.get_calendar_key(year, month, city_id)
+        """
+        日历索引由SessionInfo.change_show_calendar增量维护, 读取只需一次hgetall, 没有索引或is_init时重建
+        抖音、快手、小红书的日历已停用, tiktok_data固定为None
+        """
         from caches import get_pika_redis
-        tiktok_data = None
-        with get_pika_redis() as pika:
-            # if is_tiktok:
-            #     data = pika.hget(key, tiktok_name)
-            # elif is_ks:
-            #     data = pika.hget(key, ks_name)
-            # elif is_xhs:
-            #     data = pika.hget(key, xhs_name)
-            # else:
-            data = pika.hget(key, name)
-            if not data or is_init:
-                from common.dateutils import get_month_day
-                start_at, end_at = get_month_day(year, month, 1)
-                qs = SessionInfo.objects.filter(status=SessionInfo.STATUS_ON, start_at__gte=start_at,
-                                                start_at__lt=end_at)
-                if city_id:
-                    qs = qs.filter(show__city_id=city_id)
-                data = dict()
-                for inst in qs:
-                    d_key = inst.start_at.strftime('%Y-%m-%d')
-                    data[d_key] = data[d_key] + 1 if data.get(d_key) else 1
-                if data:
-                    pika.hset(key, name, json.dumps(data))
-                # tiktok_qs = qs.filter(dy_status=SessionInfo.STATUS_ON)
-                # tiktok_data = dict()
-                # for inst in tiktok_qs:
-                #     d_key = inst.start_at.strftime('%Y-%m-%d')
-                #     tiktok_data[d_key] = tiktok_data[d_key] + 1 if tiktok_data.get(d_key) else 1
-                # if tiktok_data:
-                #     pika.hset(key, tiktok_name, json.dumps(tiktok_data))
-                # # 快手
-                # from kuaishou_wxa.models import KsGoodsConfig
-                # ks_data = KsGoodsConfig.ks_show_calendar(qs)
-                # if ks_data:
-                #     pika.hset(key, ks_name, json.dumps(ks_data))
-                # # 小红书
-                # from xiaohongshu.models import XhsGoodsConfig
-                # xhs_data = XhsGoodsConfig.xhs_show_calendar(qs)
-                # if xhs_data:
-                #     pika.hset(key, xhs_name, json.dumps(xhs_data))
-                is_init = True
-            else:
-                data = json.loads(data)
-        return data, tiktok_data, is_init
+        data = None if is_init else get_pika_redis().hgetall(cls.get_calendar_key(year, month, city_id))
+        if not data or cls.CALENDAR_INITED not in data:
+            # 没有inited说明只有增量没有全量, 需要重建
+            return cls.rebuild_show_calendar(year, month, city_id), None, True
+        data.pop(cls.CALENDAR_INITED)
+        data = {day: int(num) for day, num in data.items() if int(num) > 0}
+        return data, None, is_init
 
     def get_show_time(self):
         inst = SessionInfo.objects.filter(show=self).first()
@@ -909,18 +909,33 @@ class ShowProject(UseNoAbstract):
     @classmethod
     def auto_expire_off(cls):
         close_old_connections()
-        # 定时任务触发不了signal
-        qs = cls.objects.filter(status=cls.STATUS_ON, session_end_at__lte=timezone.now(), session_end_at__isnull=False)
-        for show in qs:
+        # 只处理登记过的到期项目和场次
+        show_off_work.run()
+        session_off_work.run()
+
+    def register_due_work(self):
+        if self.status == self.STATUS_ON and self.session_end_at:
+            show_off_work.register(self.id, self.session_end_at)
+
+    @classmethod
+    def expire_off_due(cls, ids: list) -> int:
+        """
+        场次全部结束的项目下架
+        """
+        shows = list(cls.objects.filter(id__in=ids, status=cls.STATUS_ON, session_end_at__lte=timezone.now()))
+        if not shows:
+            return 0
+        # update不触发signal, 缓存在下面更新
+        cls.objects.filter(id__in=[show.id for show in shows], status=cls.STATUS_ON).update(status=cls.STATUS_OFF)
+        for show in shows:
             show.status = cls.STATUS_OFF
-            show.save(update_fields=['status'])
             show.shows_detail_copy_to_pika()
-        qs_s = SessionInfo.objects.filter(status=SessionInfo.STATUS_ON, end_at__lte=timezone.now())
-        for inst in qs_s:
-            inst.status = SessionInfo.STATUS_OFF
-            inst.save(update_fields=['status'])
-            inst.change_show_calendar()
-            inst.redis_show_date_copy()
+        return len(shows)
+
+    @classmethod
+    def sweep_expire_off(cls):
+        return cls.objects.filter(status=cls.STATUS_ON, session_end_at__isnull=False).values_list('id',
+                                                                                                'session_end_at')
 
     def get_wxa_code(self):
         from mp.models import SystemWxMP
@@ -1209,27 +1224,87 @@ class SessionInfo(UseNoAbstract):
         # 是否动态码
         return self.is_dy_code and self.dc_expires_in > 0
 
-    def redis_show_date_copy(self):
-        # 场次发生更新时都需要变化
-        log.debug('redis_session_info_copy')
-        from caches import get_pika_redis, redis_show_date_copy, redis_session_info_copy, \
-            redis_session_info_tiktok_copy, redis_session_info_ks_copy, redis_session_info_xhs_copy, \
-            redis_session_no_key
-
-        inst = SessionInfo.objects.filter(show_id=self.show_id, status=self.STATUS_ON, is_delete=False).order_by(
-            'start_at').first()
-        create_at = self.show.create_at.strftime("%Y-%m-%dT%H:%M:%S")
+    @classmethod
+    def get_show_session_cache(cls, show, session_list: list):
+        """
+        项目的日期和场次列表缓存数据
+        session_list: 项目上架的场次,按start_at排序
+        """
+        from ticket.serializers import ShowSessionCacheSerializer
+        inst = session_list[0] if session_list else None
+        create_at = show.create_at.strftime("%Y-%m-%dT%H:%M:%S")
         data_date = dict(start_at=inst.start_at.strftime("%Y-%m-%dT%H:%M:%S"),
                          end_at=inst.end_at.strftime("%Y-%m-%dT%H:%M:%S")) if inst else dict(start_at=create_at,
                                                                                              end_at=create_at)
-        # 有排序，只能每次更改后一个场次后都排序重新写入
-        qs = SessionInfo.objects.filter(show_id=self.show.id, status=SessionInfo.STATUS_ON, is_delete=False).order_by(
-            'start_at')
-        qs_tiktok = qs.filter(dy_status=SessionInfo.STATUS_ON, push_status=SessionInfo.PUSH_SUCCESS).order_by(
+        return data_date, ShowSessionCacheSerializer(session_list, many=True).data
+
+    def register_due_work(self):
+        if self.status == self.STATUS_ON:
+            session_off_work.register(self.id, self.end_at)
+        session_auto_check_work.register(self.id, self.end_at)
+
+    @classmethod
+    def expire_off_due(cls, ids: list) -> int:
+        """
+        已结束的场次下架, 场次编号缓存一个pipeline删除, 项目缓存每个项目入队重建一次
+        """
+        from caches import redis_session_no_key
+        from caches.local_cache import l1_invalidate
+        from ticket.show_rebuild import ShowRebuildQueue
+        sessions = list(cls.objects.filter(id__in=ids, status=cls.STATUS_ON, end_at__lte=timezone.now()).select_related(
+            'show'))
+        if not sessions:
+            return 0
+        # update不触发signal, 日历和缓存在下面更新
+        cls.objects.filter(id__in=[session.id for session in sessions], status=cls.STATUS_ON).update(
+            status=cls.STATUS_OFF)
+        with get_pika_redis().pipeline(transaction=False) as pipe:
+            for session in sessions:
+                session.status = cls.STATUS_OFF
+                pipe.hdel(redis_session_no_key, session.no)
+            pipe.execute()
+        l1_invalidate(redis_session_no_key)
+        for session in sessions:
+            session.change_show_calendar()
+        for show_id in set([session.show_id for session in sessions if session.show_id]):
+            on_commit(lambda show_id=show_id: ShowRebuildQueue.enqueue(show_id, 'session_expire'))
+        return len(sessions)
+
+    @classmethod
+    def sweep_expire_off(cls):
+        return cls.objects.filter(status=cls.STATUS_ON).values_list('id', 'end_at')
+
+    def redis_show_date_copy(self, reason: str = 'session_change'):
+        # 场次发生更新时都需要变化
+        log.debug('redis_session_info_copy')
+        from caches import get_pika_redis, redis_session_no_key
+        with get_pika_redis() as pika:
+            if self.status == SessionInfo.STATUS_ON:
+                pika.hset(redis_session_no_key, self.no, self.id)
+            else:
+                pika.hdel(redis_session_no_key, self.no)
+        from caches.local_cache import l1_invalidate
+        l1_invalidate(redis_session_no_key, self.no)
+        # 场次列表有排序, 需整个项目重建, 放入队列合并同一项目短时间内的多次修改;
+        # 事务提交后再入队, 否则延迟重建可能读到提交前的数据
+        if self.show_id:
+            from ticket.show_rebuild import ShowRebuildQueue
+            show_id = self.show_id
+            on_commit(lambda: ShowRebuildQueue.enqueue(show_id, reason))
+
+    @classmethod
+    def redis_show_session_copy(cls, show):
+        """
+        重建项目的场次列表缓存和所有场次的票档缓存
+        """
+        from caches import get_pika_redis, redis_show_date_copy, redis_session_info_copy, \
+            redis_session_info_tiktok_copy, redis_session_info_ks_copy, redis_session_info_xhs_copy
+        qs = SessionInfo.objects.filter(show_id=show.id, status=SessionInfo.STATUS_ON, is_delete=False).order_by(
             'start_at')
-        from ticket.serializers import ShowSessionCacheSerializer
-        session_list = ShowSessionCacheSerializer(qs, many=True).data
+        data_date, session_list = cls.get_show_session_cache(show, list(qs))
         session_tiktok_list = session_ks_list = session_xhs_list = None
+        # qs_tiktok = qs.filter(dy_status=SessionInfo.STATUS_ON, push_status=SessionInfo.PUSH_SUCCESS).order_by(
+        #     'start_at')
         # session_tiktok_list = ShowSessionCacheSerializer(qs_tiktok, many=True).data
         # from kuaishou_wxa.models import KsGoodsConfig
         # qs_ks = KsGoodsConfig.get_session_qs(qs).order_by('start_at')
@@ -1237,34 +1312,23 @@ class SessionInfo(UseNoAbstract):
         # from xiaohongshu.models import XhsGoodsConfig
         # xhs_ks = XhsGoodsConfig.get_session_qs(qs).order_by('start_at')
         # session_xhs_list = ShowSessionCacheSerializer(xhs_ks, many=True).data
-        with get_pika_redis() as pika:
-            if self.status == SessionInfo.STATUS_ON:
-                pika.hset(redis_session_no_key, self.no, self.id)
-            else:
-                pika.hdel(redis_session_no_key, self.no)
-            pika.hset(redis_show_date_copy, str(self.show_id), json.dumps(data_date))
-            pika.hset(redis_session_info_copy, str(self.show_id), json.dumps(session_list))
-            if session_tiktok_list:
-                pika.hset(redis_session_info_tiktok_copy, str(self.show_id), json.dumps(session_tiktok_list))
-            else:
-                pika.hdel(redis_session_info_tiktok_copy, str(self.show_id))
-            if session_ks_list:
-                pika.hset(redis_session_info_ks_copy, str(self.show_id), json.dumps(session_ks_list))
-            else:
-                pika.hdel(redis_session_info_ks_copy, str(self.show_id))
-            if session_xhs_list:
-                pika.hset(redis_session_info_xhs_copy, str(self.show_id), json.dumps(session_xhs_list))
-            else:
-                pika.hdel(redis_session_info_xhs_copy, str(self.show_id))
-        tf_qs = TicketFile.objects.filter(session_id=self.id)
-        # 更改票档缓存
-        if tf_qs:
-            if self.status == self.STATUS_OFF:
-                for level in tf_qs:
-                    level.redis_ticket_level_cache(is_create=False)
-            else:
-                for level in tf_qs:
-                    level.redis_ticket_level_cache()
+        show_id = str(show.id)
+        with get_pika_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(redis_show_date_copy, show_id, json.dumps(data_date))
+            pipe.hset(redis_session_info_copy, show_id, json.dumps(session_list))
+            for name, data in [(redis_session_info_tiktok_copy, session_tiktok_list),
+                               (redis_session_info_ks_copy, session_ks_list),
+                               (redis_session_info_xhs_copy, session_xhs_list)]:
+                if data:
+                    pipe.hset(name, show_id, json.dumps(data))
+                else:
+                    pipe.hdel(name, show_id)
+            # 更改票档缓存, 下架场次的票档删除
+            tf_qs = TicketFile.objects.filter(session__show_id=show.id).select_related('session', 'color', 'cy_tf')
+            for level in tf_qs:
+                level.set_level_cache(pipe, is_create=level.session.status != cls.STATUS_OFF)
+            pipe.execute()
+        ShowProject.delete_detail_doc(show.id)
 
     @property
     def express_end_at(self):
@@ -1286,44 +1350,62 @@ class SessionInfo(UseNoAbstract):
         """
         更改实收
         """
-        from caches import get_redis, session_actual_amount_key
-        redis = get_redis()
-        redis.lpush(session_actual_amount_key, json.dumps([self.id, float(amount)]))
-
-    def change_show_calendar(self):
-        year = self.start_at.year
-        month = self.start_at.month
-        city_id = self.show.city_id
-        ShowProject.get_show_calendar(year, month, city_id, is_init=True)
-        # 全国也要初始化一次
-        if city_id:
-            ShowProject.get_show_calendar(year, month, 0, is_init=True)
+        session_actual_amount_counter.incr(self.id, actual_amount=amount)
+
+    def get_calendar_member(self):
+        """
+        场次在日历中计数的位置: 城市_日期, 未上架为空
+        """
+        if self.status != self.STATUS_ON:
+            return ''
+        return '{}_{}'.format(self.show.city_id or 0, self.start_at.strftime('%Y-%m-%d'))
+
+    def change_show_calendar(self, old_start_at=None):
+        """
+        状态或开始时间变化后调用, 旧位置-1, 新位置+1(城市和全国各一次)
+        :param old_start_at 修改开始时间时传入修改前的时间, 没有记录过位置时用来重建旧月份
+        读旧位置和加减计数要一起完成, 否则同一场次并发修改会重复计数或减成负数;
+        日历在pika上不能用lua, 按场次加锁(redis)串行执行
+        """
+        from caches import run_with_lock, get_redis_name
+        with run_with_lock(get_redis_name('show_calendar_lock_{}'.format(self.id)), 5, 5) as got:
+            if not got:
+                log.error('change show calendar lock fail: {}'.format(self.id))
+                return
+            self._change_show_calendar(old_start_at)
+
+    def _change_show_calendar(self, old_start_at=None):
+        from caches import get_pika_redis, pika_show_calendar_session_key
+        pika = get_pika_redis()
+        member = self.get_calendar_member()
+        old_member = pika.hget(pika_show_calendar_session_key, self.id)
+        if old_member is None:
+            # 没有记录过位置(新场次或历史场次), 无法计算差值, 重建所在月份, 改过开始时间的旧月份也要重建
+            city_id = self.show.city_id or 0
+            months = {(dt.year, dt.month) for dt in [self.start_at, old_start_at] if dt}
+            for year, month in months:
+                # 全国也要初始化一次
+                for c_id in {city_id, 0}:
+                    ShowProject.rebuild_show_calendar(year, month, c_id)
+            pika.hset(pika_show_calendar_session_key, self.id, member)
+            return
+        if old_member == member:
+            return
+        with pika.pipeline(transaction=False) as pipe:
+            for mb, delta in [(old_member, -1), (member, 1)]:
+                if not mb:
+                    continue
+                city_id, day = mb.split('_')
+                year, month = int(day[:4]), int(day[5:7])
+                for c_id in {int(city_id), 0}:
+                    pipe.hincrby(ShowProject.get_calendar_key(year, month, c_id), day, delta)
+            pipe.hset(pika_show_calendar_session_key, self.id, member)
+            pipe.execute()
 
     @classmethod
     def task_add_actual_amount(cls):
-        from caches import get_redis, session_actual_amount_key
-        redis = get_redis()
-        amount_list = redis.lrange(session_actual_amount_key, 0, -1)
-        if amount_list:
-            data_dict = dict()
-            for value in amount_list:
-                val = redis.rpop(session_actual_amount_key)
-                if val:
-                    val = json.loads(val)
-                    session_id = val[0]
-                    amount = Decimal(val[1])
-                    key = str(session_id)
-                    if data_dict.get(key):
-                        data_dict[key] += amount
-                    else:
-                        data_dict[key] = amount
-            if data_dict:
-                for key, value in data_dict.items():
-                    session_id = int(key)
-                    session = cls.objects.filter(id=session_id).first()
-                    if session:
-                        session.actual_amount += Decimal(value)
-                        session.save(update_fields=['actual_amount'])
+        close_old_connections()
+        session_actual_amount_counter.drain()
 
     def set_delete(self, is_delete):
         self.is_delete = is_delete
@@ -1527,12 +1609,13 @@ class SessionInfo(UseNoAbstract):
         return product_id
 
     def update_start_at_and_end_at(self, start_at, end_at):
+        old_start_at = self.start_at
         self.start_at = start_at
         self.end_at = end_at
         self.venue_id = self.show.venues.id
         self.save(update_fields=['start_at', 'end_at', 'venue_id'])
         # 复制场次初始化
-        self.change_show_calendar()
+        self.change_show_calendar(old_start_at)
         # if valid_start_time:
         #     session.valid_start_time = valid_start_time
         #     fields.append('valid_start_time')
@@ -1543,7 +1626,7 @@ class SessionInfo(UseNoAbstract):
     @atomic
     def layer_session(self, level_dict=None):
         from django.forms.models import model_to_dict
-        from caches import get_pika_redis, pika_session_seat_list_key, pika_session_seat_key, pika_level_seat_key
+        from caches import get_pika_redis, pika_session_seat_key, pika_level_seat_key
         pika = get_pika_redis()
         session = self
         ticket_levels = TicketFile.objects.filter(session_id=session.id)
@@ -1567,7 +1650,6 @@ class SessionInfo(UseNoAbstract):
         # session_dict['create_at'] = timezone.now()
         ss = SessionInfo.objects.create(**session_dict)
         session_inst = ss
-        session_seat_list_key = pika_session_seat_list_key.format(ss.id)
         seat_list = []
         pika_list = []
         if ticket_levels:
@@ -1618,7 +1700,7 @@ class SessionInfo(UseNoAbstract):
                     i += 1
             if pika_list:
                 # clogger.debug(pika_list)
-                pika.set(session_seat_list_key, json.dumps(pika_list))
+                SessionSeat.set_seat_map(pika, ss.id, pika_list)
             if seat_list:
                 SessionSeat.objects.bulk_create(seat_list)
         return True, None, session_inst
@@ -2078,7 +2160,7 @@ class SessionChangeRecord(models.Model):
             inst.save(update_fields=fields_s)
             session.save(update_fields=fields)
             if new_start_at:
-                session.change_show_calendar()
+                session.change_show_calendar(inst.old_start_at)
         return st, msg
 
 
@@ -2166,49 +2248,61 @@ class TicketFile(models.Model):
         from ticket.stock_updater import tfc
         tfc.persist()
 
+    def get_level_cache_json(self):
+        # 票档缓存数据, 批量预热时color、cy_tf、ticket_pack_list可先select_related/prefetch_related
+        from ticket.serializers import TicketFileCacheSerializer
+        data = TicketFileCacheSerializer(self).data
+        data['origin_price'] = float(data['origin_price'])
+        data['price'] = float(data['price'])
+        if self.is_cy:
+            tp_qs = self.cy_tf.ticket_pack_list.all()
+            ticket_pack_list = []
+            if tp_qs:
+                from caiyicloud.serializers import CyTicketPackSerializer
+                ticket_pack_list = CyTicketPackSerializer(tp_qs, many=True).data
+            data['cy'] = dict(no=self.cy_tf.cy_no, category=self.cy_tf.category,
+                              ticket_pack_list=ticket_pack_list)
+        return json.dumps(data)
+
     def redis_ticket_level_cache(self, is_create=True):
         # 创建和修改的时候触发
         # log.debug('redis_ticket_level_cache')
-        from caches import get_pika_redis, redis_ticket_level_cache, redis_ticket_level_tiktok_cache, \
+        from caches import get_pika_redis
+        with get_pika_redis() as pika:
+            self.set_level_cache(pika, is_create)
+        ShowProject.delete_detail_doc(self.session.show_id)
+
+    def set_level_cache(self, pika, is_create=True):
+        """
+        pika可以是pipeline, 批量写入时使用
+        """
+        from caches import redis_ticket_level_cache, redis_ticket_level_tiktok_cache, \
             redis_ticket_level_ks_cache, redis_ticket_level_xhs_cache
         name = redis_ticket_level_cache.format(self.session.no)
         tiktok_name = redis_ticket_level_tiktok_cache.format(self.session.no)
         ks_name = redis_ticket_level_ks_cache.format(self.session.no)
         xhs_name = redis_ticket_level_xhs_cache.format(self.session.no)
         key = str(self.id)
-        with get_pika_redis() as pika:
-            if is_create and self.status:
-                from ticket.serializers import TicketFileCacheSerializer
-                data = TicketFileCacheSerializer(self).data
-                data['origin_price'] = float(data['origin_price'])
-                data['price'] = float(data['price'])
-                if self.is_cy:
-                    tp_qs = self.cy_tf.ticket_pack_list.all()
-                    ticket_pack_list = []
-                    if tp_qs:
-                        from caiyicloud.serializers import CyTicketPackSerializer
-                        ticket_pack_list = CyTicketPackSerializer(tp_qs, many=True).data
-                    data['cy'] = dict(no=self.cy_tf.cy_no, category=self.cy_tf.category,
-                                      ticket_pack_list=ticket_pack_list)
-                dd = json.dumps(data)
-                pika.hset(name, key, dd)
-                if self.is_tiktok:
-                    pika.hset(tiktok_name, key, dd)
-                else:
-                    pika.hdel(tiktok_name, key)
-                if self.is_ks:
-                    pika.hset(ks_name, key, dd)
-                else:
-                    pika.hdel(ks_name, key)
-                if self.is_xhs:
-                    pika.hset(xhs_name, key, dd)
-                else:
-                    pika.hdel(xhs_name, key)
+        if is_create and self.status:
+            dd = self.get_level_cache_json()
+            pika.hset(name, key, dd)
+            if self.is_tiktok:
+                pika.hset(tiktok_name, key, dd)
             else:
-                pika.hdel(name, key)
                 pika.hdel(tiktok_name, key)
+            if self.is_ks:
+                pika.hset(ks_name, key, dd)
+            else:
                 pika.hdel(ks_name, key)
+            if self.is_xhs:
+                pika.hset(xhs_name, key, dd)
+            else:
                 pika.hdel(xhs_name, key)
+        else:
+            pika.hdel(name, key)
+            pika.hdel(tiktok_name, key)
+            pika.hdel(ks_name, key)
+            pika.hdel(xhs_name, key)
 
     def redis_stock(self, stock=None):
         # 初始化库存
@@ -2286,33 +2380,15 @@ class TicketFile(models.Model):
 
     @classmethod
     def update_goods_sales(cls):
-        from caches import get_redis, level_sales_key
-        redis = get_redis()
-        sales_list = redis.lrange(level_sales_key, 0, -1)
-        if sales_list:
-            total_list = dict()
-            for val in sales_list:
-                dd = redis.rpop(level_sales_key)
-                id, num = dd.split('_')
-                if total_list.get(str(id)):
-                    total_list[str(id)] += int(num)
-                else:
-                    total_list[str(id)] = int(num)
-            for key, val in total_list.items():
-                self = cls.objects.filter(id=int(key)).first()
-                if self:
-                    sales = self.sales + val
-                    self.sales = sales if sales > 0 else 0
-                    self.save(update_fields=['sales'])
+        close_old_connections()
+        level_sales_counter.drain()
 
     def update_sales(self, num):
         """
         更改销量
         """
-        from caches import get_redis, level_sales_key
-        redis = get_redis()
         if num:
-            redis.lpush(level_sales_key, '{}_{}'.format(self.id, num))
+            level_sales_counter.incr(self.id, sales=num)
 
     @classmethod
     def check_status(cls):
@@ -2351,10 +2427,8 @@ class TicketFile(models.Model):
         levels_upd = []
         levels_upd.append((self.pk, mul, 0))
         from ticket.stock_updater import tfc
-        succ1, tfc_result = tfc.batch_incr(levels_upd)
-        if succ1:
-            tfc.batch_record_update_ts(tfc.resolve_ids(tfc_result))
-        else:
+        succ1, tfc_result = tfc.batch_incr(levels_upd, record_update_ts=True)
+        if not succ1:
             log.warning(f"ticket_levels incr failed")
             raise CustomAPIException('抢购失败,库存不足')
 
@@ -2585,13 +2659,20 @@ class SessionSeat(models.Model):
             return '{}层{}{}排{}列'.format(self.layers, self.box_no_special, self.showRow, self.showCol)
         return '{}层{}排{}列'.format(self.layers, self.showRow, self.showCol)
 
-    def seat_desc(self, venue):
-        vl = VenuesLayers.objects.filter(venue=venue, layer=self.layers).first()
-        if vl:
+    def seat_desc(self, venue, layer_names: dict = None):
+        """
+        layer_names: 批量导出时预先加载的 {(场馆ID, 楼层): 别名}
+        """
+        if layer_names is not None:
+            layer_name = layer_names.get((venue.id if venue else None, self.layers))
+        else:
+            vl = VenuesLayers.objects.filter(venue=venue, layer=self.layers).first()
+            layer_name = vl.name if vl else None
+        if layer_name:
             if not self.box_no_special:
-                seat = '{}{}排{}列'.format(vl.name, self.showRow, self.showCol)
+                seat = '{}{}排{}列'.format(layer_name, self.showRow, self.showCol)
             else:
-                seat = '{}{}{}排{}列'.format(vl.name, self.box_no_special, self.showRow,
+                seat = '{}{}{}排{}列'.format(layer_name, self.box_no_special, self.showRow,
                                            self.showCol)
         else:
             seat = '{}'.format(str(self))
@@ -2629,37 +2710,44 @@ class SessionSeat(models.Model):
             box_no_special = '{}楼'.format(chinese_numbers[self.layers])
         return row, box_no_special
 
-    def change_pika_mz_seat(self, is_buy):
+    def change_pika_mz_seat(self, is_buy, pika=None):
+        """
+        pika: 批量出票时传入pipeline, 由调用方execute
+        """
         if self.ticket_ids:
-            from caches import get_pika_redis, matrix_seat_data_key
+            if pika is None:
+                with get_pika_redis() as pika:
+                    return self.change_pika_mz_seat(is_buy, pika)
             result = '{}_{}_{}'.format(self.ticket_ids, int(is_buy), int(self.is_reserve))
             # 麦座肯定是未售的，3种情况会进来，1这边售卖了，麦座未售 2.退款，限制麦座未售才进来，3取消和退款一样的逻辑
             matrix_val = '{}{}{}'.format(0, int(is_buy), int(self.is_reserve))
-            with get_pika_redis() as pika:
-                name, key = SessionSeat.get_pika_mz_seat_key(self.session_id, self.layers, self.showRow, self.showCol,
-                                                             self.box_no_special)
-                pika.hset(name, key, result)
-                row, box_no_special = self.get_row_and_box_no_special()
-                new_name, new_key = SessionSeat.get_pika_mz_seat_key(self.session_id, self.layers, row,
-                                                                     self.showCol,
-                                                                     box_no_special)
-                pika.hset(new_name, new_key, result)
-                self.matrix_seat_change_pika(matrix_val)
-
-    def set_pika_buy(self, is_buy):
+            name, key = SessionSeat.get_pika_mz_seat_key(self.session_id, self.layers, self.showRow, self.showCol,
+                                                         self.box_no_special)
+            pika.hset(name, key, result)
+            row, box_no_special = self.get_row_and_box_no_special()
+            new_name, new_key = SessionSeat.get_pika_mz_seat_key(self.session_id, self.layers, row,
+                                                                 self.showCol,
+                                                                 box_no_special)
+            pika.hset(new_name, new_key, result)
+            self.matrix_seat_change_pika(matrix_val, pika)
+
+    def set_pika_buy(self, is_buy, pika=None):
         if self.ticket_ids:
-            from caches import get_pika_redis
-            with get_pika_redis() as pika:
-                name, key = SessionSeat.get_pika_buy_key(self.session_id, self.ticket_ids)
-                pika.hset(name, key, 1 if is_buy else 0)
+            if pika is None:
+                with get_pika_redis() as pika:
+                    return self.set_pika_buy(is_buy, pika)
+            name, key = SessionSeat.get_pika_buy_key(self.session_id, self.ticket_ids)
+            pika.hset(name, key, 1 if is_buy else 0)
 
-    def matrix_seat_change_pika(self, matrix_val):
+    def matrix_seat_change_pika(self, matrix_val, pika=None):
         # matrix_val新的值
-        from caches import get_pika_redis, matrix_seat_data_key
-        with get_pika_redis() as pika:
-            # 外面方法确保了座位数量没有发生变化
-            matrix_seat_data_key = matrix_seat_data_key.format(self.session_id)
-            pika.setrange(matrix_seat_data_key, self.start_index, matrix_val)
+        from caches import matrix_seat_data_key
+        if pika is None:
+            with get_pika_redis() as pika:
+                return self.matrix_seat_change_pika(matrix_val, pika)
+        # 外面方法确保了座位数量没有发生变化
+        matrix_seat_data_key = matrix_seat_data_key.format(self.session_id)
+        pika.setrange(matrix_seat_data_key, self.start_index, matrix_val)
 
     @classmethod
     def mai_zuo_set_seat_new(cls, session_id: int, venue_id: int, stand_name: str, floor_name: str, row: str,
@@ -2756,10 +2844,126 @@ class SessionSeat(models.Model):
     def can_buy(self):
         return (not self.is_reserve) and (not self.is_buy)
 
+    # 座位图状态字段,不放在静态数据里,由状态字节表示; order_no存在场次的订单hash里(下标->订单号)
+    SEAT_STATUS_FIELDS = ('is_buy', 'can_buy', 'is_reserve', 'order_no')
+
+    @classmethod
+    def seat_status_code(cls, is_buy, can_buy, is_reserve) -> str:
+        # 每个座位的状态占1个字节: '0'+(is_buy|can_buy<<1|is_reserve<<2)
+        return chr(ord('0') + (int(bool(is_buy)) | int(bool(can_buy)) << 1 | int(bool(is_reserve)) << 2))
+
+    @classmethod
+    def seat_status_json(cls, code: str, order_no=None) -> str:
+        # 状态字节和订单号对应的json片段,与静态数据片段拼接成完整的座位json
+        val = ord(code) - ord('0')
+        flags = ['true' if val & bit else 'false' for bit in (1, 2, 4)]
+        return ',"is_buy":{},"can_buy":{},"is_reserve":{},"order_no":{}}}'.format(*flags, json.dumps(order_no))
+
+    @classmethod
+    def set_seat_map(cls, pika, session_id: int, seat_list: list):
+        """
+        写入场次座位图, 只在座位布局变化时调用(create_record/layer_session)
+        静态数据: 每个座位去掉状态字段后的json片段(不含结尾的}), 以换行分隔
+        状态数据: 每个座位1字节, 下标即座位index, 之后买座/取消/同步只需要setrange
+        订单号: 下标->订单号的hash, 只有change_pika_redis带了订单号的座位才有
+        """
+        from caches import pika_seat_geometry_key, pika_seat_status_key, pika_seat_order_key, \
+            pika_session_seat_list_key
+        fragments = []
+        status = []
+        orders = dict()
+        for i, seat in enumerate(seat_list):
+            geometry = {k: v for k, v in seat.items() if k not in cls.SEAT_STATUS_FIELDS}
+            fragments.append(json.dumps(geometry)[:-1])
+            status.append(cls.seat_status_code(seat.get('is_buy'), seat.get('can_buy'), seat.get('is_reserve')))
+            if seat.get('order_no'):
+                orders[i] = seat['order_no']
+        pipe = pika.pipeline(transaction=False)
+        pipe.set(pika_seat_geometry_key.format(session_id), '\n'.join(fragments))
+        pipe.set(pika_seat_status_key.format(session_id), ''.join(status))
+        pipe.delete(pika_seat_order_key.format(session_id))
+        if orders:
+            pipe.hmset(pika_seat_order_key.format(session_id), orders)
+        # 旧的整包json已转换, 不再维护
+        pipe.delete(pika_session_seat_list_key.format(session_id))
+        pipe.execute()
+
+    @classmethod
+    def ensure_seat_map(cls, pika, session_id: int) -> bool:
+        """
+        上线前生成的场次只有旧的整包json(pika_session_seat_list_key), 第一次读取或修改状态时转换成新格式,
+        转换前不能setrange, 否则转换会用旧json覆盖掉已经写入的状态. 没有座位图返回False
+        每次都检查静态数据key, 座位图被删除或重建后不会用到过期的判断
+        """
+        from caches import pika_seat_geometry_key, pika_session_seat_list_key, run_with_lock, get_redis_name
+        session_id = int(session_id)
+        if not pika.exists(pika_seat_geometry_key.format(session_id)):
+            with run_with_lock(get_redis_name('seat_map_convert_{}'.format(session_id)), 5, 3) as got:
+                if not got:
+                    log.warning('seat map convert lock fail: {}'.format(session_id))
+                    return False
+                # 拿到锁后再确认一次, 可能已经被其他进程转换
+                if not pika.exists(pika_seat_geometry_key.format(session_id)):
+                    data = pika.get(pika_session_seat_list_key.format(session_id))
+                    if data is None:
+                        return False
+                    cls.set_seat_map(pika, session_id, json.loads(data))
+        return True
+
+    @classmethod
+    def get_seat_map_json(cls, session_id: int):
+        """
+        拼接座位图json, 静态数据只做字符串拼接不重新编码
+        先直接读取, 静态数据不存在时才转换旧格式后再读一次
+        """
+        from caches import get_pika_redis, pika_seat_geometry_key, pika_seat_status_key, pika_seat_order_key
+        pika = get_pika_redis()
+
+        def read():
+            pipe = pika.pipeline(transaction=False)
+            pipe.get(pika_seat_geometry_key.format(session_id))
+            pipe.get(pika_seat_status_key.format(session_id))
+            pipe.hgetall(pika_seat_order_key.format(session_id))
+            return pipe.execute()
+
+        geometry, status, orders = read()
+        if geometry is None:
+            if not cls.ensure_seat_map(pika, session_id):
+                return None
+            geometry, status, orders = read()
+        if not geometry:
+            return '[]'
+        suffix = dict()
+        seats = []
+        for i, fragment in enumerate(geometry.split('\n')):
+            code = status[i] if status and i < len(status) else '0'
+            order_no = orders.get(str(i))
+            if order_no:
+                seats.append(fragment + cls.seat_status_json(code, order_no))
+                continue
+            if code not in suffix:
+                suffix[code] = cls.seat_status_json(code)
+            seats.append(fragment + suffix[code])
+        return '[' + ','.join(seats) + ']'
+
+    def set_seat_status(self, pika, index: int, is_buy, can_buy, is_reserve):
+        """
+        pika可以是pipeline, 调用前需要ensure_seat_map
+        """
+        from caches import pika_seat_status_key
+        pika.setrange(pika_seat_status_key.format(self.session_id), index,
+                      self.seat_status_code(is_buy, can_buy, is_reserve))
+
+    def set_seat_order(self, pika, index: int, order_no=None):
+        from caches import pika_seat_order_key
+        if order_no:
+            pika.hset(pika_seat_order_key.format(self.session_id), index, order_no)
+        else:
+            pika.hdel(pika_seat_order_key.format(self.session_id), index)
+
     def change_pika_redis(self, is_buy, can_buy, order_no=None):
-        from caches import get_pika_redis, pika_session_seat_list_key, pika_session_seat_key, pika_level_seat_key
+        from caches import get_pika_redis, pika_session_seat_key, pika_level_seat_key
         pika = get_pika_redis()
-        pika_session_seat_list_key = pika_session_seat_list_key.format(self.session_id)
         session_seat_key = pika_session_seat_key.format(self.session_id)
         level_seat_key = pika_level_seat_key.format(self.ticket_level_id, self.seats_id)
         seat = pika.hget(session_seat_key, level_seat_key)
@@ -2769,17 +2973,46 @@ class SessionSeat(models.Model):
         seat['order_no'] = order_no
         # pika.hdel(session_seat_key, level_seat_key)
         pika.hset(session_seat_key, level_seat_key, json.dumps(seat))
-        pika_session_seat_list = pika.get(pika_session_seat_list_key)
-        pika_session_seat_list = json.loads(pika_session_seat_list)
-        pika_session_seat_list[seat['index']]['is_buy'] = is_buy
-        pika_session_seat_list[seat['index']]['can_buy'] = can_buy
-        pika_session_seat_list[seat['index']]['order_no'] = order_no
-        pika.set(pika_session_seat_list_key, json.dumps(pika_session_seat_list))
+        if self.ensure_seat_map(pika, self.session_id):
+            self.set_seat_status(pika, seat['index'], is_buy, can_buy, seat.get('is_reserve'))
+            self.set_seat_order(pika, seat['index'], order_no)
+
+    @classmethod
+    def bulk_release_pika(cls, seats: list):
+        """
+        批量取消订单时释放座位缓存, 和change_pika_redis(is_buy=False, can_buy=(not is_reserve))、
+        change_pika_mz_seat(False)、set_pika_buy(False)一样, 每个场次一次HMGET, 写入走一个pipeline
+        """
+        from caches import pika_session_seat_key, pika_level_seat_key
+        pika = get_pika_redis()
+        session_seats = dict()
+        for inst in seats:
+            session_seats.setdefault(inst.session_id, []).append(inst)
+        with pika.pipeline(transaction=False) as pipe:
+            for session_id, seat_list in session_seats.items():
+                session_seat_key = pika_session_seat_key.format(session_id)
+                has_map = cls.ensure_seat_map(pika, session_id)
+                fields = [pika_level_seat_key.format(inst.ticket_level_id, inst.seats_id) for inst in seat_list]
+                for inst, field, seat in zip(seat_list, fields, pika.hmget(session_seat_key, fields)):
+                    if not seat:
+                        log.warning('release seat cache not found: {}'.format(field))
+                        continue
+                    can_buy = not inst.is_reserve
+                    seat = json.loads(seat)
+                    seat['is_buy'] = False
+                    seat['can_buy'] = can_buy
+                    seat['order_no'] = None
+                    pipe.hset(session_seat_key, field, json.dumps(seat))
+                    if has_map:
+                        inst.set_seat_status(pipe, seat['index'], False, can_buy, seat.get('is_reserve'))
+                        inst.set_seat_order(pipe, seat['index'])
+                    inst.change_pika_mz_seat(False, pipe)
+                    inst.set_pika_buy(False, pipe)
+            pipe.execute()
 
     def mz_change_and_set_pika(self, is_buy, can_buy, is_reserve, unlock_ticket_id=None):
-        from caches import get_pika_redis, pika_session_seat_list_key, pika_session_seat_key, pika_level_seat_key
+        from caches import get_pika_redis, pika_session_seat_key, pika_level_seat_key
         with get_pika_redis() as pika:
-            pika_session_seat_list_key = pika_session_seat_list_key.format(self.session_id)
             session_seat_key = pika_session_seat_key.format(self.session_id)
             level_seat_key = pika_level_seat_key.format(self.ticket_level_id, self.seats_id)
             seat = pika.hget(session_seat_key, level_seat_key)
@@ -2789,12 +3022,8 @@ class SessionSeat(models.Model):
             seat['is_reserve'] = is_reserve
             # pika.hdel(session_seat_key, level_seat_key)
             pika.hset(session_seat_key, level_seat_key, json.dumps(seat))
-            pika_session_seat_list = pika.get(pika_session_seat_list_key)
-            pika_session_seat_list = json.loads(pika_session_seat_list)
-            pika_session_seat_list[seat['index']]['is_buy'] = is_buy
-            pika_session_seat_list[seat['index']]['can_buy'] = can_buy
-            pika_session_seat_list[seat['index']]['is_reserve'] = is_reserve
-            pika.set(pika_session_seat_list_key, json.dumps(pika_session_seat_list))
+            if self.ensure_seat_map(pika, self.session_id):
+                self.set_seat_status(pika, seat['index'], is_buy, can_buy, is_reserve)
             if unlock_ticket_id:
                 self.set_push_mz_lock(False)
 
@@ -2816,106 +3045,147 @@ class SessionSeat(models.Model):
         log_inst = admin.ModelAdmin(SessionSeat, admin.site)
         log_inst.log_change(request, self, msg)
 
+    @classmethod
+    def bulk_set_log(cls, request, logs: list):
+        """
+        logs: [(座位, msg)], 一次写入后台修改日志
+        """
+        if not (request and logs):
+            return
+        from django.contrib.admin.models import LogEntry, CHANGE
+        from django.contrib.contenttypes.models import ContentType
+        content_type_id = ContentType.objects.get_for_model(cls).pk
+        LogEntry.objects.bulk_create(
+            [LogEntry(user_id=request.user.pk, content_type_id=content_type_id, object_id=str(ss.pk),
+                      object_repr=str(ss)[:200], action_flag=CHANGE, change_message=msg) for ss, msg in logs])
+
     @classmethod
     def create_record(cls, data: list, cache_seat, request=None):
+        """
+        上传座位图: 票档、座位、已有场次座位各一次查询, 在内存里比对后bulk_create/bulk_update,
+        pika座位数据整批写入, 后台日志一次写入
+        """
+        if not data:
+            return
+        level_ids = set([int(u['ticket_level_id']) for u in data])
+        levels = TicketFile.objects.filter(id__in=level_ids).select_related('color', 'session').in_bulk()
+        if len(levels) != len(level_ids):
+            raise CustomAPIException('票档不存在,{}'.format(level_ids - set(levels.keys())))
+        session = levels[int(data[0]['ticket_level_id'])].session
+        if session.status != session.STATUS_OFF:
+            raise CustomAPIException('请先下架场次再修改,{}'.format(session.id))
+        seat_map = dict()
+        # 同一编号取id最小的座位
+        for seats in Seat.objects.filter(seat_no__in=set([u['seat_no'] for u in data])).order_by('-pk'):
+            seat_map[seats.seat_no] = seats
+        exists = dict()
+        if session.is_price:
+            exists = {ss.seats_id: ss for ss in
+                      cls.objects.filter(session_id=session.id, seats_id__in=[seats.id for seats in seat_map.values()])
+                          .select_related('ticket_level')}
         create_list = []
         update_list = []
-        levels = dict()
-        session = None
-        from caches import get_pika_redis, pika_session_seat_list_key, pika_session_seat_key, pika_level_seat_key
-        pika = get_pika_redis()
+        logs = []
         list_dd = []
-        i = 0
-        session_seat_list_key = None
-        is_delete = False
+        from caches import get_pika_redis, pika_session_seat_key, pika_level_seat_key
         for u in data:
-            ticket_level_id = u['ticket_level_id']
-            if not levels.get(str(ticket_level_id)):
-                level = TicketFile.objects.filter(id=ticket_level_id).first()
-                levels[str(ticket_level_id)] = level
-                if not session:
-                    session = level.session
-                    if session.status != session.STATUS_OFF:
-                        raise CustomAPIException('请先下架场次再修改,{}'.format(session.id))
-                    if not is_delete:
-                        session_seat_key = pika_session_seat_key.format(session.id)
-                        pika.delete(session_seat_key)
-                        is_delete = True
+            seats = seat_map.get(u['seat_no'])
+            if not seats:
+                continue
+            ticket_level_id = int(u['ticket_level_id'])
+            level = levels[ticket_level_id]
+            is_reserve = True if u.get('is_reserve') else False
+            ss = exists.get(seats.id)
+            if ss:
+                is_update = False
+                desc = ''
+                if ss.ticket_level_id != ticket_level_id:
+                    desc = '{}修改价格:{},原价格：{}'.format(str(ss), level.price, ss.ticket_level.price)
+                    is_update = True
+                    ss.ticket_level = level
+                    ss.color_id = level.color.id
+                    ss.price = level.price
+                    ss.color_code = level.color.code
+                if ss.is_reserve != is_reserve:
+                    is_update = True
+                    ss.is_reserve = is_reserve
+                    if is_reserve:
+                        desc = desc + ',{}锁座'.format(str(ss))
+                    else:
+                        desc = desc + ',{}销售座位'.format(str(ss))
+                if ss.box_no_special != u.get('box_no_special'):
+                    is_update = True
+                    ss.box_no_special = u.get('box_no_special')
+                if is_update:
+                    if ss.is_buy:
+                        raise CustomAPIException('座位已被购买，不能更改,{}'.format(str(ss)))
+                    update_list.append(ss)
+                if desc:
+                    logs.append((ss, desc))
             else:
-                level = levels[str(ticket_level_id)]
-            session_seat_key = pika_session_seat_key.format(session.id)
-            session_seat_list_key = pika_session_seat_list_key.format(session.id)
-            seat_no = u['seat_no']
-            seats = Seat.objects.filter(seat_no=seat_no).first()
-            if seats:
-                ss = None
-                level_seat_key_old = None
-                is_reserve = True if u.get('is_reserve') else False
-                if session.is_price:
-                    ss = cls.objects.filter(seats=seats, session_id=session.id).first()
-                if ss:
-                    is_update = False
-                    desc = ''
-                    if ss.ticket_level_id != int(ticket_level_id):
-                        level_seat_key_old = pika_level_seat_key.format(ss.ticket_level_id, seats.id)
-                        tf = TicketFile.objects.get(id=int(ticket_level_id))
-                        desc = '{}修改价格:{},原价格：{}'.format(str(ss), tf.price, ss.ticket_level.price)
-                        is_update = True
-                        ss.ticket_level_id = int(ticket_level_id)
-                        ss.color_id = level.color.id
-                        ss.price = level.price
-                        ss.color_code = level.color.code
-                    if ss.is_reserve != is_reserve:
-                        is_update = True
-                        ss.is_reserve = is_reserve
-                        if is_reserve:
-                            desc = desc + ',{}锁座'.format(str(ss))
-                        else:
-                            desc = desc + ',{}销售座位'.format(str(ss))
-                    if ss.box_no_special != u.get('box_no_special'):
-                        is_update = True
-                        ss.box_no_special = u.get('box_no_special')
-                    if is_update:
-                        if ss.is_buy:
-                            raise CustomAPIException('座位已被购买，不能更改,{}'.format(str(ss)))
-                        update_list.append(ss)
-                    if desc:
-                        ss.set_log(request, desc)
-                else:
-                    create_list.append(
-                        cls(ticket_level_id=int(ticket_level_id), seats=seats, row=seats.row, column=seats.column,
-                            layers=seats.layers, session_id=session.id, box_no_special=u.get('box_no_special'),
-                            color_id=level.color.id, price=level.price, color_code=level.color.code,
-                            is_reserve=is_reserve, showRow=u.get('showRow') or 0,
-                            showCol=u.get('showCol') or 0,
-                            desc=u.get('desc')))
-                dd = dict(ticket_level=int(ticket_level_id), seats=seats.id, row=seats.row, column=seats.column,
-                          layers=seats.layers, session_id=session.id,
-                          color_id=level.color.id, price=float(level.price), color_code=level.color.code,
-                          is_reserve=is_reserve, showRow=u.get('showRow') or 0,
-                          showCol=u.get('showCol') or 0, box_no_special=u.get('box_no_special'),
-                          desc=u.get('desc'), can_buy=ss.can_buy() if ss else not is_reserve)
-                level_seat_key = pika_level_seat_key.format(ticket_level_id, seats.id)
-                list_dd.append(dd)
-                dd['index'] = i
-                if level_seat_key_old:
-                    pika.hdel(session_seat_key, level_seat_key_old)
-                r = pika.hset(session_seat_key, level_seat_key, json.dumps(dd))
-                if r not in [1, 0]:
-                    raise CustomAPIException('执行失败, pika错误')
-                i += 1
-        pika.set(session_seat_list_key, json.dumps(list_dd))
+                create_list.append(
+                    cls(ticket_level_id=ticket_level_id, seats=seats, row=seats.row, column=seats.column,
+                        layers=seats.layers, session_id=session.id, box_no_special=u.get('box_no_special'),
+                        color_id=level.color.id, price=level.price, color_code=level.color.code,
+                        is_reserve=is_reserve, showRow=u.get('showRow') or 0,
+                        showCol=u.get('showCol') or 0,
+                        desc=u.get('desc')))
+            dd = dict(ticket_level=ticket_level_id, seats=seats.id, row=seats.row, column=seats.column,
+                      layers=seats.layers, session_id=session.id,
+                      color_id=level.color.id, price=float(level.price), color_code=level.color.code,
+                      is_reserve=is_reserve, showRow=u.get('showRow') or 0,
+                      showCol=u.get('showCol') or 0, box_no_special=u.get('box_no_special'),
+                      desc=u.get('desc'), can_buy=ss.can_buy() if ss else not is_reserve)
+            dd['index'] = len(list_dd)
+            list_dd.append(dd)
+        # 整个场次的座位数据重写, 旧票档的field随delete一起清掉
+        session_seat_key = pika_session_seat_key.format(session.id)
+        pika = get_pika_redis()
+        with pika.pipeline(transaction=False) as pipe:
+            pipe.delete(session_seat_key)
+            for i in range(0, len(list_dd), 1000):
+                pipe.hmset(session_seat_key, {pika_level_seat_key.format(dd['ticket_level'], dd['seats']): json.dumps(dd)
+                                              for dd in list_dd[i:i + 1000]})
+            ret = pipe.execute()
+        if not all(ret[1:]):
+            raise CustomAPIException('执行失败, pika错误')
+        cls.set_seat_map(pika, session.id, list_dd)
         if create_list:
-            cls.objects.bulk_create(create_list)
+            cls.objects.bulk_create(create_list, batch_size=1000)
             session.is_price = True
             session.cache_seat = cache_seat
             session.save(update_fields=['is_price', 'cache_seat'])
         if update_list:
             cls.objects.bulk_update(update_list,
                                     ['ticket_level_id', 'is_reserve', 'box_no_special', 'color_id', 'price',
-                                     'color_code'])
+                                     'color_code'], batch_size=1000)
             session.cache_seat = cache_seat
             session.save(update_fields=['cache_seat'])
+        cls.bulk_set_log(request, logs)
+
+    @classmethod
+    def batch_set_buy(cls, seat_list: list, expire: int = 60, msg='座位已被占用，请重新选座'):
+        """
+        批量锁定座位, 代替逐个座位 setnx+expire+set_buy:
+        1.一次往返原子地给所有座位加 session_seat_key 锁(全部成功或全部失败)
+        2.一条 UPDATE ... WHERE id IN (...) AND is_buy=false, 影响行数不等于座位数说明有座位已被占用
+        需要在事务中调用, 失败时抛出异常由外层事务回滚
+        """
+        from caches import acquire_locks, release_locks, session_seat_key
+        if not seat_list:
+            return
+        keys = [session_seat_key.format(inst.ticket_level_id, inst.seats_id) for inst in seat_list]
+        if not acquire_locks(keys, expire):
+            raise CustomAPIException(msg)
+        ids = [inst.id for inst in seat_list]
+        rows = cls.objects.filter(id__in=ids, is_buy=False).update(version=F('version') + 1, is_buy=True)
+        if rows != len(set(ids)):
+            release_locks(keys)
+            raise CustomAPIException(msg)
+        for inst in seat_list:
+            inst.is_buy = True
+            inst.version += 1
+            inst.change_pika_mz_seat(True)
 
     def set_buy(self):
         # 锁定位置
@@ -2968,8 +3238,6 @@ class SessionSeat(models.Model):
     @classmethod
     def get_order_amount(cls, user, session, ticket_list: list, pay_type, is_tiktok=False, express_fee=0,
                          can_member_card=False):
-        from caches import get_redis, seat_lock, session_seat_key
-        redis = get_redis()
         multiply = 0
         amount = 0
         actual_amount = 0
@@ -3001,12 +3269,6 @@ class SessionSeat(models.Model):
         #     if not card:
         #         card = TheaterCard.get_inst()
         for data in ticket_list:
-            kk = session_seat_key.format(data['level_id'], data['seat_id'])
-            if redis.setnx(kk, 1):
-                # 5分钟自动过期
-                redis.expire(kk, 60)
-            else:
-                raise CustomAPIException('座位已被占用，请重新选座')
             # inst = cls.objects.filter(ticket_level_id=data['level_id'], seats_id=data['seat_id']).first()
             inst = data.get('seat')
             if inst:
@@ -3021,25 +3283,17 @@ class SessionSeat(models.Model):
                     if ticket_level.limit_num > 0 and ticket[str(data['level_id'])] > ticket_level.limit_num:
                         raise CustomAPIException(
                             '价格{}的票,超过限购数量{}，请重新选座'.format(ticket_level.price, ticket_level.limit_num))
-                    key = seat_lock.format(inst.id)
-                    if redis.setnx(key, 1):
-                        try:
-                            # 5分钟自动过期
-                            redis.expire(key, 300)
-                            inst.set_buy()
-                            amount += ticket_level.price
-                            price, _ = ticket_level.get_price(card, tc_card, pay_type, 1, use_old_card)
-                            actual_amount += price
-                            multiply += 1
-                            session_seat_list.append(inst)
-                        finally:
-                            redis.delete(key)
-                    else:
-                        raise CustomAPIException('座位{}已被占用，请重新选座'.format(str(inst)))
+                    amount += ticket_level.price
+                    price, _ = ticket_level.get_price(card, tc_card, pay_type, 1, use_old_card)
+                    actual_amount += price
+                    multiply += 1
+                    session_seat_list.append(inst)
                 else:
                     raise CustomAPIException('座位{}已被占用，请重新选座'.format(str(inst)))
             else:
                 raise CustomAPIException('座位选择错误，请重新选座，')
+        # 所有座位一次性锁定
+        cls.batch_set_buy(session_seat_list)
         # if can_member_card and pay_type == Receipt.PAY_WeiXin_LP:
         #     account = user.account
         #     discount = account.get_discount()
@@ -3360,56 +3614,12 @@ class TicketOrder(models.Model):
 
     @classmethod
     def check_cps_source_new(cls):
+        """
+        抖音订单查询带货场景, 见ticket.cps_attribution
+        """
         close_old_connections()
-        from douyin import get_dou_yin
-        from caches import get_redis, check_cps_source_key
-        dy = get_dou_yin()
-        now = timezone.now()
-        start_at = now - timedelta(days=2)
-        redis = get_redis()
-        order_qs = cls.objects.filter(source_type=TicketOrder.SOURCE_DEFAULT, tiktok_order_id__isnull=False,
-                                      status__in=[cls.STATUS_PAID, cls.STATUS_FINISH],
-                                      pay_type=Receipt.PAY_TikTok_LP, pay_at__lt=now, pay_at__gt=start_at)
-        for order in order_qs:
-            key = check_cps_source_key.format(order.id)
-            try:
-                if redis.setnx(key, order.id):
-                    # 避免同一订单同时执行
-                    redis.expire(key, 5 * 60)
-                    st, ret = dy.query_cps(order.order_no)
-                    if st and ret.get('data') and ret['data'].get('cps_info') and \
-                            ret['data']['cps_info'][
-                                'cps_item_list']:
-                        source_type = ret['data']['cps_info']['cps_item_list'][0]['source_type']
-                        order.tiktok_douyinid = ret['data']['cps_info']['cps_item_list'][0][
-                            'commission_user_douyinid']
-                        order.tiktok_nickname = ret['data']['cps_info']['cps_item_list'][0][
-                            'commission_user_nickname']
-                        order.plan_id = ret['data']['cps_info']['cps_item_list'][0]['task_id']
-                        order.source_type = source_type
-                        c_amount = ret['data']['cps_info']['total_commission_amount'] / 100
-                        order.tiktok_commission_amount = c_amount
-                        # CPS订单不发放任何奖励，并且不记录最新推荐人在订单中
-                        # order.agent = None
-                        order.save(update_fields=['source_type', 'tiktok_douyinid', 'tiktok_nickname', 'plan_id',
-                                                  'source_type', 'tiktok_commission_amount'])
-                        order.change_cps_agent_amount(source_type, c_amount, order.actual_amount, TiktokUser.ST_DY)
-                    else:
-                        # 非CPS订单或带货场景为空的订单按照目前的逻辑正常计算
-                        source_type = TicketOrder.SOURCE_NO
-                        order.source_type = TicketOrder.SOURCE_NO
-                        order.save(update_fields=['source_type'])
-                        # 订单发奖励
-                        order.send_award()
-                        # 补差订单发奖励
-                        order_qs = TicketOrder.objects.filter(source_order_id=order.id)
-                        for od in order_qs:
-                            od.send_award()
-                    TicketUserCode.objects.filter(order_id=order.id).update(source_type=source_type)
-            except Exception as e:
-                continue
-            finally:
-                redis.delete(key)
+        from ticket.cps_attribution import CpsAttribution
+        return CpsAttribution().run()
 
     @classmethod
     def check_add_booking(cls):
@@ -3578,71 +3788,54 @@ class TicketOrder(models.Model):
         end_at = get_timestamp(pay_end_at)
         return end_at
 
-    def team_award(self, parent, lv, check_parent_list=None):
+    def team_award(self, parent, lv=1):
+        """
+        团队奖: 从parent开始往上每级按等级的团队奖比率发放, 到第24级为止
+        上级链路取缓存(mall.user_cache.get_ancestor_path), 各级账户和等级一次查出, 记录一次写入
+        返回parent本身是否发了奖励
+        """
         is_award = False
-        if not check_parent_list:
-            check_parent_list = []
-        if not parent or self.id == parent.id or parent in check_parent_list:
-            # 发奖励的是自己或者已经发过奖励了直接不再发
+        if not parent:
             return is_award
-        if parent and lv < 25:
-            if parent.account.level:
-                ratio = parent.account.level.team_ratio
-                if ratio > 0:
-                    # 代理分销奖
-                    amount = self.award_amount * ratio / 100
-                    if amount > 0.01:
-                        from shopping_points.models import UserCommissionChangeRecord
-                        UserCommissionChangeRecord.add_record(parent.account, amount,
-                                                              UserCommissionChangeRecord.SOURCE_TYPE_GROUP,
-                                                              '代理团购奖励,{}级'.format(lv),
-                                                              status=UserCommissionChangeRecord.STATUS_CAN_WITHDRAW,
-                                                              order=self)
-                        is_award = True
-                        try:
-                            if parent.openid:
-                                self.send_order_parent_notice(parent.openid, '团队奖{}'.format(amount))
-                        except Exception as e:
-                            log.error('发送消息失败')
-            if parent.parent:
-                check_parent_list.append(parent)
-                self.team_award(parent.parent, lv + 1, check_parent_list)
+        from mall.user_cache import get_ancestor_path
+        from shopping_points.models import UserAccount, UserCommissionChangeRecord
+        path = []
+        for uid in get_ancestor_path(parent.id)[:25 - lv]:
+            if uid == self.user_id:
+                # 发奖励的是自己直接不再发
+                break
+            path.append(uid)
+        accounts = {account.user_id: account for account in
+                    UserAccount.objects.filter(user_id__in=path, level__isnull=False).select_related('level', 'user')}
+        items = []
+        for i, uid in enumerate(path):
+            account = accounts.get(uid)
+            if not account or account.level.team_ratio <= 0:
+                continue
+            # 代理分销奖
+            amount = self.award_amount * account.level.team_ratio / 100
+            if amount > 0.01:
+                items.append((account, amount, '代理团购奖励,{}级'.format(lv + i)))
+                if i == 0:
+                    is_award = True
+        UserCommissionChangeRecord.bulk_add_records(items, UserCommissionChangeRecord.SOURCE_TYPE_GROUP,
+                                                    status=UserCommissionChangeRecord.STATUS_CAN_WITHDRAW, order=self)
+        for account, amount, _ in items:
+            try:
+                if account.user.openid:
+                    self.send_order_parent_notice(account.user.openid, '团队奖{}'.format(amount))
+            except Exception as e:
+                log.error('发送消息失败')
         return is_award
 
     @classmethod
     def send_show_start_notice(cls):
+        """
+        开场前2小时/24小时短信提醒, 见ticket.show_notice
+        """
         close_old_connections()
-        hours = 2
-        start_at = timezone.now() + timedelta(hours=hours)
-        start_at_day = timezone.now() + timedelta(hours=24)
-        from qcloud.sms import get_sms
-        sms = get_sms()
-        # log.error(start_at)
-        two_qs = cls.objects.filter(push_message=False, session__start_at__lte=start_at, status=cls.STATUS_PAID)
-        for order in two_qs:
-            code = TicketUserCode.objects.filter(order_id=order.id, give_status=TicketUserCode.GIVE_DEFAULT)
-            if code:
-                try:
-                    data = dict(name=order.title, mobile=order.mobile, number=2,
-                                time=order.session.start_at.strftime("%Y-%m-%d %H:%M"))
-                    sms.smsvrcode(data)
-                except Exception as e:
-                    log.error('发送短息消息失败')
-            order.push_message = True
-            order.push_message_day = True
-            order.save(update_fields=['push_message', 'push_message_day'])
-        day_qs = cls.objects.filter(push_message_day=False, session__start_at__lte=start_at_day, status=cls.STATUS_PAID)
-        for order in day_qs:
-            code = TicketUserCode.objects.filter(order_id=order.id, give_status=TicketUserCode.GIVE_DEFAULT)
-            if code:
-                try:
-                    data = dict(name=order.title, mobile=order.mobile, number=24,
-                                time=order.session.start_at.strftime("%Y-%m-%d %H:%M"))
-                    sms.smsvrcode(data)
-                except Exception as e:
-                    log.error('发送短息消息失败')
-            order.push_message_day = True
-            order.save(update_fields=['push_message_day'])
+        from ticket.show_notice import NoticeDispatcher
+        return NoticeDispatcher().run('order')
 
     def wx_template_msg(self):
         url = 'pages/pagesKage/orderDetail/orderDetail?id={}'.format(self.id)
@@ -3741,12 +3934,15 @@ class TicketOrder(models.Model):
         # 无座的
         snapshot = json.loads(self.snapshot)
         price_list = snapshot['price_list']
+        levels = TicketFile.objects.filter(id__in=[int(ll['level_id']) for ll in price_list],
+                                           session_id=self.session_id).select_related('color').in_bulk()
+        items = []
         for ll in price_list:
-            tf = TicketFile.objects.filter(id=int(ll['level_id']), session_id=self.session.id).first()
+            tf = levels.get(int(ll['level_id']))
             if tf:
                 tf.update_sales(int(ll['multiply']))
-                for i in list(range(ll['multiply'])):
-                    TicketUserCode.create_record(order=self, ticket_level=tf)
+                items.extend([(tf, None)] * int(ll['multiply']))
+        TicketUserCode.bulk_create_records(self, items)
 
     @classmethod
     def award_status_list(cls):
@@ -3805,12 +4001,16 @@ class TicketOrder(models.Model):
     @atomic
     def set_code(self):
         # 付款后创建二维码
-        session_seat_qs = SessionSeat.objects.filter(order_no=self.order_no)
-        for session_seat in session_seat_qs:
-            TicketUserCode.create_record(order=self, session_seat=session_seat)
-            # 付款后要把这里重新制成已售
-            session_seat.change_pika_mz_seat(True)
-            session_seat.set_pika_buy(True)
+        session_seat_list = list(SessionSeat.objects.filter(order_no=self.order_no).select_related(
+            'ticket_level__color'))
+        TicketUserCode.bulk_create_records(self, [(session_seat.ticket_level, session_seat) for session_seat in
+                                                  session_seat_list])
+        # 付款后要把这里重新制成已售
+        with get_pika_redis().pipeline(transaction=False) as pipe:
+            for session_seat in session_seat_list:
+                session_seat.change_pika_mz_seat(True, pipe)
+                session_seat.set_pika_buy(True, pipe)
+            pipe.execute()
 
     def get_snapshot(self, dd):
         import json
@@ -3908,18 +4108,35 @@ class TicketOrder(models.Model):
             qs.update(order_no=None, is_buy=False, buy_desc=None)
 
     def cancel_code(self):
+        from ticket.gate_check import drop_order
         TicketUserCode.objects.filter(order_id=self.id).update(status=TicketUserCode.STATUS_CANCEL, msg='退款作废')
+        drop_order(self)
 
     @classmethod
     def auth_check_over_time_code(cls):
-        # 微信小程序支付的自动核销
+        # 微信小程序支付的自动核销, 只处理登记过的已结束场次
         close_old_connections()
-        qs = cls.objects.filter(pay_type=Receipt.PAY_WeiXin_LP, status=cls.STATUS_PAID,
-                                session__end_at__lt=timezone.now())
-        for order in qs:
-            tu_all = TicketUserCode.objects.filter(order_id=order.id, status=TicketUserCode.STATUS_DEFAULT)
-            tu_all.update(status=TicketUserCode.STATUS_OVER_TIME)
-            order.set_finish()
+        session_auto_check_work.run()
+
+    @classmethod
+    def auto_check_due(cls, ids: list) -> int:
+        """
+        场次结束后微信小程序支付的订单: 未检票的码改为已过期, 订单改为已完成
+        """
+        order_ids = list(cls.objects.filter(session_id__in=ids, session__end_at__lt=timezone.now(),
+                                            pay_type=Receipt.PAY_WeiXin_LP, status=cls.STATUS_PAID).values_list(
+            'id', flat=True))
+        for i in range(0, len(order_ids), 500):
+            chunk = order_ids[i:i + 500]
+            TicketUserCode.objects.filter(order_id__in=chunk, status=TicketUserCode.STATUS_DEFAULT).update(
+                status=TicketUserCode.STATUS_OVER_TIME)
+            cls.objects.filter(id__in=chunk, status=cls.STATUS_PAID).update(status=cls.STATUS_FINISH)
+        return len(order_ids)
+
+    @classmethod
+    def sweep_auto_check(cls):
+        return cls.objects.filter(pay_type=Receipt.PAY_WeiXin_LP, status=cls.STATUS_PAID).order_by().values_list(
+            'session_id', 'session__end_at').distinct()
 
     @classmethod
     def auth_check_over_time_code_tiktok(cls):
@@ -4032,13 +4249,8 @@ class TicketOrder(models.Model):
     @classmethod
     def check_auto_expire(cls):
         close_old_connections()
-        now = timezone.now()
-        from mp.models import BasicConfig
-        bc = BasicConfig.get()
-        auto_cancel_minutes = bc.auto_cancel_minutes if bc else 10
-        expire_at = now + timedelta(minutes=-auto_cancel_minutes)
-        for order in cls.objects.filter(create_at__lte=expire_at, status=cls.STATUS_UNPAID):
-            order.cancel()
+        from ticket.order_expiry import OrderExpiryPipeline
+        return OrderExpiryPipeline().run()
 
     def set_finish(self):
         self.status = self.STATUS_FINISH
@@ -4326,72 +4538,15 @@ class TicketOrder(models.Model):
         return data
 
     @classmethod
-    def down_to_excel(cls, ids=list):
-        queryset = cls.objects.filter(id__in=ids)
-        if not queryset:
+    def down_to_excel(cls, ids=list, progress=None):
+        """
+        progress: progress(done, total), 每导出一批回调一次
+        """
+        if not ids:
             return None
-        # import xlwt
-        from openpyxl import Workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.append(TicketOrder.export_fields())
-        from ticket.utils import excel_dir, _write_row_by_xlwt
-        # wb = xlwt.Workbook(encoding='utf-8')
-        # ws = wb.add_sheet('演出订单')
-        # row_index = 1
-        # _write_row_by_xlwt(ws, cls.export_fields(), row_index)
-        # row_index += 1
+        from ticket.order_export import TicketOrderExporter
         log.warning('演出订单导出开始')
-        dir, rel_url, xlsx_dir = excel_dir()
-        filename = '{}{}.xlsx'.format(timezone.now().strftime('%Y%m%d%H%M%S'), random_str(10))
-        filepath = os.path.join(dir, filename)
-        for record in queryset:
-            create_at = record.create_at.strftime('%Y-%m-%d %H:%M:%S')
-            pay_at = record.pay_at.strftime('%Y-%m-%d %H:%M:%S') if record.pay_at else None
-            start_at = record.start_at.strftime('%Y-%m-%d %H:%M:%S') if record.start_at else None
-            seat_desc = ''
-            level_desc = ''
-            pay_desc = ''
-            if record.wx_pay_config:
-                pay_desc = record.wx_pay_config.title
-            if record.dy_pay_config:
-                pay_desc = record.dy_pay_config.title
-            tu_qs = TicketUserCode.objects.filter(order=record)
-            discount_coupon = ''
-            discount_pack = ''
-            discount_promotion = ''
-            discount_orders = record.discount_order.all()
-            if discount_orders:
-                for discount in discount_orders:
-                    if discount.discount_type == TicketOrderDiscount.DISCOUNT_COUPON:
-                        discount_coupon = discount.amount
-                    elif discount.discount_type == TicketOrderDiscount.DISCOUNT_PACK:
-                        discount_pack = discount.amount
-                    elif discount.discount_type == TicketOrderDiscount.DISCOUNT_PROMOTION:
-                        discount_promotion = discount.amount
-            for tu in tu_qs:
-                seat_desc_t, level_desc_t = tu.get_export_data(record.venue)
-                seat_desc = seat_desc + ',{}'.format(seat_desc_t) if seat_desc else seat_desc_t
-                level_desc = level_desc + level_desc_t if level_desc else level_desc_t
-            real_name_desc = None
-            if hasattr(record, 'real_name_order'):
-                for rl in record.real_name_order.all():
-                    if not real_name_desc:
-                        real_name_desc = f'{rl.name}-{rl.mobile}-{rl.id_card}'
-                    else:
-                        real_name_desc += f',{rl.name}-{rl.mobile}-{rl.id_card}'
-            data = [str(record.user), record.mobile, record.show_express_address,
-                    str(record.agent) if record.agent else None,
-                    record.get_pay_type_display(), pay_desc, seat_desc, level_desc,
-                    record.order_no, record.receipt.payno, record.receipt.transaction_id, record.multiply,
-                    record.amount, record.actual_amount, record.express_fee,
-                    record.get_status_display(), record.title, create_at, pay_at, start_at,
-                    str(record.venue), record.get_channel_type_display(), discount_coupon, discount_promotion,
-                    discount_pack, real_name_desc]
-            ws.append(data)
-        # _write_row_by_xlwt(ws, ['END'], row_index)
-        wb.save(filepath)
-        return '{}/{}'.format(xlsx_dir, filename)
+        return TicketOrderExporter(ids, progress).export()
 
 
 class TicketOrderRealName(models.Model):
@@ -4636,13 +4791,13 @@ class TicketUserCode(models.Model):
     def is_cy_code(self):
         return hasattr(self, 'cy_code')
 
-    def get_export_data(self, venue):
+    def get_export_data(self, venue, layer_names: dict = None):
         if self.session_seat:
             if self.is_cy_code:
                 snapshot = json.loads(self.cy_code.snapshot)
                 seat_desc = snapshot.get('seat')
             else:
-                seat_desc = self.session_seat.seat_desc(venue)
+                seat_desc = self.session_seat.seat_desc(venue, layer_names)
         else:
             seat_desc = '无座'
         snapshot = json.loads(self.snapshot)
@@ -4663,6 +4818,8 @@ class TicketUserCode(models.Model):
         self.give_mobile = None
         self.give_id = 0
         self.save(update_fields=['give_status', 'give_mobile', 'give_id'])
+        from ticket.gate_check import drop_order
+        drop_order(self.order)
 
     def confirm_give(self):
         self.give_status = self.GIVE_FINISH
@@ -4805,20 +4962,39 @@ class TicketUserCode(models.Model):
 
     @classmethod
     def create_record(cls, order, session_seat=None, ticket_level=None):
-        # from common import qrutils
         if not ticket_level:
             ticket_level = session_seat.ticket_level
-        inst = cls.objects.create(order=order, level_id=ticket_level.id, session_seat=session_seat,
-                                  price=ticket_level.price,
-                                  session_id=ticket_level.session.id, product_id=ticket_level.product_id)
-        inst.code = inst.get_code()
-        # dir, rel_url, img_dir = qrcode_dir_tk()
-        # filename = 'code_{}_v{}.jpg'.format(inst.id, 1)
-        # file_path = os.path.join(dir, filename)
-        # qrutils.generate(inst.code, size=(410, 410), save_path=file_path)
-        # inst.code_img = '{}/{}'.format(img_dir, filename)
-        inst.snapshot = inst.get_snapshot(session_seat, ticket_level)
-        inst.save(update_fields=['code', 'snapshot'])
+        cls.bulk_create_records(order, [(ticket_level, session_seat)])
+
+    @classmethod
+    def bulk_create_records(cls, order, items: list):
+        """
+        付款后批量出票
+        items: [(票档, 座位)], 无座时座位为None, 票档需要select_related('color')
+        快照在内存里拼, 场馆楼层只查一次, 一次bulk_create;
+        检票码和get_code一样由主键生成保证不重复, mysql的bulk_create不返回主键, 写入后按订单查一次主键再bulk_update
+        """
+        if not items:
+            return []
+        layer_names = None
+        if any(session_seat for _, session_seat in items):
+            layer_names = dict()
+            if order.venue_id:
+                for layer, name in VenuesLayers.objects.filter(venue_id=order.venue_id).values_list('layer', 'name'):
+                    layer_names[(order.venue_id, layer)] = name
+        objs = []
+        for ticket_level, session_seat in items:
+            seat = session_seat.seat_desc(order.venue, layer_names) if session_seat else ''
+            objs.append(cls(order=order, level_id=ticket_level.id, session_seat=session_seat, price=ticket_level.price,
+                            session_id=ticket_level.session_id, product_id=ticket_level.product_id,
+                            snapshot=cls.build_snapshot(ticket_level, seat)))
+        with atomic():
+            cls.objects.bulk_create(objs)
+            objs = list(cls.objects.filter(order=order, code__isnull=True).only('id'))
+            for inst in objs:
+                inst.code = inst.get_code()
+            cls.objects.bulk_update(objs, ['code'])
+        return objs
 
     def del_code_img(self):
         try:
@@ -4924,7 +5100,6 @@ class TicketUserCode(models.Model):
         return str(code)
 
     def get_snapshot(self, session_seat=None, ticket_level=None):
-        import json
         """
         商品快照
         :return:
@@ -4932,6 +5107,10 @@ class TicketUserCode(models.Model):
         seat = ''
         if session_seat:
             seat = session_seat.seat_desc(self.order.venue)
+        return self.build_snapshot(ticket_level, seat)
+
+    @staticmethod
+    def build_snapshot(ticket_level, seat: str = '') -> str:
         data = dict(color=ticket_level.color.name,
                     origin_price=float(ticket_level.origin_price), desc=ticket_level.desc,
                     seat=seat,
@@ -4942,6 +5121,17 @@ class TicketUserCode(models.Model):
     def check_code_order(cls, user, session_id, code):
         # session_id is no
         # session_id = int(session_id)
+        from ticket.gate_check import gate_scan, MODE_ORDER, ST_OK, ST_CHECKED, ST_EARLY
+        gate = gate_scan(user, session_id, code, MODE_ORDER)
+        if gate:
+            status, snapshot, codes = gate
+            if status == ST_CHECKED:
+                raise CustomAPIException('二维码已核销')
+            if status == ST_OK:
+                return dict(status=bool(codes), msg='' if codes else '该二维码已经核销过了', snapshot=snapshot,
+                            success=len(codes), fail=0)
+            msg = '未到开始验票时间，请核对后重试！' if status == ST_EARLY else '该场次已结束了'
+            return dict(status=False, msg=msg, snapshot=snapshot, success=0, fail=len(codes))
         inst = cls.objects.filter(code=code).first()
         if not inst or (not inst.order):
             raise CustomAPIException('二维码无效')
@@ -4970,7 +5160,7 @@ class TicketUserCode(models.Model):
                                     check_at__isnull=True, give_id=0)
             ret = dict(status=False, msg='', snapshot=None, success=0, fail=0)
             for inst in qs:
-                status, msg, snapshot = cls.check_code(user, session_id, inst.code, inst)
+                status, msg, snapshot = cls.db_check_code(user, session_id, inst.code, inst)
                 if status:
                     # 一条成功就算成功
                     ret['status'] = status
@@ -4984,8 +5174,23 @@ class TicketUserCode(models.Model):
             return ret
 
     @classmethod
-    @atomic
     def check_code(cls, user, session_id, code, inst=None):
+        if not inst:
+            from ticket.gate_check import gate_scan, MODE_CODE, ST_OK, ST_CHECKED, ST_EARLY
+            gate = gate_scan(user, session_id, code, MODE_CODE)
+            if gate:
+                status, snapshot, codes = gate
+                if status == ST_OK and codes:
+                    return True, '', snapshot
+                if status in [ST_OK, ST_CHECKED]:
+                    return False, '该二维码已经核销过了', None
+                msg = '未到开始验票时间，请核对后重试！' if status == ST_EARLY else '该场次已结束了'
+                return False, msg, snapshot
+        return cls.db_check_code(user, session_id, code, inst)
+
+    @classmethod
+    @atomic
+    def db_check_code(cls, user, session_id, code, inst=None):
         # 防止同时检验时两边都成功
         # log.debug('开始验票')
         # session_id = int(session_id)
@@ -6097,6 +6302,7 @@ class DownLoadTask(models.Model):
     TY_CHOICES = ((TY_ORDER, '演出订单'),)
     source_type = models.IntegerField('类型', choices=TY_CHOICES, default=TY_ORDER)
     export_file = models.FileField('文件', null=True, blank=True)
+    progress = models.IntegerField('进度(%)', default=0, editable=False)
     create_at = models.DateTimeField('导出时间', auto_now_add=True)
 
     class Meta:
@@ -6107,6 +6313,12 @@ class DownLoadTask(models.Model):
     def create_record(cls, name):
         return cls.objects.create(name=name)
 
+    def set_progress(self, done: int, total: int):
+        progress = int(done * 100 / total) if total else 100
+        if progress != self.progress:
+            self.progress = progress
+            self.save(update_fields=['progress'])
+
     def pika_down_key(self):
         from caches import pika_down_key
         return pika_down_key.format(self.id)
@@ -6126,11 +6338,12 @@ class DownLoadTask(models.Model):
                     export_file = None
                     if ids:
                         ids = json.loads(ids)
-                        export_file = TicketOrder.down_to_excel(ids)
+                        export_file = TicketOrder.down_to_excel(ids, inst.set_progress)
                     if export_file:
                         inst.export_file = export_file
                         inst.status = cls.ST_SUCCESS
-                        inst.save(update_fields=['export_file', 'status'])
+                        inst.progress = 100
+                        inst.save(update_fields=['export_file', 'status', 'progress'])
                         # 执行完删除
                         redis.delete(key)
                     else:
@@ -6246,44 +6459,12 @@ class TicketGiveRecord(UseNoAbstract):
     @classmethod
     def send_show_start_notice_give(cls):
         close_old_connections()
-        hours = 2
-        start_at = timezone.now() + timedelta(hours=hours)
-        start_at_day = timezone.now() + timedelta(hours=24)
+        from ticket.show_notice import NoticeDispatcher
         try:
-            from qcloud.sms import get_sms
-            sms = get_sms()
+            dispatcher = NoticeDispatcher()
         except Exception as e:
             return
-        # log.error(start_at)
-        two_qs = cls.objects.filter(push_message=False, session__start_at__lte=start_at, status=cls.STAT_FINISH)
-        has_send_dict = dict()
-        for give in two_qs:
-            if not has_send_dict.get(give.mobile, None):
-                has_send_dict[give.mobile] = 1
-                order = give.order
-                try:
-                    data = dict(name=order.title, mobile=give.give_mobile, number=2,
-                                time=give.session.start_at.strftime("%Y-%m-%d %H:%M"))
-                    sms.smsvrcode(data)
-                except Exception as e:
-                    log.error('发送短息消息失败')
-                give.push_message = True
-                give.push_message_day = True
-                give.save(update_fields=['push_message', 'push_message_day'])
-        has_send_dict = dict()
-        day_qs = cls.objects.filter(push_message_day=False, session__start_at__lte=start_at_day, status=cls.STAT_FINISH)
-        for give in day_qs:
-            if not has_send_dict.get(give.mobile, None):
-                has_send_dict[give.mobile] = 1
-                order = give.order
-                try:
-                    data = dict(name=order.title, mobile=give.give_mobile, number=24,
-                                time=give.session.start_at.strftime("%Y-%m-%d %H:%M"))
-                    sms.smsvrcode(data)
-                except Exception as e:
-                    log.error('发送短息消息失败')
-                give.push_message_day = True
-                give.save(update_fields=['push_message_day'])
+        return dispatcher.run('give')
 
 
 class TicketGiveDetail(models.Model):
@@ -6329,3 +6510,21 @@ class TicketWatchingNotice(TicketNoticeAbstract):
 
     class Meta:
         verbose_name_plural = verbose_name = '观演须知'
+
+
+def parse_session_actual_amount(val: str):
+    session_id, amount = json.loads(val)
+    return session_id, dict(actual_amount=amount)
+
+
+performer_focus_counter = DeltaCounter('performer_focus_num', ShowPerformer, ['focus_num'], legacy_key=performer_key)
+session_actual_amount_counter = DeltaCounter('session_actual_amount', SessionInfo, ['actual_amount'],
+                                             legacy_key=session_actual_amount_key,
+                                             legacy_parse=parse_session_actual_amount)
+level_sales_counter = DeltaCounter('level_sales', TicketFile, ['sales'], min_values=dict(sales=0),
+                                   legacy_key=level_sales_key)
+
+# 到期任务, 项目和场次保存时(signals)登记到期时间
+show_off_work = DueWork('show_off', ShowProject.expire_off_due, sweep=ShowProject.sweep_expire_off)
+session_off_work = DueWork('session_off', SessionInfo.expire_off_due, sweep=SessionInfo.sweep_expire_off)
+session_auto_check_work = DueWork('session_auto_check', TicketOrder.auto_check_due, sweep=TicketOrder.sweep_auto_check)
@@ -0,0 +1,365 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from caches import get_redis, order_expire_index_key, order_expire_synced_key, order_expire_stats_key, \
+    order_expire_release_key, get_redis_name
+
+log = logging.getLogger(__name__)
+
+"""
+未付款订单自动取消(TicketOrder.check_auto_expire):
+未付款订单按下单时间放入redis有序集合, 每次执行先把新订单同步进索引, 只取已超时的订单, 每批batch_size个.
+需要查询支付状态的订单用有上限的线程池并发查询, 已付款的走biz_paid;
+其余订单在一个事务里锁定并批量改为已取消, 再整批释放: 无座库存合并成一次batch_incr, 有座座位一次查询,
+座位锁一个pipeline删除, 座位缓存批量写入(SessionSeat.bulk_release_pika), 座位一次UPDATE.
+单个订单处理失败时推迟retry_delay秒再试(索引score按下单时间计, 推迟即设为 now+retry_delay-超时时间).
+已取消但释放失败的订单记入释放重试hash(订单ID->失败的步骤), 之后每次执行只重试失败的步骤, 不会重复返还.
+统计见 metrics().
+配置(env.yml, 可选):
+order_expire:
+  batch_size: 200
+  query_workers: 10  # 并发查询支付状态的线程数
+"""
+order_expire_lock_key = get_redis_name('order_expire_lock')
+
+
+def to_ts(dt) -> int:
+    return int(time.mktime(dt.timetuple()))
+
+
+class OrderExpiryPipeline(object):
+    batch_size = 200
+    query_workers = 10
+    # 每次同步时从上次同步到的ID往前多取的数量, 未提交的事务可能让小ID晚出现
+    sync_overlap = 1000
+    # 每次任务最长执行时间(s), 剩下的下次执行
+    time_budget = 50
+    retry_delay = 60
+    lock_expire = 120
+    # 释放失败的最多重试次数
+    release_max_tries = 10
+    RELEASE_PHASES = ('real_name', 'cy', 'stock', 'seat')
+
+    def __init__(self):
+        from common.config import get_config
+        conf = get_config().get('order_expire') or dict()
+        self.batch_size = conf.get('batch_size', self.batch_size)
+        self.query_workers = conf.get('query_workers', self.query_workers)
+        self.executor = None
+
+    @staticmethod
+    def get_cancel_minutes() -> int:
+        from mp.models import BasicConfig
+        bc = BasicConfig.get()
+        return bc.auto_cancel_minutes if bc else 10
+
+    @staticmethod
+    def query_pay_types() -> list:
+        from mall.models import Receipt
+        return [Receipt.PAY_WeiXin_LP, Receipt.PAY_WeiXin_MP, Receipt.PAY_WeiXin_APP, Receipt.PAY_TikTok_LP]
+
+    def sync(self) -> int:
+        """
+        新的未付款订单加入索引, 第一次执行时加载全部未付款订单
+        """
+        from django.db.models import Max
+        from ticket.models import TicketOrder
+        redis = get_redis()
+        last_id = redis.get(order_expire_synced_key)
+        qs = TicketOrder.objects.order_by()
+        if last_id is None:
+            max_id = TicketOrder.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+            qs = qs.filter(status=TicketOrder.STATUS_UNPAID, id__lte=max_id)
+        else:
+            max_id = int(last_id)
+            qs = qs.filter(id__gt=max(max_id - self.sync_overlap, 0))
+        num = 0
+        with redis.pipeline(transaction=False) as pipe:
+            for _id, create_at, status in qs.values_list('id', 'create_at', 'status').iterator():
+                max_id = max(max_id, _id)
+                if status == TicketOrder.STATUS_UNPAID:
+                    # 已推迟重试的订单不覆盖
+                    pipe.zadd(order_expire_index_key, {_id: to_ts(create_at)}, nx=True)
+                    num += 1
+            pipe.set(order_expire_synced_key, max_id)
+            pipe.execute()
+        return num
+
+    def get_due(self, minutes: int) -> list:
+        return get_redis().zrangebyscore(order_expire_index_key, '-inf', time.time() - minutes * 60, start=0,
+                                         num=self.batch_size)
+
+    @staticmethod
+    def query_paid(order) -> bool:
+        from django.db import connection
+        try:
+            order.receipt.query_status(order.order_no)
+            return order.receipt.paid
+        finally:
+            # 线程池里的数据库连接用完即关
+            connection.close()
+
+    def release(self, orders: list, phases: dict = None) -> dict:
+        """
+        和release_seat(is_cancel=True)一样, 按整批处理
+        phases: {订单ID: 要执行的步骤}, 默认执行全部步骤(RELEASE_PHASES)
+        返回失败的 {订单ID: 步骤}; 实名和彩艺按订单执行, 库存是一次原子的batch_incr, 座位释放可重复执行,
+        所以只重试失败的步骤不会重复返还
+        """
+        from ticket.models import TicketOrder, TicketFile, SessionSeat, SessionInfo
+        from ticket.stock_updater import tfc
+        from caches import session_seat_key
+        failed = dict()
+
+        def todo(order, phase):
+            return phases is None or phase in phases.get(order.id, ())
+
+        def fail(order_list, phase, e):
+            log.error('order expire release {} error: {}, {}'.format(phase, [order.order_no for order in order_list],
+                                                                      e))
+            for order in order_list:
+                failed.setdefault(order.id, set()).add(phase)
+
+        levels = []
+        stock_orders = []
+        seat_orders = dict()
+        for order in orders:
+            if order.order_type not in [TicketOrder.TY_NO_SEAT, TicketOrder.TY_HAS_SEAT]:
+                continue
+            if todo(order, 'real_name'):
+                try:
+                    for real_user in order.real_name_order.all():
+                        # 减去已买的
+                        TicketOrder.get_or_set_real_name_buy_num(order.session_id, real_user.id_card,
+                                                                 -order.multiply, is_get=False)
+                except Exception as e:
+                    fail([order], 'real_name', e)
+            if order.channel_type == TicketOrder.SR_CY:
+                # 彩艺订单不返回库存和座位等
+                if todo(order, 'cy') and hasattr(order, 'cy_order'):
+                    try:
+                        order.cy_order.cancel_order()
+                    except Exception as e:
+                        fail([order], 'cy', e)
+            elif order.session.has_seat == SessionInfo.SEAT_NO:
+                if todo(order, 'stock'):
+                    stock_orders.append(order)
+                    for ll in json.loads(order.snapshot)['price_list']:
+                        levels.append((order.session_id, int(ll['level_id']), int(ll['multiply'])))
+            elif todo(order, 'seat'):
+                seat_orders[order.order_no] = order
+        if levels:
+            try:
+                valid = set(TicketFile.objects.filter(id__in=set([level_id for _, level_id, _ in levels])).values_list(
+                    'id', 'session_id'))
+                increments = dict()
+                for session_id, level_id, multiply in levels:
+                    if (level_id, session_id) in valid:
+                        increments[level_id] = increments.get(level_id, 0) + multiply
+                if increments:
+                    succ, _ = tfc.batch_incr([(level_id, num, 0) for level_id, num in increments.items()],
+                                             record_update_ts=True)
+                    if not succ:
+                        log.warning('order expire return stock failed: {}'.format(increments))
+            except Exception as e:
+                fail(stock_orders, 'stock', e)
+        if seat_orders:
+            try:
+                seats = list(SessionSeat.objects.filter(order_no__in=list(seat_orders.keys())))
+                if seats:
+                    with get_redis().pipeline(transaction=False) as pipe:
+                        for inst in seats:
+                            # 下单的锁
+                            pipe.delete(session_seat_key.format(inst.ticket_level_id, inst.seats_id))
+                        pipe.execute()
+                    SessionSeat.bulk_release_pika(
+                        [inst for inst in seats if not seat_orders[inst.order_no].need_refund_mz])
+                    SessionSeat.objects.filter(id__in=[inst.id for inst in seats]).update(order_no=None,
+                                                                                          is_buy=False,
+                                                                                          buy_desc=None)
+            except Exception as e:
+                fail(list(seat_orders.values()), 'seat', e)
+        return failed
+
+    def add_release_retry(self, failed: dict):
+        if failed:
+            get_redis().hmset(order_expire_release_key, {
+                _id: json.dumps(dict(phases=sorted(phases), tries=0)) for _id, phases in failed.items()})
+
+    def retry_release(self) -> int:
+        """
+        重试已取消但释放失败的订单, 每次最多batch_size个, 返回重试成功的数量
+        """
+        from ticket.models import TicketOrder
+        redis = get_redis()
+        items = redis.hgetall(order_expire_release_key)
+        if not items:
+            return 0
+        items = dict([(int(_id), json.loads(val)) for _id, val in list(items.items())[:self.batch_size]])
+        orders = list(TicketOrder.objects.filter(id__in=items.keys()).select_related('session', 'cy_order')
+                      .prefetch_related('real_name_order'))
+        failed = self.release(orders, dict([(_id, set(item['phases'])) for _id, item in items.items()]))
+        with redis.pipeline(transaction=False) as pipe:
+            pipe.hdel(order_expire_release_key, *items.keys())
+            for _id, phases in failed.items():
+                tries = items[_id]['tries'] + 1
+                if tries < self.release_max_tries:
+                    pipe.hset(order_expire_release_key, _id, json.dumps(dict(phases=sorted(phases), tries=tries)))
+                else:
+                    log.error('order expire release give up: {}, {}'.format(_id, phases))
+            pipe.execute()
+        return len(orders) - len(failed)
+
+    def after_cancel(self, order):
+        from mall.models import Receipt, TheaterCardChangeRecord
+        if order.card_jc_amount > 0 and order.pay_type == Receipt.PAY_CARD_JC:
+            TheaterCardChangeRecord.add_record(user=order.user, source_type=TheaterCardChangeRecord.SOURCE_TYPE_CANCEL,
+                                               amount=order.card_jc_amount, ticket_order=order)
+        if hasattr(order, 'coupon_order'):
+            order.coupon_order.cancel_use()
+
+    def retry_score(self, minutes: int) -> float:
+        # 索引按下单时间排序, get_due取 score <= now - 超时时间, 推迟retry_delay秒即 now + retry_delay - 超时时间
+        return time.time() + self.retry_delay - minutes * 60
+
+    def process(self, ids: list, minutes: int) -> dict:
+        from django.db import transaction
+        from ticket.models import TicketOrder
+        ret = dict(cancelled=0, paid=0, skipped=0, error=0, query=0)
+        retry = []
+        orders = list(TicketOrder.objects.filter(id__in=ids, status=TicketOrder.STATUS_UNPAID).select_related(
+            'receipt', 'session', 'user', 'coupon_order', 'cy_order').prefetch_related('real_name_order'))
+        ret['skipped'] = len(ids) - len(orders)
+        query_orders = [order for order in orders if order.receipt and order.receipt.pay_type in self.query_pay_types()]
+        if query_orders:
+            start = time.time()
+            list(self.executor.map(self.query_paid, query_orders))
+            ret['query'] = len(query_orders)
+            ret['query_cost'] = time.time() - start
+        cancel_orders = []
+        for order in orders:
+            if order.receipt and order.receipt.paid:
+                try:
+                    order.receipt.biz_paid()
+                    ret['paid'] += 1
+                except Exception as e:
+                    log.error('order expire biz_paid error: {}, {}'.format(order.order_no, e))
+                    retry.append(order.id)
+            else:
+                cancel_orders.append(order)
+        if cancel_orders:
+            with transaction.atomic():
+                # 支付通知可能同时到达, 只取消锁定时仍未付款的
+                locked = set(TicketOrder.objects.select_for_update().filter(
+                    id__in=[order.id for order in cancel_orders], status=TicketOrder.STATUS_UNPAID).values_list(
+                    'id', flat=True))
+                TicketOrder.objects.filter(id__in=locked).update(status=TicketOrder.STATUS_CANCELED)
+            cancel_orders = [order for order in cancel_orders if order.id in locked]
+            for order in cancel_orders:
+                order.status = TicketOrder.STATUS_CANCELED
+            # 订单已取消, 不能重试整批, 失败的步骤单独重试
+            failed = self.release(cancel_orders)
+            self.add_release_retry(failed)
+            ret['error'] += len(failed)
+            for order in cancel_orders:
+                try:
+                    self.after_cancel(order)
+                except Exception as e:
+                    log.error('order expire after cancel error: {}, {}'.format(order.order_no, e))
+                    ret['error'] += 1
+            ret['cancelled'] = len(cancel_orders)
+        redis = get_redis()
+        with redis.pipeline(transaction=False) as pipe:
+            done = set([str(_id) for _id in ids]) - set([str(_id) for _id in retry])
+            if done:
+                pipe.zrem(order_expire_index_key, *done)
+            if retry:
+                pipe.zadd(order_expire_index_key, {_id: self.retry_score(minutes) for _id in retry}, xx=True)
+                ret['error'] += len(retry)
+            pipe.execute()
+        return ret
+
+    def delay(self, ids: list, minutes: int):
+        get_redis().zadd(order_expire_index_key, {_id: self.retry_score(minutes) for _id in ids}, xx=True)
+
+    def record(self, ret: dict, cost: float):
+        with get_redis().pipeline(transaction=False) as pipe:
+            for field in ['cancelled', 'paid', 'skipped', 'error', 'query']:
+                if ret.get(field):
+                    pipe.hincrby(order_expire_stats_key, field, ret[field])
+            pipe.hincrby(order_expire_stats_key, 'batch', 1)
+            pipe.hincrbyfloat(order_expire_stats_key, 'cost_total', cost)
+            if ret.get('query_cost'):
+                pipe.hincrbyfloat(order_expire_stats_key, 'query_cost_total', ret['query_cost'])
+            pipe.hset(order_expire_stats_key, 'last_cost', round(cost, 3))
+            pipe.hset(order_expire_stats_key, 'last_at', int(time.time()))
+            pipe.execute()
+
+    def run(self) -> int:
+        """
+        返回取消的订单数
+        """
+        redis = get_redis()
+        if not redis.set(order_expire_lock_key, 1, nx=True, ex=self.lock_expire):
+            return 0
+        begin = time.time()
+        num = 0
+        try:
+            self.sync()
+            minutes = self.get_cancel_minutes()
+            try:
+                self.retry_release()
+            except Exception as e:
+                log.error('order expire retry release error: {}'.format(e))
+            with ThreadPoolExecutor(max_workers=self.query_workers, thread_name_prefix='order_expire') as executor:
+                self.executor = executor
+                while time.time() - begin < self.time_budget:
+                    ids = self.get_due(minutes)
+                    if not ids:
+                        break
+                    start = time.time()
+                    try:
+                        ret = self.process(ids, minutes)
+                    except Exception as e:
+                        log.error('order expire batch error: {}'.format(e))
+                        self.delay(ids, minutes)
+                        ret = dict(error=len(ids))
+                    self.record(ret, time.time() - start)
+                    num += ret.get('cancelled', 0)
+        finally:
+            self.executor = None
+            redis.delete(order_expire_lock_key)
+        if num:
+            log.info('order expire: {}, {:.2f}s, {}'.format(num, time.time() - begin, self.metrics()))
+        return num
+
+    @classmethod
+    def metrics(cls) -> dict:
+        """
+        indexed: 索引中的未付款订单数, due: 已超时待处理数, oldest_overdue: 最早超时订单已超时的时间(s),
+        release_retry: 已取消待重试释放的订单数
+        cancelled/paid/skipped/error: 累计取消、查询后已付款、已不是未付款、失败的订单数
+        rate: 平均每秒处理的订单数(含已付款和跳过)
+        """
+        redis = get_redis()
+        deadline = time.time() - cls.get_cancel_minutes() * 60
+        with redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(order_expire_index_key)
+            pipe.zcount(order_expire_index_key, '-inf', deadline)
+            pipe.zrange(order_expire_index_key, 0, 0, withscores=True)
+            pipe.hgetall(order_expire_stats_key)
+            pipe.hlen(order_expire_release_key)
+            indexed, due, oldest, stats, release_retry = pipe.execute()
+        ret = dict(indexed=indexed, due=due, release_retry=release_retry,
+                   oldest_overdue=round(deadline - oldest[0][1], 3) if oldest and oldest[0][1] < deadline else 0)
+        for field in ['cancelled', 'paid', 'skipped', 'error', 'query', 'batch']:
+            ret[field] = int(stats.get(field) or 0)
+        cost = float(stats.get('cost_total') or 0)
+        total = ret['cancelled'] + ret['paid'] + ret['skipped']
+        ret['rate'] = round(total / cost, 2) if cost else 0
+        # 并发查询时每单分摊的查询耗时(s)
+        ret['query_avg'] = round(float(stats.get('query_cost_total') or 0) / ret['query'], 3) if ret['query'] else 0
+        ret['last_cost'] = float(stats.get('last_cost') or 0)
+        return ret
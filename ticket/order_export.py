@@ -0,0 +1,123 @@
+# coding: utf-8
+import logging
+import os
+from typing import Callable, List
+
+from django.db.models import Prefetch
+from django.utils import timezone
+
+log = logging.getLogger(__name__)
+
+"""
+演出订单导出(TicketOrder.down_to_excel):
+按id分批(chunk_size)加载订单, 每批用select_related/prefetch_related一次取完用户、推荐人、收款、商户、场馆、
+检票码(座位、彩艺码)、优惠和实名信息, 场馆楼层按场馆缓存成字典, 每批固定几条查询.
+openpyxl write_only模式逐行写入文件, 内存只保留当前一批订单. 每批完成后回调进度.
+"""
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class TicketOrderExporter(object):
+    chunk_size = 1000
+
+    def __init__(self, ids: List[int], progress: Callable = None):
+        """
+        progress: progress(done, total)
+        """
+        # 和TicketOrder默认排序一样按id倒序导出
+        self.ids = sorted(set(ids), reverse=True)
+        self.progress = progress
+        # (venue_id, layer) -> 楼层别名
+        self.layer_names = dict()
+        self._loaded_venues = set()
+
+    def get_queryset(self, ids: List[int]):
+        from ticket.models import TicketOrder, TicketUserCode
+        code_qs = TicketUserCode.objects.select_related('session_seat', 'cy_code')
+        return TicketOrder.objects.filter(id__in=ids).select_related(
+            'user', 'agent', 'receipt', 'wx_pay_config', 'dy_pay_config', 'venue').prefetch_related(
+            Prefetch('user_code', queryset=code_qs), 'discount_order', 'real_name_order').order_by('-pk')
+
+    def load_layer_names(self, venue_ids: set):
+        from ticket.models import VenuesLayers
+        venue_ids = venue_ids - self._loaded_venues
+        if venue_ids:
+            for venue_id, layer, name in VenuesLayers.objects.filter(venue_id__in=venue_ids).values_list(
+                    'venue_id', 'layer', 'name'):
+                self.layer_names[(venue_id, layer)] = name
+            self._loaded_venues.update(venue_ids)
+
+    def iter_chunks(self):
+        for i in range(0, len(self.ids), self.chunk_size):
+            orders = list(self.get_queryset(self.ids[i:i + self.chunk_size]))
+            self.load_layer_names(set([order.venue_id for order in orders if order.venue_id]))
+            yield orders
+
+    def get_row(self, record) -> list:
+        from ticket.models import TicketOrderDiscount
+        create_at = record.create_at.strftime(DATE_FORMAT)
+        pay_at = record.pay_at.strftime(DATE_FORMAT) if record.pay_at else None
+        start_at = record.start_at.strftime(DATE_FORMAT) if record.start_at else None
+        seat_desc = ''
+        level_desc = ''
+        pay_desc = ''
+        if record.wx_pay_config:
+            pay_desc = record.wx_pay_config.title
+        if record.dy_pay_config:
+            pay_desc = record.dy_pay_config.title
+        discount_coupon = ''
+        discount_pack = ''
+        discount_promotion = ''
+        for discount in record.discount_order.all():
+            if discount.discount_type == TicketOrderDiscount.DISCOUNT_COUPON:
+                discount_coupon = discount.amount
+            elif discount.discount_type == TicketOrderDiscount.DISCOUNT_PACK:
+                discount_pack = discount.amount
+            elif discount.discount_type == TicketOrderDiscount.DISCOUNT_PROMOTION:
+                discount_promotion = discount.amount
+        for tu in record.user_code.all():
+            seat_desc_t, level_desc_t = tu.get_export_data(record.venue, self.layer_names)
+            seat_desc = seat_desc + ',{}'.format(seat_desc_t) if seat_desc else seat_desc_t
+            level_desc = level_desc + level_desc_t if level_desc else level_desc_t
+        real_name_desc = None
+        for rl in record.real_name_order.all():
+            if not real_name_desc:
+                real_name_desc = f'{rl.name}-{rl.mobile}-{rl.id_card}'
+            else:
+                real_name_desc += f',{rl.name}-{rl.mobile}-{rl.id_card}'
+        receipt = record.receipt
+        return [str(record.user), record.mobile, record.show_express_address,
+                str(record.agent) if record.agent else None,
+                record.get_pay_type_display(), pay_desc, seat_desc, level_desc,
+                record.order_no, receipt.payno if receipt else None, receipt.transaction_id if receipt else None,
+                record.multiply, record.amount, record.actual_amount, record.express_fee,
+                record.get_status_display(), record.title, create_at, pay_at, start_at,
+                str(record.venue), record.get_channel_type_display(), discount_coupon, discount_promotion,
+                discount_pack, real_name_desc]
+
+    def write(self, filepath: str) -> int:
+        from openpyxl import Workbook
+        from ticket.models import TicketOrder
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(TicketOrder.export_fields())
+        done = 0
+        for orders in self.iter_chunks():
+            for record in orders:
+                ws.append(self.get_row(record))
+            done += len(orders)
+            if self.progress:
+                self.progress(done, len(self.ids))
+        wb.save(filepath)
+        return done
+
+    def export(self) -> str:
+        """
+        返回文件相对media的路径
+        """
+        from common.utils import random_str
+        from ticket.utils import excel_dir
+        dir, rel_url, xlsx_dir = excel_dir()
+        filename = '{}{}.xlsx'.format(timezone.now().strftime('%Y%m%d%H%M%S'), random_str(10))
+        self.write(os.path.join(dir, filename))
+        return '{}/{}'.format(xlsx_dir, filename)
@@ -10,7 +10,6 @@ from decimal import Decimal
 from mall.models import Receipt, TheaterCardUserRecord, TheaterCardUserBuy, TheaterCard, TheaterCardChangeRecord, \
     UserAddress
 from django.utils import timezone
-from caches import get_pika_redis
 from django.core.cache import cache
 from caches import cache_order_seat_key, cache_order_session_key, cache_order_show_key, redis_venues_copy_key
 import orjson
@@ -185,6 +184,9 @@ class TicketOrderCreateNoCommonSerializer(serializers.ModelSerializer):
 
     def change_stock_end(self, ticket_list):
         # 扣库存
+        if self.context.get('stock_reserved'):
+            # 异步下单已经预扣了库存(ticket.async_order), 失败时由它退回
+            return
         for data in ticket_list:
             multiply = int(data['multiply'])
             inst = data.get('level')
@@ -196,6 +198,8 @@ class TicketOrderCreateNoCommonSerializer(serializers.ModelSerializer):
 
     def return_change_stock(self, ticket_list):
         # 库存返回
+        if self.context.get('stock_reserved'):
+            return
         for data in ticket_list:
             multiply = int(data['multiply'])
             inst = data.get('level')
@@ -459,12 +463,11 @@ class TicketOrderOnSeatNewCreateSerializer(TicketOrderCreateNoCommonSerializer):
                 seat_dict[str(level.id)] += ll['multiply']
             else:
                 seat_dict[str(level.id)] = ll['multiply']
-        pika = get_pika_redis()
-        venue_data = pika.hget(redis_venues_copy_key, str(show.venues_id))
+        from caches.local_cache import l1_hget_json
+        venue_data = l1_hget_json(redis_venues_copy_key, show.venues_id)
         if not venue_data:
             venue_name = show.venues.name
         else:
-            venue_data = orjson.loads(venue_data)
             venue_name = venue_data['name']
         snapshot = TicketOrder.get_snapshot_new(dd, session, show, venue_name)
         validated_data['snapshot'] = orjson.dumps(snapshot)
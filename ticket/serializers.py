@@ -564,24 +564,24 @@ class ShowProjectCommonRelateSerializer(PKtoNoSerializer):
         return has_promote
 
     def get_show_type(self, obj):
-        from caches import get_pika_redis, redis_show_type_copy_key
-        with get_pika_redis() as pika:
-            data = pika.hget(redis_show_type_copy_key, str(obj.show_type_id))
+        from caches import redis_show_type_copy_key
+        from caches.local_cache import l1_hget_json
+        data = l1_hget_json(redis_show_type_copy_key, obj.show_type_id)
         # data = None
         if not data:
             return ShowTypeSerializer(obj.show_type, context=self.context).data
         else:
-            return json.loads(data)
+            return data
 
     def get_cate(self, obj):
         data = None
         if obj.cate:
-            from caches import get_pika_redis, redis_show_content_copy_key
-            with get_pika_redis() as pika:
-                data = pika.hget(redis_show_content_copy_key, str(obj.cate_id))
+            from caches import redis_show_content_copy_key
+            from caches.local_cache import l1_hget_json
+            data = l1_hget_json(redis_show_content_copy_key, obj.cate_id)
         # data = None
         if data:
-            return json.loads(data)
+            return data
         else:
             return ShowContentCategorySerializer(obj.cate).data
 
@@ -592,12 +592,13 @@ class ShowProjectRecommendSerializer(ShowProjectCommonRelateSerializer):
     venue = serializers.SerializerMethodField()
 
     def get_venue(self, obj):
-        from caches import get_pika_redis, redis_venues_copy_key
-        with get_pika_redis() as pika:
-            data = pika.hget(redis_venues_copy_key, str(obj.venues_id))
+        from caches import redis_venues_copy_key
+        from caches.local_cache import l1_hget_json
+        data = l1_hget_json(redis_venues_copy_key, obj.venues_id)
         # data = None
         if data:
-            data = json.loads(data)
+            # 本地缓存共享对象,复制后再修改
+            data = dict(data)
             data['city'] = data['city'].get('city')
             return data
         else:
@@ -623,12 +624,12 @@ class ShowProjectSerializer(ShowProjectCommonRelateSerializer):
     venues = serializers.SerializerMethodField()
 
     def get_venues(self, obj):
-        from caches import get_pika_redis, redis_venues_copy_key
-        with get_pika_redis() as pika:
-            data = pika.hget(redis_venues_copy_key, str(obj.venues_id))
+        from caches import redis_venues_copy_key
+        from caches.local_cache import l1_hget_json
+        data = l1_hget_json(redis_venues_copy_key, obj.venues_id)
         # data = None
         if data:
-            return json.loads(data)
+            return data
         else:
             return VenuesNewSerializer(obj.venues, context=self.context).data
 
@@ -1654,8 +1655,11 @@ class TicketGiveRecordCreateSerializer(serializers.ModelSerializer):
                                            order__user_id=user.id, status=TicketUserCode.STATUS_DEFAULT)
         if not qs or qs.count() != num:
             raise CustomAPIException('只有未使用且未赠送的票才能赠送')
+        order = qs.first().order
         inst = TicketGiveRecord.create_record(user, validated_data['give_mobile'], qs)
         qs.update(give_status=TicketUserCode.GIVE_UNCLAIMED, give_mobile=validated_data['give_mobile'], give_id=inst.id)
+        from ticket.gate_check import drop_order
+        drop_order(order)
         return inst
 
     class Meta:
@@ -1715,7 +1719,7 @@ class TicketOrderLockSeatSerializer(serializers.ModelSerializer):
 
     @atomic
     def create(self, validated_data):
-        from caches import with_redis, session_seat_key, lock_seat_key
+        from caches import with_redis, lock_seat_key
         main_session_id = validated_data['session_id']
         order_id = validated_data['order_id']
         user = self.context.get('request').user
@@ -1734,30 +1738,21 @@ class TicketOrderLockSeatSerializer(serializers.ModelSerializer):
                 num = code_qs.count()
                 if code_qs.count() != len(validated_data['seat_ids']):
                     raise CustomAPIException('请选择正确的座位数量，数量{}'.format(num))
-                seat_qs = SessionSeat.objects.filter(session__no=main_session_id, id__in=validated_data['seat_ids'])
+                seat_qs = list(SessionSeat.objects.filter(session__no=main_session_id,
+                                                          id__in=validated_data['seat_ids']))
                 for seat in seat_qs:
-                    kk = session_seat_key.format(seat.ticket_level.id, seat.id)
                     # 是否可卖，锁着的也可以手动出票
-                    if not seat.is_buy and not seat.order_no:
-                        if not redis.setnx(kk, 1):
-                            can_lock = False
-                            break
-                        else:
-                            redis.expire(kk, 30)
-                    else:
+                    if seat.is_buy or seat.order_no:
                         can_lock = False
                         break
                 if not can_lock:
-                    # 失败就全部删掉锁
-                    for seat in seat_qs:
-                        kk = session_seat_key.format(seat.ticket_level.id, seat.id)
-                        redis.delete(kk)
                     raise CustomAPIException('找不到满足条件的座位')
                 else:
+                    # 全部座位一次性锁定, 失败则全部不锁
+                    SessionSeat.batch_set_buy(seat_qs, 30, '找不到满足条件的座位')
                     i = 0
                     code_list = list(code_qs)
                     for session_seat in seat_qs:
-                        session_seat.set_buy()
                         # 写入订单号
                         session_seat.order_no = order.order_no
                         session_seat.change_pika_redis(is_buy=True, can_buy=False, order_no=order.order_no)
@@ -1765,7 +1760,7 @@ class TicketOrderLockSeatSerializer(serializers.ModelSerializer):
                         code_inst = code_list[i]
                         code_inst.session_seat = session_seat
                         i += 1
-                    SessionSeat.objects.bulk_update(list(seat_qs), ['order_no'])
+                    SessionSeat.objects.bulk_update(seat_qs, ['order_no'])
                     TicketUserCode.objects.bulk_update(code_list, ['session_seat'])
                     order.set_lock_seats(True)
                     # 发短信
@@ -0,0 +1,175 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from caches import get_redis, show_notice_lock_key, show_notice_stats_key
+from common.rate_limit import RateLimiter
+
+log = logging.getLogger(__name__)
+
+"""
+开场前短信提醒(TicketOrder.send_show_start_notice, TicketGiveRecord.send_show_start_notice_give):
+1. 一条带检票码是否存在(Exists)的查询取出到时间的订单/赠送记录, 每次最多batch_size条
+2. 发送前先整批update推送标记(认领), 执行锁避免两次执行重叠, 发送失败也不会重复发送, 与原来一致
+3. 线程池并发发送, 每个短信服务商一个限速器, 返回False或异常时重试retries次
+4. 发送结果整批记到统计(show_notice_stats_key), 失败的手机号整批写日志
+provider只需要实现 smsvrcode(data) -> bool, 可以换成 FakeSmsProvider 在本地验证.
+配置(env.yml, 可选):
+show_notice:
+  workers: 8
+  rate: 50
+  retries: 2
+  batch_size: 2000
+"""
+_limiters = dict()
+
+
+def get_limiter(provider, rate: float) -> RateLimiter:
+    name = provider.__class__.__name__
+    if name not in _limiters:
+        _limiters[name] = RateLimiter(rate)
+    return _limiters[name]
+
+
+class FakeSmsProvider(object):
+    """
+    本地模拟短信服务商: latency秒延迟, fail_ratio比例发送失败
+    """
+
+    def __init__(self, latency: float = 0.1, fail_ratio: float = 0):
+        self.latency = latency
+        self.fail_ratio = fail_ratio
+        self.sent = []
+
+    def smsvrcode(self, data):
+        time.sleep(self.latency)
+        if random.random() < self.fail_ratio:
+            return False
+        self.sent.append(data)
+        return True
+
+
+class NoticeDispatcher(object):
+    workers = 8
+    rate = 50
+    retries = 2
+    batch_size = 2000
+    lock_expire = 600
+
+    def __init__(self, provider=None, workers: int = None, rate: float = None):
+        from common.config import get_config
+        conf = get_config().get('show_notice') or dict()
+        if provider is None:
+            from qcloud.sms import get_sms
+            provider = get_sms()
+        self.provider = provider
+        self.workers = workers or conf.get('workers', self.workers)
+        self.retries = conf.get('retries', self.retries)
+        self.batch_size = conf.get('batch_size', self.batch_size)
+        self.limiter = get_limiter(provider, rate or conf.get('rate', self.rate))
+
+    def send_one(self, data: dict) -> bool:
+        for i in range(self.retries + 1):
+            if i:
+                time.sleep(0.5 * i)
+            self.limiter.wait()
+            try:
+                if self.provider.smsvrcode(data) is not False:
+                    return True
+            except Exception as e:
+                log.warning('发送短息消息失败: {}, {}'.format(data['mobile'], e))
+        return False
+
+    def send(self, kind: str, items: list) -> dict:
+        """
+        items: [短信data]
+        """
+        if not items:
+            return dict(sent=0, failed=0)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='show_notice') as executor:
+            results = list(executor.map(self.send_one, items))
+        failed = [data['mobile'] for data, ok in zip(items, results) if not ok]
+        if failed:
+            log.error('发送短息消息失败: {}'.format(failed))
+        sent = len(items) - len(failed)
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hincrby(show_notice_stats_key, '{}_sent'.format(kind), sent)
+            pipe.hincrby(show_notice_stats_key, '{}_failed'.format(kind), len(failed))
+            pipe.hset(show_notice_stats_key, '{}_last_cost'.format(kind), round(time.time() - start, 3))
+            pipe.execute()
+        return dict(sent=sent, failed=len(failed))
+
+    @staticmethod
+    def sms_data(title: str, mobile: str, number: int, start_at: datetime) -> dict:
+        return dict(name=title, mobile=mobile, number=number, time=start_at.strftime("%Y-%m-%d %H:%M"))
+
+    def order_items(self, now: datetime) -> list:
+        """
+        订单: 认领到时间的订单, 返回需要发送的短信(有未赠送的检票码)
+        """
+        from django.db.models import Exists, OuterRef
+        from ticket.models import TicketOrder, TicketUserCode
+        has_code = Exists(TicketUserCode.objects.filter(order_id=OuterRef('id'),
+                                                        give_status=TicketUserCode.GIVE_DEFAULT))
+        items = []
+        for number, flag in [(2, 'push_message'), (24, 'push_message_day')]:
+            rows = list(TicketOrder.objects.filter(**{flag: False}, session__start_at__lte=now + timedelta(hours=number),
+                                                   status=TicketOrder.STATUS_PAID).annotate(has_code=has_code).values(
+                'id', 'title', 'mobile', 'session__start_at', 'has_code')[:self.batch_size])
+            if not rows:
+                continue
+            # 2小时的提醒发了就不再发24小时的
+            update = dict(push_message=True, push_message_day=True) if flag == 'push_message' else \
+                dict(push_message_day=True)
+            TicketOrder.objects.filter(id__in=[row['id'] for row in rows]).update(**update)
+            items.extend([self.sms_data(row['title'], row['mobile'], number, row['session__start_at']) for row in rows
+                          if row['has_code']])
+        return items
+
+    def give_items(self, now: datetime) -> list:
+        """
+        赠送记录: 同一赠送人每次只发一条, 其余的下次再发
+        """
+        from ticket.models import TicketGiveRecord
+        items = []
+        for number, flag in [(2, 'push_message'), (24, 'push_message_day')]:
+            rows = list(TicketGiveRecord.objects.filter(**{flag: False},
+                                                        session__start_at__lte=now + timedelta(hours=number),
+                                                        status=TicketGiveRecord.STAT_FINISH).values(
+                'id', 'mobile', 'give_mobile', 'order__title', 'session__start_at')[:self.batch_size])
+            send_rows = dict()
+            for row in rows:
+                send_rows.setdefault(row['mobile'], row)
+            if not send_rows:
+                continue
+            update = dict(push_message=True, push_message_day=True) if flag == 'push_message' else \
+                dict(push_message_day=True)
+            TicketGiveRecord.objects.filter(id__in=[row['id'] for row in send_rows.values()]).update(**update)
+            items.extend([self.sms_data(row['order__title'], row['give_mobile'], number, row['session__start_at'])
+                          for row in send_rows.values()])
+        return items
+
+    def run(self, kind: str) -> dict:
+        """
+        kind: order 订单, give 赠送记录
+        """
+        redis = get_redis()
+        lock_key = show_notice_lock_key.format(kind)
+        if not redis.set(lock_key, 1, nx=True, ex=self.lock_expire):
+            return dict()
+        try:
+            now = datetime.now()
+            items = self.order_items(now) if kind == 'order' else self.give_items(now)
+            ret = self.send(kind, items)
+            if items:
+                log.info('show notice {}: {}'.format(kind, ret))
+            return ret
+        finally:
+            redis.delete(lock_key)
+
+
+def show_notice_metrics() -> dict:
+    return get_redis().hgetall(show_notice_stats_key)
@@ -0,0 +1,133 @@
+import logging
+import time
+
+from caches import get_redis, show_rebuild_queue_key, show_rebuild_first_key, show_rebuild_reason_key, \
+    show_rebuild_scheduled_key, show_rebuild_stats_key
+
+log = logging.getLogger(__name__)
+
+"""
+项目场次缓存重建队列(SessionInfo.redis_show_date_copy):
+场次保存时只把(show_id, reason)放入队列, 同一项目在队列里只有一条, score为最后一次入队时间.
+项目静默debounce秒(或首次入队超过max_wait秒)后由worker取出, 每个项目只重建一次场次列表和票档缓存.
+第一次入队时安排一个延迟任务, 定时任务兜底.
+"""
+
+
+class ShowRebuildQueue(object):
+    debounce = 2
+    max_wait = 10
+    batch_size = 100
+
+    @classmethod
+    def enqueue(cls, show_id: int, reason: str = ''):
+        now = time.time()
+        redis = get_redis()
+        with redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(show_rebuild_queue_key, {show_id: now})
+            pipe.hsetnx(show_rebuild_first_key, show_id, now)
+            pipe.hset(show_rebuild_reason_key, show_id, reason)
+            pipe.execute()
+        cls.schedule()
+
+    @classmethod
+    def schedule(cls):
+        """
+        保证只有一个待执行的延迟任务
+        """
+        if get_redis().set(show_rebuild_scheduled_key, 1, nx=True, ex=cls.max_wait * 3):
+            try:
+                from ticket.tasks import drain_show_rebuild_queue
+                drain_show_rebuild_queue.apply_async(countdown=cls.debounce)
+            except Exception as e:
+                # 定时任务兜底
+                log.error('schedule show rebuild error: {}'.format(e))
+
+    @classmethod
+    def get_due(cls, now: float) -> list:
+        redis = get_redis()
+        items = redis.zrange(show_rebuild_queue_key, 0, -1, withscores=True)
+        if not items:
+            return []
+        first_list = redis.hmget(show_rebuild_first_key, [show_id for show_id, _ in items])
+        due = []
+        for (show_id, last_at), first_at in zip(items, first_list):
+            if last_at <= now - cls.debounce or (first_at and float(first_at) <= now - cls.max_wait):
+                due.append(show_id)
+            if len(due) >= cls.batch_size:
+                break
+        return due
+
+    @classmethod
+    def claim(cls, show_id: str):
+        """
+        取出项目, 多个worker同时执行时只有一个能取到
+        """
+        with get_redis().pipeline() as pipe:
+            pipe.zrem(show_rebuild_queue_key, show_id)
+            pipe.hget(show_rebuild_first_key, show_id)
+            pipe.hget(show_rebuild_reason_key, show_id)
+            pipe.hdel(show_rebuild_first_key, show_id)
+            pipe.hdel(show_rebuild_reason_key, show_id)
+            removed, first_at, reason, _, _ = pipe.execute()
+        return removed, first_at, reason
+
+    @classmethod
+    def rebuild(cls, show_id: str, first_at, reason):
+        from ticket.models import ShowProject, SessionInfo
+        show = ShowProject.objects.filter(id=show_id).first()
+        if show:
+            SessionInfo.redis_show_session_copy(show)
+        latency = time.time() - float(first_at) if first_at else 0
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hincrby(show_rebuild_stats_key, 'count', 1)
+            pipe.hincrbyfloat(show_rebuild_stats_key, 'latency_total', latency)
+            pipe.hset(show_rebuild_stats_key, 'latency_last', round(latency, 3))
+            pipe.execute()
+        log.debug('show rebuild {}, reason: {}, latency: {:.3f}s'.format(show_id, reason, latency))
+
+    @classmethod
+    def drain(cls):
+        redis = get_redis()
+        redis.delete(show_rebuild_scheduled_key)
+        num = 0
+        while True:
+            due = cls.get_due(time.time())
+            if not due:
+                break
+            for show_id in due:
+                removed, first_at, reason = cls.claim(show_id)
+                if not removed:
+                    continue
+                try:
+                    cls.rebuild(show_id, first_at, reason)
+                    num += 1
+                except Exception as e:
+                    log.error('show rebuild {} error: {}'.format(show_id, e))
+                    redis.hincrby(show_rebuild_stats_key, 'error', 1)
+        # 还在防抖期的项目, 再安排一次
+        if redis.zcard(show_rebuild_queue_key):
+            cls.schedule()
+        if num:
+            log.info('show rebuild: {}, {}'.format(num, cls.metrics()))
+        return num
+
+    @classmethod
+    def metrics(cls) -> dict:
+        """
+        depth: 队列中待重建的项目数
+        oldest_wait: 队列中最早入队的项目已等待的时间(s)
+        count/latency_avg/latency_last: 已重建次数, 从首次入队到重建完成的平均/最近延迟(s)
+        """
+        redis = get_redis()
+        with redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(show_rebuild_queue_key)
+            pipe.hvals(show_rebuild_first_key)
+            pipe.hgetall(show_rebuild_stats_key)
+            depth, first_list, stats = pipe.execute()
+        count = int(stats.get('count') or 0)
+        oldest = min([float(first_at) for first_at in first_list]) if first_list else None
+        return dict(depth=depth, oldest_wait=round(time.time() - oldest, 3) if oldest else 0, count=count,
+                    error=int(stats.get('error') or 0),
+                    latency_avg=round(float(stats.get('latency_total') or 0) / count, 3) if count else 0,
+                    latency_last=float(stats.get('latency_last') or 0))
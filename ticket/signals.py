@@ -26,6 +26,7 @@ def sessioninfo_change_status(sender, **kwargs):
             instance.change_show_calendar()
     if created or update_fields:
         instance.redis_show_date_copy()
+    instance.register_due_work()
     if created:
         from statistical.models import TotalStatistical
         TotalStatistical.add_session_num()
@@ -73,6 +74,7 @@ def show_project_change(sender, **kwargs):
     logger.debug(update_fields)
     if created or update_fields:
         instance.shows_detail_copy_to_pika()
+    instance.register_due_work()
 
 
 @receiver(post_save, sender=TicketFile)
@@ -1,5 +1,5 @@
 import logging
-from typing import List, Type, Union
+from typing import List, Tuple, Type, Union
 
 from concu.stock_cache import StockCache, StockModel
 from ticket.models import TicketFile, SessionInfo
@@ -22,5 +22,9 @@ class TicketFileCache(StockCache):
     def save_stock_model(self, id: Union[int, str], qty: int) -> bool:
         return TicketFile.objects.filter(pk=id).update(stock=qty) == 1
 
+    def save_stock_models(self, items: List[Tuple[Union[int, str], int]]) -> List[Union[int, str]]:
+        TicketFile.objects.bulk_update([TicketFile(pk=_id, stock=qty) for _id, qty in items], ['stock'])
+        return [_id for _id, qty in items]
+
 
 tfc = TicketFileCache()
@@ -34,6 +34,38 @@ def add_session_actual_amount():
     SessionInfo.task_add_actual_amount()
 
 
+@shared_task
+def drain_show_rebuild_queue():
+    from django.db import close_old_connections
+    from ticket.show_rebuild import ShowRebuildQueue
+    close_old_connections()
+    return ShowRebuildQueue.drain()
+
+
+@shared_task
+def flush_gate_checks():
+    from django.db import close_old_connections
+    from ticket.gate_check import GateCheckRecorder
+    close_old_connections()
+    return GateCheckRecorder.drain()
+
+
+@shared_task
+def preload_gate_index():
+    from django.db import close_old_connections
+    from ticket.gate_check import preload_indexes
+    close_old_connections()
+    return preload_indexes()
+
+
+@shared_task
+def reconcile_gate_checks():
+    from django.db import close_old_connections
+    from ticket.gate_check import reconcile_indexes
+    close_old_connections()
+    return reconcile_indexes()
+
+
 @shared_task
 def send_show_start_notice():
     from ticket.models import TicketOrder
@@ -0,0 +1,914 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from caches.testing import FakeRedisTestCase
+
+
+def create_session(**kwargs):
+    from ticket.models import ShowProject, SessionInfo
+    now = datetime.now()
+    data = dict(show=ShowProject.objects.create(title='测试节目', sale_time=now), start_at=now + timedelta(days=1),
+                end_at=now + timedelta(days=1, hours=2), has_seat=SessionInfo.SEAT_NO)
+    data.update(kwargs)
+    return SessionInfo.objects.create(**data)
+
+
+class StockCacheScriptTest(FakeRedisTestCase):
+    def setUp(self):
+        super(StockCacheScriptTest, self).setUp()
+        from concu.stock_cache import StockModel
+        from ticket.stock_updater import TicketFileCache
+        self.sc = TicketFileCache()
+        self.sc.append_cache(StockModel(1, 5))
+        self.sc.append_cache(StockModel(2, 3))
+
+    def stocks(self):
+        return [int(qty) for qty in self.sc.get_stocks([1, 2])]
+
+    def test_incr_ceiling(self):
+        self.assertEqual(self.sc.incr(1, -3), (True, 2))
+        # 不够扣时不改动库存, 不需要回滚
+        self.assertEqual(self.sc.incr(1, -3), (False, 0))
+        self.assertEqual(self.stocks(), [2, 3])
+        self.assertEqual(self.sc.incr(1, -3, Ellipsis), (True, -1))
+
+    def test_incr_record(self):
+        self.sc.incr(1, -1, disable_record_update_ts=True)
+        self.assertFalse(self.stock_redis.smembers(self.sc.get_dirty_key()))
+        self.sc.incr(1, -1)
+        self.assertEqual(self.stock_redis.smembers(self.sc.get_dirty_key()), {'1'})
+
+    def test_batch_incr_all_or_nothing(self):
+        self.assertEqual(self.sc.batch_incr([(1, -2, 0), (2, -4, 0)]), (False, []))
+        self.assertEqual(self.stocks(), [5, 3])
+        self.assertEqual(self.sc.batch_incr([(1, -2, 0), (2, -3, 0)], record_update_ts=True),
+                         (True, [(1, 3), (2, 0)]))
+        self.assertEqual(self.stocks(), [3, 0])
+        self.assertEqual(self.stock_redis.smembers(self.sc.get_dirty_key()), {'1', '2'})
+
+    def test_same_result_as_client_side(self):
+        from concu.stock_cache import StockModel
+        from ticket.stock_updater import TicketFileCache
+        legacy = TicketFileCache()
+        legacy.use_script = False
+        ops = [(1, -2, 0), (1, -4, 0), (2, 1, Ellipsis), (1, -3, 0), (2, -5, 0)]
+        results = [self.sc.incr(*op) for op in ops]
+        self.stock_redis.flushdb()
+        legacy.append_cache(StockModel(1, 5))
+        legacy.append_cache(StockModel(2, 3))
+        self.assertEqual([legacy.incr(*op) for op in ops], results)
+
+
+class StockCacheDirtyPersistTest(FakeRedisTestCase):
+    def setUp(self):
+        super(StockCacheDirtyPersistTest, self).setUp()
+        from ticket.models import TicketFile
+        from ticket.stock_updater import TicketFileCache
+        session = create_session()
+        self.files = [TicketFile.objects.create(session=session, stock=10) for _ in range(3)]
+        self.sc = TicketFileCache()
+        self.sc.pre_cache()
+
+    def db_stocks(self):
+        from ticket.models import TicketFile
+        return [TicketFile.objects.get(pk=tf.pk).stock for tf in self.files]
+
+    def test_persist_only_dirty(self):
+        a, b, c = [tf.pk for tf in self.files]
+        self.sc.batch_incr([(a, -2, 0), (b, -3, 0)], record_update_ts=True)
+        self.sc.persist()
+        self.assertEqual(self.db_stocks(), [8, 7, 10])
+        self.assertFalse(self.stock_redis.exists(self.sc.get_dirty_key(), self.sc.get_dirty_processing_key()))
+        # 增量模式不写update-ts字典
+        self.assertFalse(self.stock_redis.exists(self.sc.get_update_ts_key()))
+
+    def test_resume_processing_set(self):
+        from concu.stock_cache import DRAIN_DIRTY_LUA, get_script
+        a, b, c = [tf.pk for tf in self.files]
+        self.sc.persist()
+        self.sc.incr(a, -1)
+        # 上一轮改名后中途崩溃, 处理中集合还在
+        get_script(DRAIN_DIRTY_LUA)(keys=[self.sc.get_dirty_key(), self.sc.get_dirty_processing_key()],
+                                    client=self.stock_redis)
+        self.sc.incr(c, -4)
+        self.sc.persist()
+        self.assertEqual(self.db_stocks(), [9, 10, 10])
+        self.assertEqual(self.stock_redis.smembers(self.sc.get_dirty_key()), {str(c)})
+        self.sc.persist()
+        self.assertEqual(self.db_stocks(), [9, 10, 6])
+
+    def test_instant_persist(self):
+        a, b, c = [tf.pk for tf in self.files]
+        self.sc.incr(a, -5)
+        self.sc.instant_persist(a)
+        self.sc.instant_persist(b)
+        self.assertEqual(self.db_stocks(), [5, 10, 10])
+
+    def test_full_persist_skips_dirty_set(self):
+        a, b, c = [tf.pk for tf in self.files]
+        for use_script in (True, False):
+            self.sc.use_dirty_set = False
+            self.sc.use_script = use_script
+            self.sc.incr(a, -1)
+            self.sc.batch_incr([(b, -1, 0)], record_update_ts=True)
+            # 全量模式只写update-ts字典, dirty集合没有消费者, 不能写入
+            self.assertFalse(self.stock_redis.exists(self.sc.get_dirty_key()))
+        self.sc.persist()
+        self.assertEqual(self.db_stocks(), [8, 8, 10])
+
+
+class SeatMapTest(FakeRedisTestCase):
+    session_id = 9001
+
+    def setUp(self):
+        super(SeatMapTest, self).setUp()
+        self.seats = [dict(index=i, row=1, column=i + 1, layers=1, color_code='#fff', is_buy=i == 1, can_buy=i != 1,
+                           is_reserve=False, order_no='T001' if i == 1 else None) for i in range(4)]
+
+    def test_round_trip(self):
+        from ticket.models import SessionSeat
+        SessionSeat.set_seat_map(self.pika, self.session_id, self.seats)
+        self.assertEqual(json.loads(SessionSeat.get_seat_map_json(self.session_id)), self.seats)
+
+    def test_set_status_and_order(self):
+        from ticket.models import SessionSeat
+        SessionSeat.set_seat_map(self.pika, self.session_id, self.seats)
+        inst = SessionSeat(session_id=self.session_id)
+        inst.set_seat_status(self.pika, 2, True, False, False)
+        inst.set_seat_order(self.pika, 2, 'T002')
+        inst.set_seat_status(self.pika, 1, False, True, False)
+        inst.set_seat_order(self.pika, 1)
+        seats = json.loads(SessionSeat.get_seat_map_json(self.session_id))
+        self.assertEqual([(seat['is_buy'], seat['can_buy'], seat['order_no']) for seat in seats],
+                         [(False, True, None), (False, True, None), (True, False, 'T002'), (False, True, None)])
+
+    def test_convert_legacy(self):
+        from caches import pika_session_seat_list_key
+        from ticket.models import SessionSeat
+        self.pika.set(pika_session_seat_list_key.format(self.session_id), json.dumps(self.seats))
+        self.assertEqual(json.loads(SessionSeat.get_seat_map_json(self.session_id)), self.seats)
+        self.assertFalse(self.pika.exists(pika_session_seat_list_key.format(self.session_id)))
+        self.assertIsNone(SessionSeat.get_seat_map_json(self.session_id + 1))
+
+    def test_map_removed(self):
+        from caches import pika_seat_geometry_key, pika_seat_status_key
+        from ticket.models import SessionSeat
+        SessionSeat.set_seat_map(self.pika, self.session_id, self.seats)
+        self.assertTrue(SessionSeat.ensure_seat_map(self.pika, self.session_id))
+        self.pika.delete(pika_seat_geometry_key.format(self.session_id), pika_seat_status_key.format(self.session_id))
+        # 座位图被删除后不能再当作已转换, 否则setrange会写出只有状态没有静态数据的座位图
+        self.assertFalse(SessionSeat.ensure_seat_map(self.pika, self.session_id))
+        self.assertIsNone(SessionSeat.get_seat_map_json(self.session_id))
+        self.assertFalse(self.pika.exists(pika_seat_status_key.format(self.session_id)))
+
+
+class SeatClaimTest(FakeRedisTestCase):
+    def test_acquire_locks_all_or_nothing(self):
+        from caches import acquire_locks, release_locks
+        self.redis.set('lock_b', 1)
+        self.assertFalse(acquire_locks(['lock_a', 'lock_b', 'lock_c'], 30))
+        self.assertFalse(self.redis.exists('lock_a', 'lock_c'))
+        self.redis.delete('lock_b')
+        self.assertTrue(acquire_locks(['lock_a', 'lock_b', 'lock_c'], 30))
+        self.assertTrue(0 < self.redis.ttl('lock_c') <= 30)
+        release_locks(['lock_a', 'lock_b', 'lock_c'])
+        self.assertFalse(self.redis.exists('lock_a', 'lock_b', 'lock_c'))
+
+    def test_batch_set_buy(self):
+        from restframework_ext.exceptions import CustomAPIException
+        from ticket.models import Venues, Seat, SessionSeat, SessionInfo, TicketFile
+        session = create_session(has_seat=SessionInfo.SEAT_HAS)
+        level = TicketFile.objects.create(session=session, stock=10)
+        venue = Venues.objects.create(name='测试场馆', address='测试地址')
+        seats = [SessionSeat.objects.create(session_id=session.id, ticket_level=level, row=1, column=i,
+                                            seats=Seat.objects.create(venue=venue, row=1, column=i))
+                 for i in range(1, 4)]
+        SessionSeat.batch_set_buy(seats[:2])
+        self.assertEqual(SessionSeat.objects.filter(is_buy=True).count(), 2)
+        # 第2个座位已被占用, 整批失败, 第3个座位的锁也不保留
+        with self.assertRaises(CustomAPIException):
+            SessionSeat.batch_set_buy(seats[1:])
+        self.assertFalse(SessionSeat.objects.get(pk=seats[2].pk).is_buy)
+        SessionSeat.batch_set_buy([seats[2]])
+        self.assertTrue(SessionSeat.objects.get(pk=seats[2].pk).is_buy)
+
+
+class ShowDetailDocTest(FakeRedisTestCase):
+    show_id = 7001
+
+    def setUp(self):
+        super(ShowDetailDocTest, self).setUp()
+        from caches import redis_show_type_copy_key, redis_venues_copy_key, redis_show_date_copy, \
+            redis_session_info_copy, redis_ticket_level_cache
+        from concu.stock_cache import StockModel
+        from ticket.stock_updater import tfc
+        self.pika.hset(redis_show_type_copy_key, 1, json.dumps(dict(id=1, name='话剧')))
+        self.pika.hset(redis_venues_copy_key, 2, json.dumps(dict(id=2, name='测试场馆')))
+        self.pika.hset(redis_show_date_copy, self.show_id, json.dumps(['2026-10-20']))
+        self.pika.hset(redis_session_info_copy, self.show_id, json.dumps([dict(no='S1'), dict(no='S2')]))
+        self.level_key = redis_ticket_level_cache.format('S1')
+        levels = [dict(id=11, price=280), dict(id=12, price=180), dict(id=13, price=80, cy=dict(ticket_pack_list=[1]))]
+        for level in levels:
+            self.pika.hset(self.level_key, level['id'], json.dumps(level))
+            tfc.append_cache(StockModel(level['id'], level['id'] * 10))
+
+    def get_cache(self):
+        from ticket.models import ShowProject
+        data = dict(status=ShowProject.STATUS_ON, sale_time='2026-01-01T00:00:00', show_type=1, venues=2)
+        return ShowProject.get_cache(data, self.show_id, None, False, False)
+
+    def test_build_and_cache(self):
+        from ticket.models import ShowProject
+        data = self.get_cache()
+        self.assertEqual(data['venues']['name'], '测试场馆')
+        self.assertEqual(data['date'], ['2026-10-20'])
+        # 按价格排序, 套票放最后, 库存实时取
+        self.assertEqual([(level['id'], level['stock']) for level in data['sessions'][0]['ticket_level']],
+                         [(12, '120'), (11, '110'), (13, '130')])
+        self.assertEqual(data['sessions'][1]['ticket_level'], [])
+        self.pika.hdel(self.level_key, 11)
+        self.assertEqual(len(self.get_cache()['sessions'][0]['ticket_level']), 3)
+        ShowProject.delete_detail_doc(self.show_id)
+        self.assertEqual(len(self.get_cache()['sessions'][0]['ticket_level']), 2)
+
+
+class L1HashCacheTest(FakeRedisTestCase):
+    def setUp(self):
+        super(L1HashCacheTest, self).setUp()
+        from caches import redis_venues_copy_key
+        from caches.local_cache import L1HashCache
+        self.key = redis_venues_copy_key
+        self.cache = L1HashCache('redis_venues_copy_key', self.key, max_size=2, ttl=60)
+        for i in range(1, 4):
+            self.pika.hset(self.key, i, json.dumps(dict(id=i, name='场馆{}'.format(i))))
+
+    def test_hit_and_invalidate(self):
+        from caches import local_cache
+        self.assertEqual(self.cache.hget_json(1)['name'], '场馆1')
+        self.pika.hset(self.key, 1, json.dumps(dict(id=1, name='新场馆')))
+        self.assertEqual(self.cache.hget_json('1')['name'], '场馆1')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # 其他进程发布的失效消息
+        with mock.patch.dict(local_cache._caches, {self.key: self.cache}):
+            local_cache._on_message(dict(data=json.dumps([self.key, '1'])))
+        self.assertEqual(self.cache.hget_json(1)['name'], '新场馆')
+
+    def test_size_and_ttl(self):
+        for i in range(1, 4):
+            self.cache.hget(i)
+        self.assertEqual(list(self.cache._data.keys()), ['2', '3'])
+        self.pika.hset(self.key, 3, 'changed')
+        self.assertNotEqual(self.cache.hget(3), 'changed')
+        with mock.patch('caches.local_cache.time.time', return_value=time.time() + 61):
+            self.assertEqual(self.cache.hget(3), 'changed')
+
+    def test_disabled(self):
+        from caches.local_cache import L1HashCache
+        cache = L1HashCache('redis_venues_copy_key', self.key, enabled=False)
+        cache.hget(1)
+        self.pika.hset(self.key, 1, 'changed')
+        self.assertEqual(cache.hget(1), 'changed')
+        self.assertIsNone(cache.hget_json(9))
+
+
+class ShowCacheWarmerTest(FakeRedisTestCase):
+    def setUp(self):
+        super(ShowCacheWarmerTest, self).setUp()
+        from ticket.models import Venues
+        self.venues = [Venues.objects.create(name='场馆{}'.format(i), address='地址') for i in range(5)]
+
+    def test_resume_from_checkpoint(self):
+        from caches import redis_venues_copy_key
+        from ticket.cache_warmer import ShowCacheWarmer, warm_cache_checkpoint_key
+        warmer = ShowCacheWarmer(batch_size=2)
+        write_venues = warmer.write_venues
+        written = []
+        interrupt = [True]
+
+        def handler(objs, writer):
+            if interrupt[0] and self.venues[2] in objs:
+                raise RuntimeError('interrupted')
+            written.extend(objs)
+            write_venues(objs, writer)
+
+        warmer.stages[2].handler = handler
+        with self.assertRaises(RuntimeError):
+            warmer.run()
+        self.assertEqual(self.pika.hget(warm_cache_checkpoint_key, 'venues'), str(self.venues[1].pk))
+        interrupt[0] = False
+        warmer.run()
+        # 第二次从断点继续, 已写入的一批不再处理
+        self.assertEqual(written, self.venues)
+        self.assertEqual(self.pika.hlen(redis_venues_copy_key), 5)
+        self.assertFalse(self.pika.exists(warm_cache_checkpoint_key))
+
+    def test_stock_not_overwritten(self):
+        from ticket.cache_warmer import ShowCacheWarmer
+        from ticket.models import TicketFile
+        from ticket.stock_updater import tfc
+        session = create_session()
+        a, b = [TicketFile.objects.create(session=session, stock=10) for _ in range(2)]
+        self.stock_redis.set(tfc.cache_key(a.pk), 3)
+        ShowCacheWarmer().pre_cache_stock()
+        self.assertEqual(tfc.get_stocks([a.pk, b.pk]), ['3', '10'])
+
+
+class ShowCalendarTest(FakeRedisTestCase):
+    def calendar(self):
+        from ticket.models import ShowProject
+        return ShowProject.get_show_calendar(2030, 5)[0]
+
+    def test_incremental_index(self):
+        from ticket.models import SessionInfo
+        day = datetime(2030, 5, 10, 19, 30)
+        session = create_session(start_at=day, end_at=day + timedelta(hours=2), status=SessionInfo.STATUS_OFF)
+        create_session(start_at=day, end_at=day + timedelta(hours=2), status=SessionInfo.STATUS_ON)
+        session.status = SessionInfo.STATUS_ON
+        session.save(update_fields=['status'])
+        self.assertEqual(self.calendar(), {'2030-05-10': 2})
+        session.start_at = day + timedelta(days=1)
+        session.save(update_fields=['start_at'])
+        session.change_show_calendar()
+        self.assertEqual(self.calendar(), {'2030-05-10': 1, '2030-05-11': 1})
+        session.status = SessionInfo.STATUS_OFF
+        session.save(update_fields=['status'])
+        # 重复调用不会重复计数
+        session.change_show_calendar()
+        self.assertEqual(self.calendar(), {'2030-05-10': 1})
+
+    def test_rebuild_old_month(self):
+        from caches import pika_show_calendar_session_key
+        from ticket.models import ShowProject, SessionInfo
+        day = datetime(2030, 5, 31, 19, 30)
+        session = create_session(start_at=day, end_at=day + timedelta(hours=2), status=SessionInfo.STATUS_ON)
+        self.assertEqual(self.calendar(), {'2030-05-31': 1})
+        # 历史场次没有记录过位置, 改到下个月后旧月份也要重建, 否则5月一直多算一场
+        self.pika.hdel(pika_show_calendar_session_key, session.id)
+        session.start_at = day + timedelta(days=1)
+        session.save(update_fields=['start_at'])
+        session.change_show_calendar(day)
+        self.assertEqual(self.calendar(), {})
+        self.assertEqual(ShowProject.get_show_calendar(2030, 6)[0], {'2030-06-01': 1})
+
+
+class ShowRebuildQueueTest(FakeRedisTestCase):
+    def setUp(self):
+        super(ShowRebuildQueueTest, self).setUp()
+        from ticket.show_rebuild import ShowRebuildQueue
+        patcher = mock.patch.object(ShowRebuildQueue, 'schedule')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_coalesce_and_debounce(self):
+        from caches import show_rebuild_first_key
+        from ticket.show_rebuild import ShowRebuildQueue
+        for show_id, reason in [(1, 'a'), (1, 'b'), (2, 'c')]:
+            ShowRebuildQueue.enqueue(show_id, reason)
+        now = time.time()
+        self.assertEqual(ShowRebuildQueue.get_due(now), [])
+        self.assertEqual(sorted(ShowRebuildQueue.get_due(now + ShowRebuildQueue.debounce)), ['1', '2'])
+        # 一直有新的修改也不会超过max_wait
+        self.redis.hset(show_rebuild_first_key, 1, now - ShowRebuildQueue.max_wait)
+        self.assertEqual(ShowRebuildQueue.get_due(now), ['1'])
+        self.assertEqual(ShowRebuildQueue.claim('1')[2], 'b')
+        self.assertEqual(ShowRebuildQueue.claim('1')[0], 0)
+
+    def test_drain(self):
+        from caches import redis_session_info_copy
+        from ticket.show_rebuild import ShowRebuildQueue
+        session = create_session()
+        self.pika.delete(redis_session_info_copy)
+        ShowRebuildQueue.enqueue(session.show_id, 'a')
+        ShowRebuildQueue.enqueue(session.show_id, 'b')
+        with mock.patch.object(ShowRebuildQueue, 'debounce', 0):
+            self.assertEqual(ShowRebuildQueue.drain(), 1)
+        self.assertTrue(self.pika.hexists(redis_session_info_copy, session.show_id))
+        self.assertEqual(ShowRebuildQueue.metrics()['depth'], 0)
+
+
+class NoSeatOrderPipelineTest(FakeRedisTestCase):
+    def setUp(self):
+        super(NoSeatOrderPipelineTest, self).setUp()
+        from concu.stock_cache import StockModel, BATCH_INCR_LUA, get_script
+        from ticket.async_order import NoSeatOrderPipeline
+        from ticket.stock_updater import tfc
+        self.pipeline = NoSeatOrderPipeline(db_workers=1, max_pending=2)
+        self.addCleanup(self.pipeline.executor.shutdown)
+
+        async def batch_incr_script(keys, args):
+            return get_script(BATCH_INCR_LUA)(keys=keys, args=args, client=self.stock_redis)
+
+        self.pipeline._batch_incr_script = batch_incr_script
+        tfc.append_cache(StockModel(1, 3))
+        self.user = mock.Mock(forbid_order=False, mobile='13800000000')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def create(self, multiply: int, create_order=None):
+        from ticket.models import SessionInfo
+        session = mock.Mock(id=1, can_buy=True, has_seat=SessionInfo.SEAT_NO)
+
+        async def cache_get(key):
+            return session
+
+        async def cache_get_many(keys):
+            return [mock.Mock(id=1, lock_stock=False)]
+
+        async def get_user(token):
+            return self.user
+
+        data = dict(session_id=1, mobile='13800000000', multiply=multiply,
+                    ticket_list=[dict(level_id=1, multiply=multiply)])
+        with mock.patch('caches.async_client.cache_get', cache_get), \
+                mock.patch('caches.async_client.cache_get_many', cache_get_many), \
+                mock.patch('mall.user_cache.async_token_to_cache_user', get_user), \
+                mock.patch.object(self.pipeline, 'create_order', create_order or mock.Mock(return_value='ok')):
+            return self.loop.run_until_complete(self.pipeline.create('token', data, dict(), dict()))
+
+    def stock(self):
+        from ticket.stock_updater import tfc
+        return int(tfc.get_stock(1))
+
+    def test_reserve_stock(self):
+        from restframework_ext.exceptions import CustomAPIException
+        self.assertEqual(self.create(2), 'ok')
+        self.assertEqual(self.stock(), 1)
+        create_order = mock.Mock()
+        with self.assertRaises(CustomAPIException):
+            self.create(2, create_order)
+        # 库存不足不进入数据库阶段
+        create_order.assert_not_called()
+        self.assertEqual(self.stock(), 1)
+
+    def test_release_on_db_error(self):
+        with self.assertRaises(ValueError):
+            self.create(2, mock.Mock(side_effect=ValueError))
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(self.pipeline.pending, 0)
+
+    def test_reject_when_busy(self):
+        from restframework_ext.exceptions import CustomAPIException
+        self.pipeline.pending = self.pipeline.max_pending
+        with self.assertRaises(CustomAPIException) as ctx:
+            self.create(1)
+        self.assertEqual(ctx.exception.status_code, 429)
+        self.assertEqual(self.pipeline.get_metrics()['rejected'], 1)
+        self.assertEqual(self.stock(), 3)
+
+
+class TicketOrderExportTest(FakeRedisTestCase):
+    def setUp(self):
+        super(TicketOrderExportTest, self).setUp()
+        from mall.models import User
+        from ticket.models import TicketOrder
+        session = create_session()
+        user = User.objects.create(username='export', mobile='13800000001')
+        self.orders = [TicketOrder.objects.create(user=user, session=session, title='测试节目', multiply=1, amount=100,
+                                                  order_no='NO{}'.format(i)) for i in range(5)]
+        self.filepath = os.path.join(tempfile.mkdtemp(), 'orders.xlsx')
+        self.addCleanup(os.remove, self.filepath)
+
+    def export(self, ids, chunk_size=2):
+        from ticket.order_export import TicketOrderExporter
+        progress = []
+        exporter = TicketOrderExporter(ids, progress=lambda done, total: progress.append((done, total)))
+        exporter.chunk_size = chunk_size
+        exporter.write(self.filepath)
+        return progress
+
+    def test_export(self):
+        from openpyxl import load_workbook
+        from ticket.models import TicketOrder
+        progress = self.export([order.id for order in self.orders])
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        rows = list(load_workbook(self.filepath, read_only=True).active.iter_rows(values_only=True))
+        self.assertEqual(list(rows[0]), TicketOrder.export_fields())
+        # 按id倒序
+        order_no = rows[0].index('订单号')
+        self.assertEqual([row[order_no] for row in rows[1:]], ['NO4', 'NO3', 'NO2', 'NO1', 'NO0'])
+
+    def test_queries_per_chunk(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as small:
+            self.export([order.id for order in self.orders[:2]], chunk_size=10)
+        with CaptureQueriesContext(connection) as large:
+            self.export([order.id for order in self.orders], chunk_size=10)
+        # 每批的查询数固定, 不随订单数增加
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+
+class TicketUserCodeBulkTest(FakeRedisTestCase):
+    def test_bulk_create_records(self):
+        from mall.models import User
+        from ticket.models import TicketColor, TicketFile, TicketOrder, TicketUserCode
+        session = create_session()
+        color = TicketColor.objects.create(name='绿色', code='#19D9E7')
+        level = TicketFile.objects.create(session=session, color=color, stock=10, price=100)
+        user = User.objects.create(username='code', mobile='13800000002')
+        orders = [TicketOrder.objects.create(user=user, session=session, title='测试节目', multiply=3, amount=300)
+                  for _ in range(2)]
+        first = TicketUserCode.bulk_create_records(orders[0], [(level, None)] * 3)
+        TicketUserCode.bulk_create_records(orders[1], [(level, None)] * 3)
+        codes = dict(TicketUserCode.objects.values_list('id', 'code'))
+        self.assertEqual(len(codes), 6)
+        self.assertEqual(len(set(codes.values())), 6)
+        # 已出的码不会被后面的订单改写
+        self.assertEqual(dict((inst.id, inst.code) for inst in first),
+                         dict((inst.id, codes[inst.id]) for inst in first))
+        for _id, code in codes.items():
+            self.assertEqual(int(code) % 10 ** len(str(_id)), _id)
+
+
+class GateCheckTest(FakeRedisTestCase):
+    def setUp(self):
+        super(GateCheckTest, self).setUp()
+        from mall.models import User
+        from ticket.models import TicketColor, TicketFile, TicketOrder, TicketUserCode
+        self.session = create_session(can_check_at=datetime.now() - timedelta(hours=1))
+        color = TicketColor.objects.create(name='绿色', code='#19D9E7')
+        level = TicketFile.objects.create(session=self.session, color=color, stock=10, price=100)
+        user = User.objects.create(username='gate', mobile='13800000003')
+        self.account = user.account
+        self.orders = []
+        self.codes = []
+        for _ in range(2):
+            order = TicketOrder.objects.create(user=user, session=self.session, title='测试节目', multiply=2, amount=200)
+            TicketUserCode.bulk_create_records(order, [(level, None)] * 2)
+            self.orders.append(order)
+            self.codes.append(list(TicketUserCode.objects.filter(order=order).order_by('id').values_list('code',
+                                                                                                          flat=True)))
+
+    def test_claim(self):
+        from ticket import gate_check
+        index = gate_check.GateCheckIndex(self.session.no)
+        self.assertEqual(index.load(), 4)
+        code = self.codes[0][0]
+        status, snapshot, codes = index.claim(code, gate_check.MODE_CODE, self.account.id)
+        self.assertEqual((status, codes), (gate_check.ST_OK, [code]))
+        self.assertEqual(snapshot['seat'], '无座')
+        self.assertEqual(index.claim(code, gate_check.MODE_CODE, self.account.id)[0], gate_check.ST_CHECKED)
+        self.assertEqual(index.claim('0', gate_check.MODE_CODE, self.account.id)[0], gate_check.ST_MISS)
+        # 按订单检票占用订单全部未检的码
+        status, _, codes = index.claim(self.codes[1][1], gate_check.MODE_ORDER, self.account.id)
+        self.assertEqual((status, sorted(codes)), (gate_check.ST_OK, sorted(self.codes[1])))
+        # 不在检票时间内不占用
+        check_start = gate_check.to_ts(self.session.can_check_at)
+        status, _, codes = index.claim(self.codes[0][1], gate_check.MODE_ORDER, self.account.id, now=check_start - 1)
+        self.assertEqual((status, codes), (gate_check.ST_EARLY, [code, self.codes[0][1]]))
+        status, _, _ = index.claim(self.codes[0][1], gate_check.MODE_CODE, self.account.id,
+                                   now=gate_check.to_ts(self.session.end_at))
+        self.assertEqual(status, gate_check.ST_ENDED)
+        self.assertEqual(self.redis.llen(index.queue_key), 3)
+
+    def test_drain(self):
+        from ticket import gate_check
+        from ticket.models import TicketOrder, TicketUserCode
+        index = gate_check.GateCheckIndex(self.session.no)
+        index.load()
+        index.claim(self.codes[0][0], gate_check.MODE_CODE, self.account.id)
+        index.claim(self.codes[1][0], gate_check.MODE_ORDER, self.account.id)
+        self.assertEqual(gate_check.GateCheckRecorder.drain(), 3)
+        self.assertEqual(gate_check.GateCheckRecorder.drain(), 0)
+        checked = TicketUserCode.objects.filter(status=TicketUserCode.STATUS_CHECK, check_user_id=self.account.id)
+        self.assertEqual(sorted(checked.values_list('code', flat=True)), sorted([self.codes[0][0]] + self.codes[1]))
+        orders = dict(TicketOrder.objects.filter(id__in=[order.id for order in self.orders]).values_list('id',
+                                                                                                       'is_check_num'))
+        self.assertEqual(orders, {self.orders[0].id: 1, self.orders[1].id: 2})
+        self.assertEqual(TicketOrder.objects.get(id=self.orders[1].id).status, TicketOrder.STATUS_FINISH)
+        # 已写库的不再补写
+        self.assertEqual(index.reconcile(), 0)
+
+    def test_sub_session_claim_once(self):
+        from ticket import gate_check
+        from ticket.models import SessionInfo
+        main = create_session(can_check_at=datetime.now() - timedelta(hours=1))
+        SessionInfo.objects.filter(id=self.session.id).update(main_session=main)
+        main_index, sub_index = gate_check.GateCheckIndex(main.no), gate_check.GateCheckIndex(self.session.no)
+        self.assertEqual((main_index.load(), sub_index.load()), (4, 4))
+        code = self.codes[0][0]
+        self.assertEqual(main_index.claim(code, gate_check.MODE_CODE, self.account.id)[0], gate_check.ST_OK)
+        # 子场次的码在两个索引里, 从子场次再扫不能再占用一次
+        self.assertEqual(sub_index.claim(code, gate_check.MODE_CODE, self.account.id)[0], gate_check.ST_CHECKED)
+        status, _, codes = sub_index.claim(self.codes[0][1], gate_check.MODE_ORDER, self.account.id)
+        self.assertEqual((status, codes), (gate_check.ST_OK, [self.codes[0][1]]))
+        self.assertEqual(main_index.claim(self.codes[0][1], gate_check.MODE_CODE, self.account.id)[0],
+                         gate_check.ST_CHECKED)
+        # 重新实例化时从索引信息取共用的已检票hash
+        index = gate_check.GateCheckIndex(self.session.no)
+        self.assertTrue(index.ensure_loaded())
+        self.assertEqual(index.checked_key, main_index.checked_key)
+        self.assertEqual(self.redis.llen(index.queue_key), 2)
+        self.assertEqual(gate_check.reconcile_indexes(), 2)
+
+
+class OrderExpiryPipelineTest(FakeRedisTestCase):
+    def setUp(self):
+        super(OrderExpiryPipelineTest, self).setUp()
+        from concu.stock_cache import StockModel
+        from mall.models import User
+        from ticket.models import TicketColor, TicketFile, TicketOrder
+        from ticket.order_expiry import OrderExpiryPipeline
+        from ticket.stock_updater import tfc
+        session = create_session()
+        color = TicketColor.objects.create(name='绿色', code='#19D9E7')
+        self.level = TicketFile.objects.create(session=session, color=color, stock=10, price=100)
+        tfc.append_cache(StockModel(self.level.id, 5))
+        user = User.objects.create(username='expire', mobile='13800000004')
+        self.orders = []
+        for multiply, status in [(2, TicketOrder.STATUS_UNPAID), (1, TicketOrder.STATUS_UNPAID),
+                                 (3, TicketOrder.STATUS_PAID)]:
+            snapshot = json.dumps(dict(price_list=[dict(level_id=self.level.id, multiply=multiply)]))
+            self.orders.append(TicketOrder.objects.create(
+                user=user, session=session, title='测试节目', multiply=multiply, amount=100 * multiply, status=status,
+                order_type=TicketOrder.TY_NO_SEAT, snapshot=snapshot))
+        TicketOrder.objects.update(create_at=datetime.now() - timedelta(minutes=30))
+        self.pipeline = OrderExpiryPipeline()
+
+    def stock(self):
+        from ticket.stock_updater import tfc
+        return int(tfc.get_stock(self.level.id))
+
+    def test_cancel_and_return_stock(self):
+        from ticket.models import TicketOrder
+        self.assertEqual(self.pipeline.sync(), 2)
+        ids = self.pipeline.get_due(10)
+        self.assertEqual(sorted(map(int, ids)), [self.orders[0].id, self.orders[1].id])
+        ret = self.pipeline.process(ids, 10)
+        self.assertEqual((ret['cancelled'], ret['error']), (2, 0))
+        self.assertEqual(self.stock(), 8)
+        self.assertEqual(TicketOrder.objects.filter(status=TicketOrder.STATUS_CANCELED).count(), 2)
+        self.assertEqual(self.pipeline.get_due(10), [])
+        # 已取消的订单重复执行不再返还
+        self.assertEqual(self.pipeline.process(ids, 10)['skipped'], 2)
+        self.assertEqual(self.stock(), 8)
+
+    def test_delay(self):
+        from caches import order_expire_index_key
+        self.pipeline.sync()
+        ids = self.pipeline.get_due(10)
+        self.pipeline.delay(ids, 10)
+        self.assertEqual(self.pipeline.get_due(10), [])
+        self.assertAlmostEqual(self.redis.zscore(order_expire_index_key, ids[0]),
+                               time.time() + self.pipeline.retry_delay - 600, delta=2)
+
+    def test_retry_failed_release(self):
+        from caches import order_expire_release_key
+        from ticket.stock_updater import tfc
+        self.pipeline.sync()
+        with mock.patch.object(tfc, 'batch_incr', side_effect=ConnectionError):
+            ret = self.pipeline.process(self.pipeline.get_due(10), 10)
+        self.assertEqual((ret['cancelled'], ret['error']), (2, 2))
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(json.loads(self.redis.hget(order_expire_release_key, self.orders[0].id)),
+                         dict(phases=['stock'], tries=0))
+        with mock.patch('ticket.models.TicketOrder.get_or_set_real_name_buy_num') as real_name:
+            self.assertEqual(self.pipeline.retry_release(), 2)
+        # 只重试失败的步骤
+        real_name.assert_not_called()
+        self.assertEqual(self.stock(), 8)
+        self.assertFalse(self.redis.exists(order_expire_release_key))
+
+
+class DueWorkTest(FakeRedisTestCase):
+    def setUp(self):
+        super(DueWorkTest, self).setUp()
+        from ticket.models import SessionInfo
+        from ticket.show_rebuild import ShowRebuildQueue
+        patcher = mock.patch.object(ShowRebuildQueue, 'schedule')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now = datetime.now()
+        self.ended = create_session(start_at=now - timedelta(hours=3), end_at=now - timedelta(hours=1),
+                                    status=SessionInfo.STATUS_ON)
+        self.future = create_session(status=SessionInfo.STATUS_ON)
+
+    def test_pop_due(self):
+        from ticket.models import session_off_work
+        self.assertEqual(self.redis.zcard(session_off_work.key), 2)
+        self.assertEqual(session_off_work.pop_due(), [self.ended.id])
+        self.assertEqual(session_off_work.pop_due(), [])
+        self.assertEqual(self.redis.zrange(session_off_work.key, 0, -1), [str(self.future.id)])
+
+    def test_run(self):
+        from ticket.models import SessionInfo, session_off_work
+        self.assertEqual(session_off_work.run(), 1)
+        self.assertEqual(SessionInfo.objects.get(id=self.ended.id).status, SessionInfo.STATUS_OFF)
+        self.assertEqual(SessionInfo.objects.get(id=self.future.id).status, SessionInfo.STATUS_ON)
+        self.assertEqual(session_off_work.metrics()['count'], 1)
+        # 没有登记的由sweep补登记
+        self.redis.delete(session_off_work.key, session_off_work.swept_key)
+        SessionInfo.objects.filter(id=self.future.id).update(end_at=datetime.now() - timedelta(minutes=1))
+        self.assertEqual(session_off_work.run(), 1)
+        self.assertEqual(SessionInfo.objects.get(id=self.future.id).status, SessionInfo.STATUS_OFF)
+
+    def test_handler_error(self):
+        from caches import due_work
+        with mock.patch.dict(due_work._works):
+            work = due_work.DueWork('test', mock.Mock(side_effect=ValueError))
+            work.register(1, datetime.now() - timedelta(minutes=1))
+            self.assertEqual(work.run(), 0)
+            # 推迟retry_delay秒重试
+            self.assertEqual(work.pop_due(), [])
+            self.assertAlmostEqual(self.redis.zscore(work.key, 1), time.time() + work.retry_delay, delta=2)
+            self.assertEqual(work.metrics()['error'], 1)
+
+
+class CpsAttributionTest(FakeRedisTestCase):
+    def setUp(self):
+        super(CpsAttributionTest, self).setUp()
+        from mall.models import Receipt, User
+        from ticket.models import TicketOrder
+        session = create_session()
+        user = User.objects.create(username='cps', mobile='13800000005')
+        now = datetime.now()
+        self.orders = [TicketOrder.objects.create(
+            user=user, session=session, title='测试节目', multiply=1, amount=100, status=TicketOrder.STATUS_PAID,
+            pay_type=Receipt.PAY_TikTok_LP, pay_at=now - timedelta(minutes=10 - i), tiktok_order_id='tt{}'.format(i))
+            for i in range(3)]
+        cps = dict(source_type=1, commission_user_douyinid='dy1', commission_user_nickname='达人', task_id='t1')
+        no_cps = (True, dict(data=dict(error_code=0, cps_info=dict(cps_item_list=[]))))
+        self.results = {self.orders[0].order_no: (True, dict(data=dict(error_code=0, cps_info=dict(
+            cps_item_list=[cps], total_commission_amount=250)))), self.orders[1].order_no: no_cps,
+            self.orders[2].order_no: None}
+        self.client = mock.Mock()
+        self.client.query_cps.side_effect = lambda order_no: self.results[order_no]
+        for name in ['send_award', 'change_cps_agent_amount']:
+            patcher = mock.patch.object(TicketOrder, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_run(self):
+        from caches import cps_attribution_watermark_key
+        from ticket.cps_attribution import CpsAttribution
+        from ticket.models import TicketOrder
+        ret = CpsAttribution(self.client, workers=2, rate=0).run()
+        self.assertEqual((ret['orders'], ret['cps'], ret['no_cps'], ret['failed']), (3, 1, 1, 1))
+        orders = dict(TicketOrder.objects.values_list('id', 'source_type'))
+        self.assertEqual([orders[order.id] for order in self.orders],
+                         [1, TicketOrder.SOURCE_NO, TicketOrder.SOURCE_DEFAULT])
+        order = TicketOrder.objects.get(id=self.orders[0].id)
+        self.assertEqual((order.tiktok_douyinid, order.tiktok_commission_amount), ('dy1', Decimal('2.5')))
+        self.assertEqual(self.change_cps_agent_amount.call_count, 1)
+        self.assertEqual(self.send_award.call_count, 1)
+        # 水位停在未查到结果的订单
+        self.assertEqual(float(self.redis.get(cps_attribution_watermark_key)),
+                         time.mktime(self.orders[2].pay_at.timetuple()))
+        self.results[self.orders[2].order_no] = self.results[self.orders[1].order_no]
+        self.client.query_cps.reset_mock()
+        ret = CpsAttribution(self.client, workers=2, rate=0).run()
+        self.assertEqual((ret['orders'], ret['no_cps'], ret['failed']), (1, 1, 0))
+        self.client.query_cps.assert_called_once_with(self.orders[2].order_no)
+
+    def test_dry_run(self):
+        from caches import cps_attribution_watermark_key
+        from ticket.cps_attribution import CpsAttribution
+        from ticket.models import TicketOrder
+        ret = CpsAttribution(self.client, workers=2, rate=0, dry_run=True).run()
+        self.assertEqual((ret['cps'], ret['no_cps']), (1, 1))
+        self.assertEqual(TicketOrder.objects.filter(source_type=TicketOrder.SOURCE_DEFAULT).count(), 3)
+        self.assertFalse(self.redis.exists(cps_attribution_watermark_key))
+        self.send_award.assert_not_called()
+
+
+class TeamAwardTest(FakeRedisTestCase):
+    def test_stop_at_buyer(self):
+        from mall.models import User
+        from shopping_points.models import UserAccount, UserAccountLevel, UserCommissionChangeRecord
+        from ticket.models import TicketOrder
+        level = UserAccountLevel.objects.create(name='代理', grade=1, team_ratio=10)
+        parent = None
+        users = []
+        for i in range(4):
+            parent = User.objects.create(username='team{}'.format(i), mobile='1380000002{}'.format(i), parent=parent)
+            users.append(parent)
+        UserAccount.objects.filter(user__in=users).update(level=level)
+        # 买家在上级链路中间, 只发到买家之前
+        order = TicketOrder.objects.create(user=users[1], session=create_session(), title='测试节目', multiply=1,
+                                           amount=100, actual_amount=100)
+        self.assertTrue(order.team_award(users[3]))
+        records = UserCommissionChangeRecord.objects.filter(order=order).order_by('id')
+        self.assertEqual([(r.account.user_id, r.amount) for r in records],
+                         [(users[3].id, Decimal('10.00')), (users[2].id, Decimal('10.00'))])
+
+
+class ShowNoticeTest(FakeRedisTestCase):
+    def setUp(self):
+        super(ShowNoticeTest, self).setUp()
+        from mall.models import User
+        from ticket import show_notice
+        from ticket.models import TicketColor, TicketFile, TicketOrder, TicketUserCode
+        patcher = mock.patch.dict(show_notice._limiters)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now = datetime.now()
+        user = User.objects.create(username='notice', mobile='13800000030')
+        self.orders = []
+        for i, hours in enumerate([1, 1, 10]):
+            session = create_session(start_at=now + timedelta(hours=hours), end_at=now + timedelta(hours=hours + 2))
+            self.orders.append(TicketOrder.objects.create(
+                user=user, session=session, title='节目{}'.format(i), mobile='1380000004{}'.format(i), multiply=1,
+                amount=100, status=TicketOrder.STATUS_PAID))
+        color = TicketColor.objects.create(name='绿色', code='#19D9E7')
+        for order in [self.orders[0], self.orders[2]]:
+            level = TicketFile.objects.create(session=order.session, color=color, stock=10, price=100)
+            TicketUserCode.bulk_create_records(order, [(level, None)])
+
+    def test_run_order(self):
+        from ticket.models import TicketOrder
+        from ticket.show_notice import FakeSmsProvider, NoticeDispatcher, show_notice_metrics
+        provider = FakeSmsProvider(latency=0)
+        ret = NoticeDispatcher(provider, workers=2, rate=0).run('order')
+        # 没有检票码的订单只标记不发送
+        self.assertEqual(ret, dict(sent=2, failed=0))
+        self.assertEqual(sorted([(data['mobile'], data['number']) for data in provider.sent]),
+                         [('13800000040', 2), ('13800000042', 24)])
+        flags = dict((_id, (a, b)) for _id, a, b in TicketOrder.objects.values_list('id', 'push_message',
+                                                                                  'push_message_day'))
+        self.assertEqual([flags[order.id] for order in self.orders], [(True, True), (True, True), (False, True)])
+        # 已认领的不再发送
+        self.assertEqual(NoticeDispatcher(provider, workers=2, rate=0).run('order'), dict(sent=0, failed=0))
+        self.assertEqual(show_notice_metrics()['order_sent'], '2')
+
+    def test_retry(self):
+        from ticket.show_notice import NoticeDispatcher
+        provider = mock.Mock()
+        provider.smsvrcode.side_effect = [False, ConnectionError, True]
+        dispatcher = NoticeDispatcher(provider, workers=1, rate=0)
+        with mock.patch('ticket.show_notice.time.sleep'):
+            self.assertTrue(dispatcher.send_one(dict(mobile='13800000040')))
+            provider.smsvrcode.side_effect = None
+            provider.smsvrcode.return_value = False
+            self.assertEqual(dispatcher.send('order', [dict(mobile='13800000040')]), dict(sent=0, failed=1))
+        self.assertEqual(provider.smsvrcode.call_count, 3 + dispatcher.retries + 1)
+
+
+class SeatMapUploadTest(FakeRedisTestCase):
+    def setUp(self):
+        super(SeatMapUploadTest, self).setUp()
+        from ticket.models import SessionInfo, Seat, TicketColor, TicketFile, Venues
+        self.session = create_session(has_seat=SessionInfo.SEAT_HAS, status=SessionInfo.STATUS_OFF)
+        self.levels = [TicketFile.objects.create(session=self.session, color=TicketColor.objects.create(
+            name='色{}'.format(i), code='#00000{}'.format(i)), stock=10, price=100 * (i + 1)) for i in range(2)]
+        venue = Venues.objects.create(name='测试场馆', address='测试地址')
+        self.seats = [Seat.objects.create(venue=venue, row=1, column=i, layers=1, seat_no='1-1-{}'.format(i))
+                      for i in range(1, 6)]
+
+    def data(self, num: int, level_ids: dict = None, reserve: tuple = ()):
+        level_ids = level_ids or dict()
+        return [dict(ticket_level_id=level_ids.get(i, self.levels[0].id), seat_no=seats.seat_no,
+                     is_reserve=i in reserve, showRow=1, showCol=i + 1) for i, seats in enumerate(self.seats[:num])]
+
+    def pika_fields(self) -> list:
+        from caches import pika_session_seat_key
+        return sorted(self.pika.hkeys(pika_session_seat_key.format(self.session.id)))
+
+    def test_create_and_update(self):
+        from caches import pika_level_seat_key
+        from ticket.models import SessionInfo, SessionSeat
+        SessionSeat.create_record(self.data(3), 'cache')
+        self.assertEqual(SessionSeat.objects.filter(session_id=self.session.id).count(), 3)
+        self.assertTrue(SessionInfo.objects.get(id=self.session.id).is_price)
+        SessionSeat.create_record(self.data(3, {0: self.levels[1].id}, reserve=(1,)), 'cache')
+        ss = {inst.seats_id: inst for inst in SessionSeat.objects.filter(session_id=self.session.id)}
+        self.assertEqual(len(ss), 3)
+        self.assertEqual((ss[self.seats[0].id].ticket_level_id, ss[self.seats[0].id].price),
+                         (self.levels[1].id, Decimal('200.00')))
+        self.assertTrue(ss[self.seats[1].id].is_reserve)
+        # 整个场次重写, 旧票档的field不保留
+        self.assertEqual(self.pika_fields(), sorted(
+            [pika_level_seat_key.format(self.levels[1].id, self.seats[0].id)] +
+            [pika_level_seat_key.format(self.levels[0].id, seats.id) for seats in self.seats[1:3]]))
+        seat_map = json.loads(SessionSeat.get_seat_map_json(self.session.id))
+        self.assertEqual([seat['can_buy'] for seat in seat_map], [True, False, True])
+
+    def test_queries_not_per_seat(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from ticket.models import SessionInfo, SessionSeat
+        counts = []
+        for num in [2, 5]:
+            SessionSeat.objects.all().delete()
+            SessionInfo.objects.filter(id=self.session.id).update(is_price=False)
+            with CaptureQueriesContext(connection) as ctx:
+                SessionSeat.create_record(self.data(num, {0: self.levels[num % 2].id}), 'cache')
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_bought_seat_rejected(self):
+        from restframework_ext.exceptions import CustomAPIException
+        from ticket.models import SessionSeat
+        SessionSeat.create_record(self.data(3), 'cache')
+        SessionSeat.objects.filter(seats=self.seats[2]).update(is_buy=True)
+        fields = self.pika_fields()
+        with self.assertRaises(CustomAPIException):
+            SessionSeat.create_record(self.data(3, {2: self.levels[1].id}), 'cache')
+        # 检查在写入前完成, pika不会被改写一半
+        self.assertEqual(self.pika_fields(), fields)
+        self.assertEqual(SessionSeat.objects.get(seats=self.seats[2]).ticket_level_id, self.levels[0].id)
@@ -170,8 +170,8 @@ class ShowProjectViewSet(SerializerSelector, DetailPKtoNoViewSet):
         try:
             show_id = int(no[:-2])
         except Exception as e:
-            with get_pika_redis() as pika:
-                show_id = pika.hget(redis_shows_no_key, no)
+            from caches.local_cache import l1_hget
+            show_id = l1_hget(redis_shows_no_key, no)
             if not show_id:
                 show = self.get_object()
                 show.set_shows_no_pk()
@@ -569,16 +569,15 @@ class SessionSeatViewSet(ReturnNoDetailViewSet):
         session_id = request.GET.get('session_id')
         if not session_id:
             raise CustomAPIException('session_id必传')
-        from caches import get_pika_redis, pika_session_seat_list_key, redis_session_no_key
-        pika = get_pika_redis()
-        s_id = pika.hget(redis_session_no_key, session_id)
+        from caches import redis_session_no_key
+        from caches.local_cache import l1_hget
+        s_id = l1_hget(redis_session_no_key, session_id)
         if not s_id:
             raise CustomAPIException('未配置座位信息')
-        key = pika_session_seat_list_key.format(s_id)
-        data = pika.get(key)
-        data = json.loads(data) if data else None
+        data = SessionSeat.get_seat_map_json(s_id)
         # data = self.serializer_class(seat_qs, many=True, context={'request': request}).data
-        return Response(data)
+        # 座位图已是json字符串,直接返回,不再解析和重新编码
+        return HttpResponse(data or 'null', content_type='application/json')
 
     @action(methods=['get'], detail=False)
     def get_data(self, request):
@@ -586,8 +585,9 @@ class SessionSeatViewSet(ReturnNoDetailViewSet):
         if not session_id:
             raise CustomAPIException('session_id必传')
         from caches import get_pika_redis, pika_session_seat_key, redis_session_no_key
+        from caches.local_cache import l1_hget
         pika = get_pika_redis()
-        s_id = pika.hget(redis_session_no_key, session_id)
+        s_id = l1_hget(redis_session_no_key, session_id)
         if not s_id:
             raise CustomAPIException('未配置座位信息')
         key = pika_session_seat_key.format(s_id)